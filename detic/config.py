@@ -140,6 +140,14 @@ def add_rsprompter_config(cfg):
     _C.MODEL.BACKBONE.SAM_TYPE = 'vit_t'
     _C.MODEL.BACKBONE.ADD_UNFROZEN = 'xxx'
     _C.MODEL.RPN.OBJECTNESS_LOSS_TYPE = 'binary_ce'
+    # test proposals per image picked from the objectness: '' keeps
+    # POST_NMS_TOPK_TEST, 'threshold' the ones with a probability of at least
+    # ADAPTIVE_TOPK_THRESH, 'mass' the top ones holding ADAPTIVE_TOPK_MASS of
+    # the summed probability; at least ADAPTIVE_TOPK_MIN, at most POST_NMS_TOPK_TEST
+    _C.MODEL.RPN.ADAPTIVE_TOPK_TEST = ''
+    _C.MODEL.RPN.ADAPTIVE_TOPK_THRESH = 0.5
+    _C.MODEL.RPN.ADAPTIVE_TOPK_MASS = 0.9
+    _C.MODEL.RPN.ADAPTIVE_TOPK_MIN = 50
     _C.MODEL.NUM_SAMPLE_CATS = 50
 
     _C.MODEL.FPN.INNER_CHANNELS  = 32
@@ -148,6 +156,8 @@ def add_rsprompter_config(cfg):
     _C.MODEL.FPN.SELECTED_CHANNELS = list(range(8, 32, 2))
     _C.MODEL.FPN.IN_CHANNELS = [768, 768, 768]
     _C.MODEL.FPN.ADD_PE = False
+    # anchors / positional encodings kept per input geometry, 0 disables
+    _C.MODEL.GEOMETRY_CACHE_SIZE = 8
 
     _C.MODEL.ROI_BOX_HEAD.CAT_FREQ_PATH = 'datasets/metadata/lvis_v1_train_cat_info.json'
     _C.MODEL.ROI_BOX_HEAD.IGNORE_ZERO_CATS = False
@@ -156,6 +166,9 @@ def add_rsprompter_config(cfg):
     _C.MODEL.ROI_BOX_HEAD.BACKGROUND_WEIGHT = 0.2
     _C.MODEL.ROI_BOX_HEAD.ZEROSHOT_WEIGHT_PATH = 'datasets/metadata/lvis_v1_clip_a+cname.npy'
     _C.MODEL.ROI_BOX_HEAD.FED_LOSS_FREQ_WEIGHT = 0.5
+    # compute the federated sigmoid CE on the sampled classes only, False
+    # keeps the dense N x K loss (for validation)
+    _C.MODEL.ROI_BOX_HEAD.SPARSE_FED_LOSS = True
     _C.MODEL.ROI_BOX_HEAD.USE_FOCAL_CE = False
     
     _C.MODEL.ROI_MASK_HEAD.WITH_SINCOS = True
@@ -172,6 +185,8 @@ def add_rsprompter_config(cfg):
     _C.MODEL.ROI_MASK_HEAD.ROI_PROMPTER = ''
     _C.MODEL.ROI_MASK_HEAD.CONTEXT_FORMER_LAYER = 'DetrDecoderLayer'
     _C.MODEL.ROI_MASK_HEAD.ROI_PROMPTER_FUSE_TYPE = 'add'
+    # compute only the gt / predicted class channel of the mask predictor
+    _C.MODEL.ROI_MASK_HEAD.GATHERED_PREDICTOR = True
 
     _C.MODEL.SAM_ON = False
     _C.MODEL.SAM_PIXEL_MEAN = [0.,0.,0.]
@@ -194,6 +209,12 @@ def add_rsprompter_config(cfg):
     _C.FIND_UNUSED_PARAM = True
 
     _C.TEST.MASK_THR_BINARY = 0.5
+    # 'bitmask': dense bool pred_masks of the original image size, 'rle':
+    # COCO RLEs in pred_masks_rle (read by the evaluators), whose memory does
+    # not grow with the number of detections
+    _C.TEST.MASK_FORMAT = 'bitmask'
+    # masks are pasted into their boxes this many output pixels at a time
+    _C.TEST.MASK_CHUNK_PIXELS = 1 << 24
     _C.TEST.DO_POSTPROCESS = True
     _C.TEST.IMS_PER_BATCH = 2 #the batch_size of testing
     _C.TEST.SCORE_TYPE = 'cls'
@@ -202,12 +223,74 @@ def add_rsprompter_config(cfg):
     _C.TEST.FIXED_AP = False
     
     _C.MODEL.ROI_HEADS.ALLOW_LOW_QUALITY_MATCHES = True
+    # NMS of the final detections: 'hard' (batched_nms), 'soft' (Soft-NMS,
+    # exact, all classes in parallel) or 'matrix' (matrix-decay Soft-NMS, no
+    # loop). NMS_THRESH_TEST is the linear / hard threshold
+    _C.MODEL.ROI_HEADS.NMS_TYPE = 'hard'
+    _C.MODEL.ROI_HEADS.SOFT_NMS_METHOD = 'linear'  # linear, gaussian or hard
+    _C.MODEL.ROI_HEADS.SOFT_NMS_SIGMA = 0.5
+    _C.MODEL.ROI_HEADS.SOFT_NMS_PRUNE = 0.001
+    # at most this many (box, class) candidates above SCORE_THRESH_TEST go
+    # into the NMS, the top scored ones; 0 keeps all
+    _C.MODEL.ROI_HEADS.MAX_CANDIDATES_TEST = 0
+    # NMS across the classes instead of per class; with NMS_TYPE matrix it
+    # needs a positive MAX_CANDIDATES_TEST
+    _C.MODEL.ROI_HEADS.CLASS_AGNOSTIC_NMS = False
+    # only the top k classes of every box are candidates; 0 keeps all
+    _C.MODEL.ROI_HEADS.TOPK_CLASSES_PER_BOX = 0
+    # test time box / VLM / mask RoI pooling through one FusedROIPooler
+    _C.MODEL.ROI_HEADS.FUSED_POOLER = True
+    # label_and_sample_proposals on the padded batch instead of per image
+    _C.MODEL.ROI_HEADS.BATCHED_SAMPLING = True
     
+    # test time early exit from DeticCascadeROIHeads: after every stage but
+    # the last, the proposals whose highest foreground score averaged so far
+    # is below EARLY_EXIT_BG_THRESH, or at least EARLY_EXIT_FG_THRESH with a
+    # box the stage moved by less than EARLY_EXIT_BOX_IOU, skip the later
+    # stages and keep the scores averaged over the stages they ran
+    _C.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT = False
+    _C.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_BG_THRESH = 0.01
+    _C.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_FG_THRESH = 0.9
+    _C.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_BOX_IOU = 0.95
+
     _C.MODEL.CLIP_TEXT_FEATS_PATH = 'san'
 
     _C.FP16 = False
 
+    # keep the loader workers alive between iterations over the loader, and
+    # batches each worker loads in advance (tools/profile_dataloader.py)
     _C.DATALOADER.PERSISTENT_WORKERS = False
+    _C.DATALOADER.PREFETCH_FACTOR = 2
+    # Batches read ahead, pinned and copied to the device in the background
+    # by DevicePrefetcher in the train and test loops, 0 disables it. With
+    # NUM_WORKERS 0 the train batches are read in the training thread
+    _C.DATALOADER.DEVICE_PREFETCH = 2
+    # Multi-dataset dataloader
+    _C.DATALOADER.DATASET_RATIO = [1, 1] # sample ratio
+    _C.DATALOADER.USE_RFS = [False, False]
+    _C.DATALOADER.MULTI_DATASET_GROUPING = False # Always true when multi-dataset is enabled
+    _C.DATALOADER.DATASET_ANN = ['box', 'box'] # Annotation type of each dataset
+    _C.DATALOADER.USE_DIFF_BS_SIZE = False # Use different batchsize for each dataset
+    _C.DATALOADER.DATASET_BS = [8, 32] # Used when USE_DIFF_BS_SIZE is on
+    # Multi-dataset grouping by padded pixels instead of a batch size: a batch
+    # is emitted before its len * max H * max W would exceed PIXEL_BUDGET
+    # (0 disables it). Overrides USE_DIFF_BS_SIZE. The size is the one the
+    # model pads to: with a square_size in its padding_constraints (the CLIP
+    # trunk pads to 1024) the budget is a batch size of PIXEL_BUDGET / 1024^2.
+    _C.DATALOADER.PIXEL_BUDGET = 0
+    _C.DATALOADER.PIXEL_BUDGET_MAX_BATCH_SIZE = 64
+    _C.DATALOADER.PIXEL_BUDGET_SIZE_DIVISIBILITY = 32
+    # width / height boundaries of the aspect ratio buckets of PIXEL_BUDGET
+    _C.DATALOADER.ASPECT_RATIO_BOUNDARIES = [0.5, 0.75, 1.0, 1.333, 2.0]
+    # Directory of the columnar, memory-mapped annotation store shared by all
+    # workers and local ranks. '' keeps the python dicts (DatasetFromList).
+    # Point it to /dev/shm to keep the store in shared memory.
+    _C.DATALOADER.ANNOTATION_STORE = ''
+    # Shard directories of tools/pack_dataset_shards.py, one per DATASETS.TRAIN
+    # entry. When set, the train loader streams the shards sequentially
+    # (ShardedStreamDataset) instead of opening every image file.
+    _C.DATALOADER.SHARD_DIRS = []
+    _C.DATALOADER.SHUFFLE_BUFFER = 1000 # records per source
 
     _C.WANDB = False
     _C.EVAL_AR = False
@@ -0,0 +1,509 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import json
+import logging
+import os
+import pickle
+import shutil
+import numpy as np
+import torch.utils.data
+import pycocotools.mask as mask_util
+
+from detectron2.structures import BoxMode
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["AnnotationStore", "AnnotationStoreView", "get_annotation_store"]
+
+_FORMAT_VERSION = 1
+_LIST_KEYS = ("neg_category_ids", "pos_category_ids", "not_exhaustive_category_ids")
+_IMAGE_KEYS = ("file_name", "height", "width", "image_id", "dataset_source",
+    "tar_index", "annotations") + _LIST_KEYS
+_ANN_KEYS = ("bbox", "bbox_mode", "category_id", "iscrowd", "segmentation")
+_SEGM_NONE, _SEGM_POLY, _SEGM_RLE = 0, 1, 2
+
+
+class AnnotationStore(torch.utils.data.Dataset):
+    """
+    A read-only, columnar replacement of `DatasetFromList` for detection dataset
+    dicts. All records are flattened into a handful of NumPy arrays:
+
+    - image table: height, width, image_id, dataset_source, tar_index,
+      file names (byte buffer + offsets), per-image category id lists
+      (flat int32 buffer + offsets) and the annotation range of each image.
+    - annotation table: bbox, bbox_mode, category_id, iscrowd and the
+      segmentation type of each annotation.
+    - polygons: one float32 coordinate buffer with per-polygon offsets and
+      per-annotation polygon offsets.
+    - RLEs: one byte buffer of compressed counts with offsets and sizes.
+
+    Keys the table does not know about are pickled per record into a side buffer.
+    Once saved, the arrays are opened with `np.load(mmap_mode='r')`, so all
+    DataLoader workers and local ranks share the same page cache pages instead
+    of holding a private copy of millions of Python objects. `__getitem__`
+    materializes only the requested record.
+    """
+
+    def __init__(self, arrays, path=None, metadata=None):
+        self._arrays = arrays
+        self._path = path
+        self.metadata = metadata or {}
+        for k, v in arrays.items():
+            setattr(self, '_' + k, v)
+        self._num_images = len(self._height)
+
+    # ------------------------------------------------------------------ #
+    # construction / serialization
+    # ------------------------------------------------------------------ #
+    @classmethod
+    def from_dicts(cls, dataset_dicts):
+        """
+        Args:
+            dataset_dicts (list[dict]): records in detectron2 Dataset format
+        """
+        num_images = len(dataset_dicts)
+        height = np.zeros(num_images, dtype=np.int32)
+        width = np.zeros(num_images, dtype=np.int32)
+        image_id = np.full(num_images, -1, dtype=np.int64)
+        dataset_source = np.full(num_images, -1, dtype=np.int16)
+        tar_index = np.full(num_images, -1, dtype=np.int64)
+        has_annotations = np.zeros(num_images, dtype=np.bool_)
+        file_names = _BytesColumn()
+        image_extras = _BytesColumn()
+        lists = {k: _IntListColumn() for k in _LIST_KEYS}
+
+        ann_offsets = [0]
+        bbox, bbox_mode, category_id, iscrowd, segm_type = [], [], [], [], []
+        ann_polys = [0]
+        poly_offsets = [0]
+        poly_coords = []
+        num_coords = 0
+        rles = _BytesColumn()
+        rle_size = []
+        ann_extras = _BytesColumn()
+
+        for i, d in enumerate(dataset_dicts):
+            height[i] = d["height"]
+            width[i] = d["width"]
+            image_id[i] = d.get("image_id", -1)
+            dataset_source[i] = d.get("dataset_source", -1)
+            tar_index[i] = d.get("tar_index", -1)
+            file_names.append(d.get("file_name", "").encode("utf-8"))
+            for k, column in lists.items():
+                column.append(d.get(k, None))
+            extra = {k: v for k, v in d.items() if k not in _IMAGE_KEYS}
+            image_extras.append(pickle.dumps(extra) if extra else b"")
+
+            has_annotations[i] = "annotations" in d
+            for anno in d.get("annotations", []):
+                bbox.append(anno["bbox"])
+                bbox_mode.append(int(anno["bbox_mode"]))
+                category_id.append(anno["category_id"])
+                iscrowd.append(anno.get("iscrowd", -1))
+                segm = anno.get("segmentation", None)
+                if segm is None:
+                    segm_type.append(_SEGM_NONE)
+                    rles.append(b"")
+                    rle_size.append((0, 0))
+                elif isinstance(segm, dict):
+                    segm_type.append(_SEGM_RLE)
+                    if isinstance(segm["counts"], list):
+                        # uncompressed RLE, compress it once here
+                        segm = mask_util.frPyObjects(segm, *segm["size"])
+                    counts = segm["counts"]
+                    rles.append(counts.encode("ascii") if isinstance(counts, str) else counts)
+                    rle_size.append(tuple(segm["size"]))
+                else:
+                    segm_type.append(_SEGM_POLY)
+                    rles.append(b"")
+                    rle_size.append((0, 0))
+                    for poly in segm:
+                        poly_coords.append(np.asarray(poly, dtype=np.float32))
+                        num_coords += len(poly)
+                        poly_offsets.append(num_coords)
+                ann_polys.append(len(poly_offsets) - 1)
+                extra = {k: v for k, v in anno.items() if k not in _ANN_KEYS}
+                ann_extras.append(pickle.dumps(extra) if extra else b"")
+            ann_offsets.append(len(bbox))
+
+        arrays = {
+            "height": height,
+            "width": width,
+            "image_id": image_id,
+            "dataset_source": dataset_source,
+            "tar_index": tar_index,
+            "has_annotations": has_annotations,
+            "ann_offsets": np.asarray(ann_offsets, dtype=np.int64),
+            "bbox": np.asarray(bbox, dtype=np.float64).reshape(-1, 4),
+            "bbox_mode": np.asarray(bbox_mode, dtype=np.int8),
+            "category_id": np.asarray(category_id, dtype=np.int32),
+            "iscrowd": np.asarray(iscrowd, dtype=np.int8),
+            "segm_type": np.asarray(segm_type, dtype=np.int8),
+            "ann_polys": np.asarray(ann_polys, dtype=np.int64),
+            "poly_offsets": np.asarray(poly_offsets, dtype=np.int64),
+            "poly_coords": np.concatenate(poly_coords) if poly_coords \
+                else np.zeros(0, dtype=np.float32),
+            "rle_size": np.asarray(rle_size, dtype=np.int32).reshape(-1, 2),
+        }
+        arrays.update(file_names.to_arrays("file_name"))
+        arrays.update(image_extras.to_arrays("image_extra"))
+        arrays.update(rles.to_arrays("rle"))
+        arrays.update(ann_extras.to_arrays("ann_extra"))
+        for k, column in lists.items():
+            arrays.update(column.to_arrays(k))
+        return cls(arrays)
+
+    def save(self, path, sources=None):
+        """
+        Write the store as a directory of .npy files. The directory is written
+        next to `path` and renamed into place, so concurrent writers (e.g. the
+        local masters of several machines on a shared filesystem) never expose
+        a partial store. `sources` (the path, size and mtime of the annotation
+        files it was built from) is kept in meta.json to detect staleness.
+        """
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for k, v in self._arrays.items():
+            np.save(os.path.join(tmp_path, k + ".npy"), np.ascontiguousarray(v))
+        if self.metadata:
+            with open(os.path.join(tmp_path, "metadata.pkl"), "wb") as f:
+                pickle.dump(self.metadata, f)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({
+                "version": _FORMAT_VERSION,
+                "num_images": len(self),
+                "num_annotations": len(self._category_id),
+                "arrays": sorted(self._arrays.keys()),
+                "sources": sources or [],
+            }, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._path = path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta["version"] == _FORMAT_VERSION, \
+            "Annotation store {} has version {}, expected {}".format(
+                path, meta["version"], _FORMAT_VERSION)
+        arrays = {
+            k: np.load(os.path.join(path, k + ".npy"), mmap_mode="r" if mmap else None)
+            for k in meta["arrays"]}
+        metadata = None
+        if os.path.isfile(os.path.join(path, "metadata.pkl")):
+            with open(os.path.join(path, "metadata.pkl"), "rb") as f:
+                metadata = pickle.load(f)
+        return cls(arrays, path=path, metadata=metadata)
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, "meta.json"))
+
+    def __reduce__(self):
+        # Workers started with "spawn" re-open the memory-mapped files
+        # instead of receiving a pickled copy of every array.
+        if self._path is not None:
+            return (AnnotationStore.load, (self._path,))
+        return (AnnotationStore, (self._arrays, None, self.metadata))
+
+    # ------------------------------------------------------------------ #
+    # record access
+    # ------------------------------------------------------------------ #
+    def __len__(self):
+        return self._num_images
+
+    def to_dicts(self):
+        return [self[i] for i in range(len(self))]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        record = {}
+        file_name = _get_bytes(self._file_name, self._file_name_offsets, idx)
+        if len(file_name):
+            record["file_name"] = file_name.decode("utf-8")
+        record["height"] = int(self._height[idx])
+        record["width"] = int(self._width[idx])
+        if self._image_id[idx] >= 0:
+            record["image_id"] = int(self._image_id[idx])
+        if self._dataset_source[idx] >= 0:
+            record["dataset_source"] = int(self._dataset_source[idx])
+        if self._tar_index[idx] >= 0:
+            record["tar_index"] = int(self._tar_index[idx])
+        for k in _LIST_KEYS:
+            if getattr(self, "_{}_present".format(k))[idx]:
+                offsets = getattr(self, "_{}_offsets".format(k))
+                record[k] = getattr(self, "_" + k)[offsets[idx]: offsets[idx + 1]].tolist()
+        extra = _get_bytes(self._image_extra, self._image_extra_offsets, idx)
+        if len(extra):
+            record.update(pickle.loads(extra))
+        if self._has_annotations[idx]:
+            record["annotations"] = [
+                self._get_annotation(j) for j in range(
+                    self._ann_offsets[idx], self._ann_offsets[idx + 1])]
+        return record
+
+    def _get_annotation(self, j):
+        obj = {
+            "bbox": self._bbox[j].tolist(),
+            "bbox_mode": BoxMode(int(self._bbox_mode[j])),
+            "category_id": int(self._category_id[j]),
+        }
+        if self._iscrowd[j] >= 0:
+            obj["iscrowd"] = int(self._iscrowd[j])
+        segm_type = self._segm_type[j]
+        if segm_type == _SEGM_POLY:
+            obj["segmentation"] = [
+                self._poly_coords[self._poly_offsets[p]: self._poly_offsets[p + 1]].tolist()
+                for p in range(self._ann_polys[j], self._ann_polys[j + 1])]
+        elif segm_type == _SEGM_RLE:
+            obj["segmentation"] = {
+                "size": self._rle_size[j].tolist(),
+                "counts": _get_bytes(self._rle, self._rle_offsets, j).decode("ascii"),
+            }
+        extra = _get_bytes(self._ann_extra, self._ann_extra_offsets, j)
+        if len(extra):
+            obj.update(pickle.loads(extra))
+        return obj
+
+    # ------------------------------------------------------------------ #
+    # columnar accessors, used for dataset statistics without
+    # materializing the records
+    # ------------------------------------------------------------------ #
+    @property
+    def dataset_sources(self):
+        return self._dataset_source
+
+    @property
+    def ann_offsets(self):
+        return self._ann_offsets
+
+    @property
+    def category_ids(self):
+        return self._category_id
+
+    @property
+    def iscrowd(self):
+        return self._iscrowd
+
+    @property
+    def has_annotations(self):
+        return self._has_annotations
+
+    def get_list_column(self, key):
+        """
+        Returns (values, offsets, present) of a per-image id list such as
+        `pos_category_ids`.
+        """
+        assert key in _LIST_KEYS, key
+        return (getattr(self, "_" + key), getattr(self, "_{}_offsets".format(key)),
+            getattr(self, "_{}_present".format(key)))
+
+    def __repr__(self):
+        return "AnnotationStore(images={}, annotations={}, path={})".format(
+            len(self), len(self._category_id), self._path)
+
+
+class AnnotationStoreView(torch.utils.data.Dataset):
+    """
+    The records `indices` (all by default) of several AnnotationStores,
+    concatenated, materialized one at a time like the stores themselves.
+    The records of `stores[i]` get `dataset_sources[i]` as dataset_source
+    when given. The columnar accessors of AnnotationStore return the values
+    of the selected records, in order.
+    """
+    def __init__(self, stores, dataset_sources=None, indices=None):
+        self.stores = list(stores)
+        self.store_dataset_sources = dataset_sources
+        self._starts = np.cumsum([0] + [len(x) for x in self.stores])
+        if indices is None:
+            indices = np.arange(self._starts[-1])
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.subset(idx)
+        j = int(self.indices[idx])
+        k = int(np.searchsorted(self._starts, j, side="right")) - 1
+        record = self.stores[k][j - int(self._starts[k])]
+        if self.store_dataset_sources is not None:
+            record["dataset_source"] = self.store_dataset_sources[k]
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, selection):
+        """
+        The view of the records `self.indices[selection]` (a slice, mask or
+        index array).
+        """
+        return AnnotationStoreView(
+            self.stores, self.store_dataset_sources, self.indices[selection])
+
+    @property
+    def dataset_sources(self):
+        if self.store_dataset_sources is not None:
+            return np.repeat(np.asarray(self.store_dataset_sources, dtype=np.int16),
+                np.diff(self._starts))[self.indices]
+        return np.concatenate([x.dataset_sources for x in self.stores])[self.indices]
+
+    @property
+    def has_annotations(self):
+        return np.concatenate([x.has_annotations for x in self.stores])[self.indices]
+
+    @property
+    def ann_offsets(self):
+        return self._annotation_positions()[1]
+
+    @property
+    def category_ids(self):
+        return np.concatenate([x.category_ids for x in self.stores])[
+            self._annotation_positions()[0]]
+
+    @property
+    def iscrowd(self):
+        return np.concatenate([x.iscrowd for x in self.stores])[
+            self._annotation_positions()[0]]
+
+    def get_list_column(self, key):
+        values, offsets = _concat_ragged(
+            [x.get_list_column(key)[:2] for x in self.stores])
+        positions, offsets = _gather_ragged(offsets, self.indices)
+        present = np.concatenate([x.get_list_column(key)[2] for x in self.stores])
+        return values[positions], offsets, present[self.indices]
+
+    def _annotation_positions(self):
+        _, offsets = _concat_ragged(
+            [(x.category_ids, x.ann_offsets) for x in self.stores])
+        return _gather_ragged(offsets, self.indices)
+
+    def __repr__(self):
+        return "AnnotationStoreView(images={}, stores={})".format(
+            len(self), self.stores)
+
+
+def get_annotation_store(dataset_dicts, path, source_files=()):
+    """
+    Build (on the local master) or open the annotation store at `path` for
+    `dataset_dicts`, loaded from the annotation files `source_files`. Every
+    local rank and DataLoader worker then maps the same files. The store is
+    rebuilt when the number of images / annotations or the size or mtime of
+    any of `source_files` changed.
+    """
+    fingerprint = (len(dataset_dicts),
+        sum(len(d.get("annotations", [])) for d in dataset_dicts),
+        _source_stats(source_files))
+    if comm.get_local_rank() == 0:
+        if AnnotationStore.exists(path) and \
+            _store_fingerprint(path) != fingerprint:
+            logger.info("Annotation store {} is stale, rebuilding".format(path))
+            shutil.rmtree(path)
+        if not AnnotationStore.exists(path):
+            logger.info("Building annotation store of {} images at {}".format(
+                fingerprint[0], path))
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            AnnotationStore.from_dicts(dataset_dicts).save(
+                path, sources=fingerprint[2])
+    comm.synchronize()
+    store = AnnotationStore.load(path)
+    assert _store_fingerprint(path) == fingerprint, \
+        "Annotation store {} does not match the dataset".format(path)
+    logger.info("Using {}".format(store))
+    return store
+
+
+def _store_fingerprint(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return (meta["num_images"], meta["num_annotations"], meta.get("sources", []))
+
+
+def _source_stats(source_files):
+    stats = []
+    for f in source_files:
+        stat = os.stat(f)
+        stats.append([os.path.abspath(f), stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+def _concat_ragged(columns):
+    """
+    (values, offsets) of the concatenation of ragged (values, offsets) columns.
+    """
+    values = np.concatenate([np.asarray(v) for v, _ in columns])
+    offsets, base = [np.zeros(1, dtype=np.int64)], 0
+    for v, o in columns:
+        offsets.append(np.asarray(o[1:], dtype=np.int64) + base)
+        base += len(v)
+    return values, np.concatenate(offsets)
+
+
+def _gather_ragged(offsets, idx):
+    """
+    The positions of the values of the rows `idx` of a ragged column with
+    `offsets`, and the offsets of these rows.
+    """
+    starts = offsets[idx]
+    counts = offsets[idx + 1] - starts
+    new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], counts) + \
+        np.arange(new_offsets[-1], dtype=np.int64)
+    return positions, new_offsets
+
+
+def _get_bytes(buffer, offsets, idx):
+    return buffer[offsets[idx]: offsets[idx + 1]].tobytes()
+
+
+class _BytesColumn(object):
+    """
+    Variable length byte strings, stored as one buffer + offsets.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offsets = [0]
+
+    def append(self, b):
+        self.chunks.append(b)
+        self.offsets.append(self.offsets[-1] + len(b))
+
+    def to_arrays(self, name):
+        return {
+            name: np.frombuffer(b"".join(self.chunks), dtype=np.uint8).copy(),
+            name + "_offsets": np.asarray(self.offsets, dtype=np.int64),
+        }
+
+
+class _IntListColumn(object):
+    """
+    Optional per-image integer lists, stored as one buffer + offsets + presence.
+    """
+    def __init__(self):
+        self.values = []
+        self.offsets = [0]
+        self.present = []
+
+    def append(self, values):
+        self.present.append(values is not None)
+        if values is not None:
+            self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    def to_arrays(self, name):
+        return {
+            name: np.asarray(self.values, dtype=np.int32),
+            name + "_offsets": np.asarray(self.offsets, dtype=np.int64),
+            name + "_present": np.asarray(self.present, dtype=np.bool_),
+        }
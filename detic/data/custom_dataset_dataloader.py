@@ -1,7 +1,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Part of the code is from https://github.com/xingyizhou/UniDet/blob/master/projects/UniDet/unidet/data/multi_dataset_dataloader.py (Apache-2.0 License)
+import bisect
 import copy
 import logging
+import os
+import random
 import numpy as np
 import operator
 import torch
@@ -17,21 +20,43 @@ from detectron2.data.common import DatasetFromList, MapDataset
 from detectron2.data.dataset_mapper import DatasetMapper
 from detectron2.data.build import get_detection_dataset_dicts, build_batch_data_loader
 from detectron2.data.samplers import TrainingSampler, RepeatFactorTrainingSampler
-from detectron2.data.build import worker_init_reset_seed, print_instances_class_histogram
+from detectron2.data.build import worker_init_reset_seed
 from detectron2.data.build import filter_images_with_only_crowd_annotations
 from detectron2.data.build import filter_images_with_few_keypoints
 from detectron2.data.build import check_metadata_consistency
 from detectron2.data.catalog import MetadataCatalog, DatasetCatalog
 from detectron2.utils import comm
+from detectron2.utils.file_io import PathManager
+from .annotation_store import AnnotationStore, AnnotationStoreView, get_annotation_store
+from .sharded_dataset import ShardedStreamDataset
+from .custom_dataset_mapper import CustomDatasetMapper, SamDatasetMapper
+from .dataset_stats import category_columns, repeat_factors_from_columns
+from .dataset_stats import get_repeat_factors, print_class_histogram
+from .datasets.snapshot import get_dataset_store, get_stats_cache_path
 import itertools
-import math
-from collections import defaultdict
 from typing import Optional
 
 
-def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=None):
+def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=None,
+        padding_constraints=None):
+    # PIXEL_BUDGET counts the pixels the model pads the batch to
+    assert cfg.DATALOADER.PIXEL_BUDGET <= 0 or padding_constraints is not None, \
+        "DATALOADER.PIXEL_BUDGET needs the padding_constraints of the model"
     sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
-    if 'MultiDataset' in sampler_name:
+    if cfg.DATALOADER.SHARD_DIRS:
+        assert len(cfg.DATALOADER.SHARD_DIRS) == len(cfg.DATASETS.TRAIN)
+        # sources are mixed by the stream, which replaces the sampler
+        multi_dataset = 'MultiDataset' in sampler_name
+        dataset_dicts = ShardedStreamDataset(
+            cfg.DATALOADER.SHARD_DIRS,
+            dataset_ratio=cfg.DATALOADER.DATASET_RATIO if multi_dataset else None,
+            use_rfs=cfg.DATALOADER.USE_RFS if multi_dataset else None,
+            dataset_ann=cfg.DATALOADER.DATASET_ANN if multi_dataset else None,
+            repeat_threshold=cfg.DATALOADER.REPEAT_THRESHOLD,
+            shuffle_buffer=cfg.DATALOADER.SHUFFLE_BUFFER,
+        )
+        sampler = None
+    elif 'MultiDataset' in sampler_name:
         dataset_dicts = get_detection_dataset_dicts_with_source(
             cfg.DATASETS.TRAIN,
             filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
@@ -39,6 +64,14 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
             if cfg.MODEL.KEYPOINT_ON else 0,
             proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
         )
+    elif not cfg.MODEL.LOAD_PROPOSALS:
+        dataset_dicts = get_detection_dataset_dicts_with_source(
+            cfg.DATASETS.TRAIN,
+            filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+            min_keypoints=cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE
+            if cfg.MODEL.KEYPOINT_ON else 0,
+            with_source=False,
+        )
     else:
         dataset_dicts = get_detection_dataset_dicts(
             cfg.DATASETS.TRAIN,
@@ -48,13 +81,20 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
             proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
         )
     if mapper is None:
-        mapper = DatasetMapper(cfg, True)
-
-    if sampler is not None:
+        # the shard records carry the image content, see read_record_image
+        mapper = SamDatasetMapper(cfg, True) if cfg.DATALOADER.SHARD_DIRS \
+            else DatasetMapper(cfg, True)
+    assert not cfg.DATALOADER.SHARD_DIRS or \
+        isinstance(mapper, (CustomDatasetMapper, SamDatasetMapper)), \
+        "DATALOADER.SHARD_DIRS needs a mapper reading the image_bytes of the " \
+        "records (CustomDatasetMapper or SamDatasetMapper), not {}".format(
+            type(mapper).__name__)
+
+    if sampler is not None or cfg.DATALOADER.SHARD_DIRS:
         pass
     
     elif sampler_name == "TrainingSampler":
-        sampler = TrainingSampler(len(dataset))
+        sampler = TrainingSampler(len(dataset_dicts))
     
     elif sampler_name == "MultiDatasetSampler":
         sampler = MultiDatasetSampler(
@@ -63,15 +103,38 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
             use_rfs = cfg.DATALOADER.USE_RFS,
             dataset_ann = cfg.DATALOADER.DATASET_ANN,
             repeat_threshold = cfg.DATALOADER.REPEAT_THRESHOLD,
+            cache_path = get_stats_cache_path(
+                'repeat_factors', cfg.DATASETS.TRAIN,
+                filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+                use_rfs=cfg.DATALOADER.USE_RFS,
+                dataset_ann=cfg.DATALOADER.DATASET_ANN,
+                repeat_threshold=cfg.DATALOADER.REPEAT_THRESHOLD,
+            ),
         )
     elif sampler_name == "RepeatFactorTrainingSampler":
-        repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(
-            dataset_dicts, cfg.DATALOADER.REPEAT_THRESHOLD
-        )
+        repeat_factors = repeat_factors_from_columns(
+            *category_columns(dataset_dicts), cfg.DATALOADER.REPEAT_THRESHOLD)
         sampler = RepeatFactorTrainingSampler(repeat_factors)
     else:
         raise ValueError("Unknown training sampler: {}".format(sampler_name))
 
+    if cfg.DATALOADER.ANNOTATION_STORE and not cfg.DATALOADER.SHARD_DIRS and \
+        not isinstance(dataset_dicts, AnnotationStoreView):
+        # the sampler statistics above are the last users of the python dicts
+        source_files = []
+        for name in cfg.DATASETS.TRAIN:
+            json_file = MetadataCatalog.get(name).get('json_file', None)
+            if json_file is None:
+                logging.getLogger(__name__).warning(
+                    "Dataset {} has no json_file, the annotation store only "
+                    "checks its sizes for staleness".format(name))
+            else:
+                source_files.append(PathManager.get_local_path(json_file))
+        dataset_dicts = get_annotation_store(
+            dataset_dicts, os.path.join(
+                cfg.DATALOADER.ANNOTATION_STORE, '+'.join(cfg.DATASETS.TRAIN)),
+            source_files=source_files)
+
     return {
         "dataset": dataset_dicts,
         "sampler": sampler,
@@ -79,10 +142,19 @@ def _custom_train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=
         "total_batch_size": cfg.SOLVER.IMS_PER_BATCH,
         "aspect_ratio_grouping": cfg.DATALOADER.ASPECT_RATIO_GROUPING,
         "num_workers": cfg.DATALOADER.NUM_WORKERS,
+        "persistent_workers": cfg.DATALOADER.PERSISTENT_WORKERS,
+        "prefetch_factor": cfg.DATALOADER.PREFETCH_FACTOR,
         'multi_dataset_grouping': cfg.DATALOADER.MULTI_DATASET_GROUPING,
         'use_diff_bs_size': cfg.DATALOADER.USE_DIFF_BS_SIZE,
         'dataset_bs': cfg.DATALOADER.DATASET_BS,
-        'num_datasets': len(cfg.DATASETS.TRAIN)
+        'num_datasets': len(cfg.DATASETS.TRAIN),
+        'pixel_budget': cfg.DATALOADER.PIXEL_BUDGET,
+        'pixel_budget_cfg': {
+            'aspect_ratio_boundaries': cfg.DATALOADER.ASPECT_RATIO_BOUNDARIES,
+            'max_batch_size': cfg.DATALOADER.PIXEL_BUDGET_MAX_BATCH_SIZE,
+            'size_divisibility': cfg.DATALOADER.PIXEL_BUDGET_SIZE_DIVISIBILITY,
+            'square_size': (padding_constraints or {}).get('square_size', 0),
+        },
     }
 
 
@@ -92,10 +164,14 @@ def build_custom_train_loader(
         total_batch_size=16,
         aspect_ratio_grouping=True, 
         num_workers=0,
+        persistent_workers=False,
+        prefetch_factor=2,
         num_datasets=1,
         multi_dataset_grouping=False,
         use_diff_bs_size=False,
-        dataset_bs=[]
+        dataset_bs=[],
+        pixel_budget=0,
+        pixel_budget_cfg=None,
     ):
     """
     Modified from detectron2.data.build.build_custom_train_loader, but supports
@@ -105,9 +181,13 @@ def build_custom_train_loader(
         dataset = DatasetFromList(dataset, copy=False)
     if mapper is not None:
         dataset = MapDataset(dataset, mapper)
-    if sampler is None:
-        sampler = TrainingSampler(len(dataset))
-    assert isinstance(sampler, torch.utils.data.sampler.Sampler)
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        assert sampler is None, "sampler must be None for an IterableDataset"
+    else:
+        if sampler is None:
+            sampler = TrainingSampler(len(dataset))
+        assert isinstance(sampler, torch.utils.data.sampler.Sampler)
+    worker_kwargs = _worker_kwargs(num_workers, persistent_workers, prefetch_factor)
     if multi_dataset_grouping:
         return build_multi_dataset_batch_data_loader(
             use_diff_bs_size,
@@ -117,6 +197,9 @@ def build_custom_train_loader(
             total_batch_size,
             num_datasets=num_datasets,
             num_workers=num_workers,
+            pixel_budget=pixel_budget,
+            pixel_budget_cfg=pixel_budget_cfg,
+            **worker_kwargs,
         )
     else:
         return build_batch_data_loader(
@@ -125,14 +208,29 @@ def build_custom_train_loader(
             total_batch_size,
             aspect_ratio_grouping=aspect_ratio_grouping,
             num_workers=num_workers,
+            **worker_kwargs,
         )
 
 
+def _worker_kwargs(num_workers, persistent_workers, prefetch_factor):
+    # DataLoader rejects these without worker processes
+    if num_workers == 0:
+        return {}
+    return {
+        'persistent_workers': persistent_workers,
+        'prefetch_factor': prefetch_factor,
+    }
+
+
 def build_multi_dataset_batch_data_loader(
     use_diff_bs_size, dataset_bs,
-    dataset, sampler, total_batch_size, num_datasets, num_workers=0
+    dataset, sampler, total_batch_size, num_datasets, num_workers=0,
+    pixel_budget=0, pixel_budget_cfg=None, **kwargs
 ):
     """
+    With `pixel_budget` > 0 batches are grouped by padded pixels
+    (PixelBudgetGroupedDataset, options in `pixel_budget_cfg`) instead of
+    `total_batch_size` / `dataset_bs`. `kwargs` go to the DataLoader.
     """
     world_size = get_world_size()
     assert (
@@ -142,6 +240,11 @@ def build_multi_dataset_batch_data_loader(
     )
 
     batch_size = total_batch_size // world_size
+    if isinstance(sampler, MultiDatasetSampler):
+        # seed the augmentations of every sample by its position in the
+        # sampler stream, so that the loader state can be checkpointed
+        sampler = _PositionedSampler(sampler)
+        dataset = _PositionSeededDataset(dataset)
     data_loader = torch.utils.data.DataLoader(
         dataset,
         sampler=sampler,
@@ -149,8 +252,12 @@ def build_multi_dataset_batch_data_loader(
         batch_sampler=None,
         collate_fn=operator.itemgetter(0),  # don't batch, but yield individual elements
         worker_init_fn=worker_init_reset_seed,
+        **kwargs,
     )  # yield individual mapped dict
-    if use_diff_bs_size:
+    if pixel_budget > 0:
+        return PixelBudgetGroupedDataset(
+            data_loader, pixel_budget, num_datasets, **(pixel_budget_cfg or {}))
+    elif use_diff_bs_size:
         return DIFFMDAspectRatioGroupedDataset(
             data_loader, dataset_bs, num_datasets)
     else:
@@ -159,29 +266,48 @@ def build_multi_dataset_batch_data_loader(
 
 
 def get_detection_dataset_dicts_with_source(
-    dataset_names, filter_empty=True, min_keypoints=0, proposal_files=None
+    dataset_names, filter_empty=True, min_keypoints=0, proposal_files=None,
+    with_source=True,
 ):
+    """
+    `with_source`: set the `dataset_source` of the records. When all datasets
+    are snapshots (AnnotationStore, see datasets/snapshot.py), returns an
+    AnnotationStoreView of them instead of building every record.
+    """
     assert len(dataset_names)
-    dataset_dicts = [DatasetCatalog.get(dataset_name) for dataset_name in dataset_names]
+    dataset_dicts = [get_dataset_store(dataset_name) for dataset_name in dataset_names]
     for dataset_name, dicts in zip(dataset_names, dataset_dicts):
         assert len(dicts), "Dataset '{}' is empty!".format(dataset_name)
+    from_stores = min_keypoints == 0 and \
+        all(isinstance(dicts, AnnotationStore) for dicts in dataset_dicts)
+    if not from_stores:
+        dataset_dicts = [list(dicts) if isinstance(dicts, AnnotationStore) else dicts
+            for dicts in dataset_dicts]
     
     for source_id, (dataset_name, dicts) in \
         enumerate(zip(dataset_names, dataset_dicts)):
         assert len(dicts), "Dataset '{}' is empty!".format(dataset_name)
-        for d in dicts:
-            d['dataset_source'] = source_id
+        if with_source and not from_stores:
+            for d in dicts:
+                d['dataset_source'] = source_id
 
-        if "annotations" in dicts[0]:
+        if "annotations" in dicts[0] and comm.is_main_process():
             try:
                 class_names = MetadataCatalog.get(dataset_name).thing_classes
                 check_metadata_consistency("thing_classes", dataset_name)
-                print_instances_class_histogram(dicts, class_names)
+                print_class_histogram(dicts, class_names)
             except AttributeError:  # class names are not available for this dataset
                 pass
 
     assert proposal_files is None
 
+    if from_stores:
+        view = AnnotationStoreView(dataset_dicts, dataset_sources=list(
+            range(len(dataset_dicts))) if with_source else None)
+        if filter_empty and view.has_annotations[0]:
+            view = filter_store_images_with_only_crowd_annotations(view)
+        return view
+
     dataset_dicts = list(itertools.chain.from_iterable(dataset_dicts))
 
     has_instances = "annotations" in dataset_dicts[0]
@@ -193,7 +319,25 @@ def get_detection_dataset_dicts_with_source(
     return dataset_dicts
 
 
+def filter_store_images_with_only_crowd_annotations(view):
+    """
+    detectron2's filter_images_with_only_crowd_annotations on the columns of
+    an AnnotationStoreView.
+    """
+    offsets = np.asarray(view.ann_offsets)
+    image = np.repeat(np.arange(len(view)), np.diff(offsets))
+    valid = np.bincount(image[np.asarray(view.iscrowd) <= 0], minlength=len(view)) > 0
+    logger = logging.getLogger(__name__)
+    logger.info(
+        "Removed {} images with no usable annotations. {} images left.".format(
+            len(view) - int(valid.sum()), int(valid.sum())))
+    return view.subset(valid)
+
+
 class MultiDatasetSampler(Sampler):
+    # indices are drawn in chunks of this size, see __iter__
+    _CHUNK_SIZE = 4096
+
     def __init__(
         self, 
         dataset_dicts, 
@@ -202,12 +346,17 @@ class MultiDatasetSampler(Sampler):
         dataset_ann,
         repeat_threshold=0.001,
         seed: Optional[int] = None,
+        cache_path=None,
         ):
         """
+        `cache_path`: file caching the repeat factors, see get_repeat_factors.
         """
-        sizes = [0 for _ in range(len(dataset_ratio))]
-        for d in dataset_dicts:
-            sizes[d['dataset_source']] += 1
+        if isinstance(dataset_dicts, AnnotationStoreView):
+            sources = np.asarray(dataset_dicts.dataset_sources, dtype=np.int64)
+        else:
+            sources = np.fromiter((d['dataset_source'] for d in dataset_dicts),
+                dtype=np.int64, count=len(dataset_dicts))
+        sizes = np.bincount(sources, minlength=len(dataset_ratio)).tolist()
         print('dataset sizes', sizes)
         self.sizes = sizes
         assert len(dataset_ratio) == len(sizes), \
@@ -219,114 +368,364 @@ class MultiDatasetSampler(Sampler):
         self._seed = int(seed)
         self._rank = comm.get_rank()
         self._world_size = comm.get_world_size()
-        
-        self.dataset_ids =  torch.tensor(
-            [d['dataset_source'] for d in dataset_dicts], dtype=torch.long)
 
         dataset_weight = [torch.ones(s) * max(sizes) / s * r / sum(dataset_ratio) \
             for i, (r, s) in enumerate(zip(dataset_ratio, sizes))]
         dataset_weight = torch.cat(dataset_weight)
         
-        rfs_factors = []
-        st = 0
-        for i, s in enumerate(sizes):
-            if use_rfs[i]:
-                if dataset_ann[i] == 'box':
-                    rfs_func = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency
-                else:
-                    rfs_func = repeat_factors_from_tag_frequency
-                rfs_factor = rfs_func(
-                    dataset_dicts[st: st + s],
-                    repeat_thresh=repeat_threshold)
-                rfs_factor = rfs_factor * (s / rfs_factor.sum())
-            else:
-                rfs_factor = torch.ones(s)
-            rfs_factors.append(rfs_factor)
-            st = st + s
-        rfs_factors = torch.cat(rfs_factors)
+        rfs_factors = get_repeat_factors(
+            dataset_dicts, sizes, use_rfs, dataset_ann, repeat_threshold,
+            cache_path=cache_path)
 
         self.weights = dataset_weight * rfs_factors
         self.sample_epoch_size = len(self.weights)
+        self._prob, self._alias = build_alias_table(self.weights.numpy())
+        # position in this rank's index stream, see state_dict()
+        self._position = 0
 
     def __iter__(self):
-        start = self._rank
-        yield from itertools.islice(
-            self._infinite_indices(), start, None, self._world_size)
+        # every rank draws its own stream, in chunks that only depend on
+        # (seed, rank, chunk id), so that any position can be resumed directly
+        chunk_id, offset = divmod(self._position, self._CHUNK_SIZE)
+        while True:
+            ids = self._chunk_indices(chunk_id)
+            for i in ids[offset:].tolist():
+                self._position += 1
+                yield i
+            offset = 0
+            chunk_id += 1
+
+    def _chunk_indices(self, chunk_id):
+        rng = np.random.default_rng([self._seed, self._rank, chunk_id])
+        return sample_alias_table(self._prob, self._alias, self._CHUNK_SIZE, rng)
+
+    def index_at(self, position):
+        chunk_id, offset = divmod(position, self._CHUNK_SIZE)
+        return int(self._chunk_indices(chunk_id)[offset])
+
+    def state_dict(self):
+        """
+        Seed and number of indices this rank's stream has yielded.
+        """
+        return {'seed': self._seed, 'position': self._position}
 
+    def load_state_dict(self, state):
+        """
+        Continue the stream at `state['position']` in the next `__iter__`.
+        """
+        self._seed = int(state['seed'])
+        self._position = int(state['position'])
 
-    def _infinite_indices(self):
-        g = torch.Generator()
-        g.manual_seed(self._seed)
-        while True:
-            ids = torch.multinomial(
-                self.weights, self.sample_epoch_size, generator=g, 
-                replacement=True)
-            nums = [(self.dataset_ids[ids] == i).sum().int().item() \
-                for i in range(len(self.sizes))]
-            yield from ids
+
+def build_alias_table(weights):
+    """
+    Walker's alias table (Vose's construction, vectorized) of the
+    distribution proportional to `weights`, to draw samples in O(1).
+    Returns (prob, alias): pick i uniformly, keep it with probability
+    prob[i], otherwise take alias[i].
+    """
+    n = len(weights)
+    q = np.asarray(weights, dtype=np.float64) * (n / np.sum(weights, dtype=np.float64))
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+    # smalls are consumed in order, larges that drop below 1 are appended
+    small = np.empty(n, dtype=np.int64)
+    num_small = np.count_nonzero(q < 1.)
+    small[:num_small] = np.flatnonzero(q < 1.)
+    head = 0
+    large = np.flatnonzero(q >= 1.)
+    while head < num_small and len(large):
+        k = min(num_small - head, len(large))
+        s, l = small[head:head + k], large[:k]
+        head += k
+        prob[s] = q[s]
+        alias[s] = l
+        q[l] -= 1. - q[s]
+        now_small = q[l] < 1.
+        new_small = l[now_small]
+        small[num_small:num_small + len(new_small)] = new_small
+        num_small += len(new_small)
+        large = np.concatenate([l[~now_small], large[k:]])
+    # whatever is left has probability 1 up to rounding
+    return prob, alias
+
+
+def sample_alias_table(prob, alias, num_samples, rng):
+    i = rng.integers(0, len(prob), size=num_samples)
+    return np.where(rng.random(num_samples) < prob[i], i, alias[i])
+
+
+class _PositionedSampler(Sampler):
+    """
+    Yields the (seed, rank, position, index) keys of a MultiDatasetSampler
+    for _PositionSeededDataset.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def __iter__(self):
+        for index in self.sampler:
+            yield self.key_at(self.sampler._position - 1, index)
+
+    def key_at(self, position, index=None):
+        if index is None:
+            index = self.sampler.index_at(position)
+        return (self.sampler._seed, self.sampler._rank, position, index)
+
+
+class _PositionSeededDataset(torch.utils.data.Dataset):
+    """
+    dataset[(seed, rank, position, index)] is dataset[index] mapped with the
+    python/numpy/torch RNGs seeded by (seed, rank, position): the random
+    augmentations of a sample do not depend on the worker that maps it, and
+    are the same when the sample is mapped again after a resume.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        seed, rank, position, index = key
+        # don't disturb the training RNGs when mapping in the main process
+        in_main_process = torch.utils.data.get_worker_info() is None
+        if in_main_process:
+            rng_state = get_rng_state()
+        sample_seed = int(np.random.SeedSequence([seed, rank, position]).generate_state(1)[0])
+        random.seed(sample_seed)
+        np.random.seed(sample_seed)
+        torch.random.default_generator.manual_seed(sample_seed)
+        try:
+            return self.dataset[index]
+        finally:
+            if in_main_process:
+                set_rng_state(rng_state)
+
+
+def get_rng_state(cuda=False):
+    """
+    Python, numpy, torch (and the current cuda device) RNG states, as plain
+    lists and tensors that can be stored in a checkpoint.
+    """
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state(),
+    }
+    if cuda and torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state(
+        (np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
 
 
 class MDAspectRatioGroupedDataset(torch.utils.data.IterableDataset):
-    def __init__(self, dataset, batch_size, num_datasets):
+    def __init__(self, dataset, batch_size, num_datasets, num_aspect_buckets=2):
         """
+        `dataset` is the DataLoader of build_multi_dataset_batch_data_loader.
+        With a MultiDatasetSampler the grouping can be checkpointed: the state
+        is the sampler position of the next dict and the positions of the
+        dicts waiting in the buckets, which are mapped again on resume.
         """
         self.dataset = dataset
         self.batch_size = batch_size
-        self._buckets = [[] for _ in range(2 * num_datasets)]
+        self.num_aspect_buckets = num_aspect_buckets
+        num_buckets = num_aspect_buckets * num_datasets
+        self._buckets = [[] for _ in range(num_buckets)]
+        # sampler positions of the dicts in self._buckets
+        self._bucket_positions = [[] for _ in range(num_buckets)]
+        self._position = None
+        self._resume_positions = None
 
-    def __iter__(self):
-        for d in self.dataset:
-            w, h = d["width"], d["height"]
-            aspect_ratio_bucket_id = 0 if w > h else 1
-            bucket_id = d['dataset_source'] * 2 + aspect_ratio_bucket_id
-            bucket = self._buckets[bucket_id]
-            bucket.append(d)
-            if len(bucket) == self.batch_size:
-                yield bucket[:]
-                del bucket[:]
+    def _get_batch_size(self, d):
+        return self.batch_size
 
+    def _aspect_ratio_bucket_id(self, d):
+        return 0 if d["width"] > d["height"] else 1
 
-class DIFFMDAspectRatioGroupedDataset(torch.utils.data.IterableDataset):
-    def __init__(self, dataset, batch_sizes, num_datasets):
+    def _bucket_id(self, d):
+        return d['dataset_source'] * self.num_aspect_buckets + \
+            self._aspect_ratio_bucket_id(d)
+
+    def _flush_before(self, bucket, d):
         """
+        Whether `bucket` is emitted before `d` is added to it.
         """
-        self.dataset = dataset
-        self.batch_sizes = batch_sizes
-        self._buckets = [[] for _ in range(2 * num_datasets)]
+        return False
+
+    def _flush_after(self, bucket, d):
+        """
+        Whether `bucket` is emitted once `d` has been added to it.
+        """
+        return len(bucket) == self._get_batch_size(d)
+
+    def _pop_bucket(self, bucket_id):
+        batch = self._buckets[bucket_id][:]
+        del self._buckets[bucket_id][:]
+        del self._bucket_positions[bucket_id][:]
+        return batch
+
+    def _positioned_sampler(self):
+        sampler = getattr(self.dataset, 'sampler', None)
+        return sampler if isinstance(sampler, _PositionedSampler) else None
 
     def __iter__(self):
+        sampler = self._positioned_sampler()
+        if sampler is not None:
+            # the DataLoader prefetches ahead of the sampler position,
+            # count the dicts that are actually consumed
+            self._position = sampler.sampler.state_dict()['position']
+            if self._resume_positions is not None:
+                for bucket, positions, saved in zip(
+                        self._buckets, self._bucket_positions, self._resume_positions):
+                    for position in saved:
+                        bucket.append(self.dataset.dataset[sampler.key_at(position)])
+                        positions.append(position)
+                self._resume_positions = None
         for d in self.dataset:
-            w, h = d["width"], d["height"]
-            aspect_ratio_bucket_id = 0 if w > h else 1
-            bucket_id = d['dataset_source'] * 2 + aspect_ratio_bucket_id
+            bucket_id = self._bucket_id(d)
             bucket = self._buckets[bucket_id]
+            if bucket and self._flush_before(bucket, d):
+                yield self._pop_bucket(bucket_id)
             bucket.append(d)
-            if len(bucket) == self.batch_sizes[d['dataset_source']]:
-                yield bucket[:]
-                del bucket[:]
+            if sampler is not None:
+                self._bucket_positions[bucket_id].append(self._position)
+                self._position += 1
+            if self._flush_after(bucket, d):
+                yield self._pop_bucket(bucket_id)
+
+    def state_dict(self):
+        sampler = self._positioned_sampler()
+        if sampler is None:
+            return {}
+        state = sampler.sampler.state_dict()
+        if self._position is not None:
+            state['position'] = self._position
+        if self._resume_positions is not None:
+            buckets = self._resume_positions
+        else:
+            buckets = [list(x) for x in self._bucket_positions]
+        return {'sampler': state, 'buckets': buckets}
+
+    def load_state_dict(self, state):
+        sampler = self._positioned_sampler()
+        assert sampler is not None, 'The data loader state needs a MultiDatasetSampler'
+        assert len(state['buckets']) == len(self._buckets)
+        sampler.sampler.load_state_dict(state['sampler'])
+        self._resume_positions = state['buckets']
+
+
+class DIFFMDAspectRatioGroupedDataset(MDAspectRatioGroupedDataset):
+    def __init__(self, dataset, batch_sizes, num_datasets):
+        """
+        """
+        super().__init__(dataset, None, num_datasets)
+        self.batch_sizes = batch_sizes
 
+    def _get_batch_size(self, d):
+        return self.batch_sizes[d['dataset_source']]
 
-def repeat_factors_from_tag_frequency(dataset_dicts, repeat_thresh):
+
+class PixelBudgetGroupedDataset(MDAspectRatioGroupedDataset):
+    def __init__(self, dataset, pixel_budget, num_datasets,
+            aspect_ratio_boundaries=(0.5, 0.75, 1.0, 1.333, 2.0),
+            max_batch_size=64, size_divisibility=32, square_size=0):
+        """
+        Groups by dataset and width / height (split at `aspect_ratio_boundaries`),
+        and emits a bucket when the next image would bring its padded size,
+        len(batch) * max height * max width (rounded up to `size_divisibility`),
+        above `pixel_budget`, or when it holds `max_batch_size` images.
+        Sources with small images thus get proportionally larger batches.
+        With `square_size` > 0 (ImageList padding_constraints) every image is
+        padded to that square, which leaves pixel_budget // square_size ** 2
+        images per batch.
+        """
+        self.aspect_ratio_boundaries = sorted(aspect_ratio_boundaries)
+        super().__init__(
+            dataset, None, num_datasets,
+            num_aspect_buckets=len(self.aspect_ratio_boundaries) + 1)
+        self.pixel_budget = pixel_budget
+        self.max_batch_size = max_batch_size
+        self.size_divisibility = max(size_divisibility, 1)
+        self.square_size = square_size
+
+    def _aspect_ratio_bucket_id(self, d):
+        return bisect.bisect_right(
+            self.aspect_ratio_boundaries, d["width"] / d["height"])
+
+    def _padded_size(self, d):
+        if self.square_size > 0:
+            return self.square_size, self.square_size
+        # the mapped image, (C, H, W)
+        h, w = d['image'].shape[-2:]
+        s = self.size_divisibility
+        return (h + s - 1) // s * s, (w + s - 1) // s * s
+
+    def _flush_before(self, bucket, d):
+        h, w = self._padded_size(d)
+        for x in bucket:
+            xh, xw = self._padded_size(x)
+            h, w = max(h, xh), max(w, xw)
+        return (len(bucket) + 1) * h * w > self.pixel_budget
+
+    def _flush_after(self, bucket, d):
+        return len(bucket) >= self.max_batch_size
+
+
+class TrainLoaderCheckpointable(object):
     """
+    Checkpointable for DetectionCheckpointer holding the state of every rank's
+    train loader (see MDAspectRatioGroupedDataset.state_dict) and RNGs.
+    Only the main process writes checkpoints, so all ranks must call
+    `gather()` right before a checkpoint is saved.
     """
-    category_freq = defaultdict(int)
-    for dataset_dict in dataset_dicts:
-        cat_ids = dataset_dict['pos_category_ids']
-        for cat_id in cat_ids:
-            category_freq[cat_id] += 1
-    num_images = len(dataset_dicts)
-    for k, v in category_freq.items():
-        category_freq[k] = v / num_images
-
-    category_rep = {
-        cat_id: max(1.0, math.sqrt(repeat_thresh / cat_freq))
-        for cat_id, cat_freq in category_freq.items()
-    }
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        self._states = None
+
+    def _local_state(self):
+        loader_state = {}
+        if hasattr(self.data_loader, 'state_dict'):
+            loader_state = self.data_loader.state_dict()
+        return {'loader': loader_state, 'rng': get_rng_state(cuda=True)}
+
+    def gather(self):
+        self._states = comm.all_gather(self._local_state())
+
+    def state_dict(self):
+        states = self._states or [self._local_state()]
+        self._states = None
+        if not states[0]['loader']:
+            logging.getLogger(__name__).warning(
+                'The train loader can not be checkpointed, '
+                'resuming will restart its sampler.')
+        return {'world_size': len(states), 'ranks': states}
+
+    def load_state_dict(self, state):
+        if state['world_size'] != comm.get_world_size():
+            logging.getLogger(__name__).warning(
+                'Train loader state was saved with {} ranks, now {}: not restored.'.format(
+                    state['world_size'], comm.get_world_size()))
+            return
+        local_state = state['ranks'][comm.get_rank()]
+        if local_state['loader'] and hasattr(self.data_loader, 'load_state_dict'):
+            self.data_loader.load_state_dict(local_state['loader'])
+        set_rng_state(local_state['rng'])
 
-    rep_factors = []
-    for dataset_dict in dataset_dicts:
-        cat_ids = dataset_dict['pos_category_ids']
-        rep_factor = max({category_rep[cat_id] for cat_id in cat_ids}, default=1.0)
-        rep_factors.append(rep_factor)
 
-    return torch.tensor(rep_factors, dtype=torch.float32)
\ No newline at end of file
+def repeat_factors_from_tag_frequency(dataset_dicts, repeat_thresh):
+    """
+    Repeat factors from the image-level `pos_category_ids`.
+    """
+    return repeat_factors_from_columns(
+        *category_columns(dataset_dicts, 'image'), repeat_thresh)
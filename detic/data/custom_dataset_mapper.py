@@ -1,9 +1,11 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import copy
+import io
 import logging
 import numpy as np
 import torch
 import pycocotools.mask as mask_util
+from PIL import Image
 
 from detectron2.config import configurable
 from detectron2.data import DatasetMapper
@@ -14,7 +16,24 @@ from detectron2.structures import Keypoints, PolygonMasks, BitMasks
 from .custom_build_augmentation import build_custom_augmentation
 from .tar_dataset import DiskTarDataset
 
-__all__ = ["CustomDatasetMapper", "SamDatasetMapper"]
+__all__ = ["CustomDatasetMapper", "SamDatasetMapper", "read_record_image"]
+
+
+def read_record_image(dataset_dict, image_format, tar_dataset=None):
+    """
+    The image of a record: decoded from the file content in "image_bytes"
+    (popped, see ShardedStreamDataset), read from "file_name", or else read
+    from `tar_dataset` at "tar_index".
+    """
+    if "image_bytes" in dataset_dict:
+        image = Image.open(io.BytesIO(dataset_dict.pop("image_bytes")))
+    elif "file_name" in dataset_dict:
+        return utils.read_image(dataset_dict["file_name"], format=image_format)
+    else:
+        image, _, _ = tar_dataset[dataset_dict["tar_index"]]
+    image = utils._apply_exif_orientation(image)
+    return utils.convert_PIL_to_numpy(image, image_format)
+
 
 class CustomDatasetMapper(DatasetMapper):
     @configurable
@@ -82,13 +101,8 @@ class CustomDatasetMapper(DatasetMapper):
         """
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
         # USER: Write your own image loading if it's not from a file
-        if 'file_name' in dataset_dict:
-            ori_image = utils.read_image(
-                dataset_dict["file_name"], format=self.image_format)
-        else:
-            ori_image, _, _ = self.tar_dataset[dataset_dict["tar_index"]]
-            ori_image = utils._apply_exif_orientation(ori_image)
-            ori_image = utils.convert_PIL_to_numpy(ori_image, self.image_format)
+        ori_image = read_record_image(dataset_dict, self.image_format,
+            self.tar_dataset if self.use_tar_dataset else None)
         utils.check_image_size(dataset_dict, ori_image)
 
         # USER: Remove if you don't do semantic/panoptic segmentation.
@@ -278,6 +292,33 @@ class SamDatasetMapper(DatasetMapper):
     def __init__(self, is_train: bool, **kwargs):
         super().__init__(is_train, **kwargs)
 
+    def __call__(self, dataset_dict):
+        """
+        Also maps the records of ShardedStreamDataset, which carry the image
+        file content in "image_bytes" instead of reading "file_name".
+        """
+        if "image_bytes" not in dataset_dict:
+            return super().__call__(dataset_dict)
+        dataset_dict = dict(dataset_dict)
+        image = read_record_image(dataset_dict, self.image_format)
+        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        utils.check_image_size(dataset_dict, image)
+
+        aug_input = T.AugInput(image)
+        transforms = self.augmentations(aug_input)
+        image = aug_input.image
+
+        image_shape = image.shape[:2]  # h, w
+        dataset_dict["image"] = torch.as_tensor(
+            np.ascontiguousarray(image.transpose(2, 0, 1)))
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            return dataset_dict
+
+        if "annotations" in dataset_dict:
+            self._transform_annotations(dataset_dict, transforms, image_shape)
+        return dataset_dict
+
 
     def _transform_annotations(self, dataset_dict, transforms, image_shape):
         for anno in dataset_dict["annotations"]:
@@ -0,0 +1,181 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import itertools
+import logging
+import os
+import pickle
+import numpy as np
+import torch
+from tabulate import tabulate
+from termcolor import colored
+
+from detectron2.utils import comm
+from detectron2.utils.logger import log_first_n
+
+from .annotation_store import AnnotationStore, AnnotationStoreView
+
+logger = logging.getLogger(__name__)
+
+# larger category ids are remapped with np.unique instead of indexing directly
+_MAX_DENSE_CATEGORY_ID = 1 << 24
+
+__all__ = [
+    "category_columns", "repeat_factors_from_columns",
+    "get_repeat_factors", "print_class_histogram",
+]
+
+
+def category_columns(dataset_dicts, dataset_ann='box'):
+    """
+    (category ids, per-image offsets into them) of the annotations
+    (`dataset_ann` 'box') or of `pos_category_ids` (image labels), read from
+    the columns of an AnnotationStore(View) or in one pass over the dicts.
+    """
+    if isinstance(dataset_dicts, (AnnotationStore, AnnotationStoreView)):
+        if dataset_ann == 'box':
+            return np.asarray(dataset_dicts.category_ids, dtype=np.int64), \
+                np.asarray(dataset_dicts.ann_offsets, dtype=np.int64)
+        values, offsets, _ = dataset_dicts.get_list_column('pos_category_ids')
+        return np.asarray(values, dtype=np.int64), np.asarray(offsets, dtype=np.int64)
+    if dataset_ann == 'box':
+        key, get_id = 'annotations', lambda obj: obj['category_id']
+    else:
+        key, get_id = 'pos_category_ids', int
+    offsets = np.zeros(len(dataset_dicts) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(d[key]) for d in dataset_dicts),
+        dtype=np.int64, count=len(dataset_dicts)), out=offsets[1:])
+    cat_ids = np.fromiter((get_id(x) for d in dataset_dicts for x in d[key]),
+        dtype=np.int64, count=offsets[-1])
+    return cat_ids, offsets
+
+
+def repeat_factors_from_columns(cat_ids, offsets, repeat_thresh):
+    """
+    LVIS repeat factors (same values as detectron2's
+    RepeatFactorTrainingSampler.repeat_factors_from_category_frequency):
+    f(c) is the fraction of images containing category c,
+    r(c) = max(1, sqrt(repeat_thresh / f(c))) and the factor of an image is
+    the max r(c) of its categories (1 without any).
+    """
+    num_images = len(offsets) - 1
+    factors = np.ones(num_images, dtype=np.float64)
+    if len(cat_ids) == 0:
+        return torch.tensor(factors, dtype=torch.float32)
+    counts = np.diff(offsets)
+    image_of = np.repeat(np.arange(num_images, dtype=np.int64), counts)
+    if cat_ids.min() >= 0 and cat_ids.max() < _MAX_DENSE_CATEGORY_ID:
+        cat_index, num_cats = cat_ids, int(cat_ids.max()) + 1
+    else:
+        cats, cat_index = np.unique(cat_ids, return_inverse=True)
+        num_cats = len(cats)
+    # an image counts once per category: dedupe the (image, category) keys,
+    # which are already sorted by image, so the stable sort is cheap
+    keys = image_of * num_cats + cat_index
+    keys.sort(kind='stable')
+    first = np.empty(len(keys), dtype=bool)
+    first[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=first[1:])
+    image_count = np.bincount(keys[first] % num_cats, minlength=num_cats)
+    with np.errstate(divide='ignore'):
+        # categories that do not occur are never looked up
+        category_rep = np.maximum(1.0, np.sqrt(repeat_thresh / (image_count / num_images)))
+    nonempty = counts > 0
+    factors[nonempty] = np.maximum.reduceat(
+        category_rep[cat_index], offsets[:-1][nonempty])
+    return torch.tensor(factors, dtype=torch.float32)
+
+
+def get_repeat_factors(dataset_dicts, sizes, use_rfs, dataset_ann,
+        repeat_thresh, cache_path=None):
+    """
+    Concatenated repeat factors of the datasets (of `sizes` images, in
+    order) in `dataset_dicts`, each normalized to sum to its size; 1 for the
+    datasets without `use_rfs`.
+
+    Computed on rank 0 only (or read from `cache_path`, see
+    snapshot.get_stats_cache_path) and sent to the other ranks.
+    """
+    factors = None
+    if comm.is_main_process():
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                factors = pickle.load(f)
+            logger.info("Loaded repeat factors from {}".format(cache_path))
+        else:
+            factors = []
+            st = 0
+            for s, rfs, ann in zip(sizes, use_rfs, dataset_ann):
+                if rfs:
+                    rfs_factor = repeat_factors_from_columns(
+                        *category_columns(dataset_dicts[st: st + s], ann), repeat_thresh)
+                    rfs_factor = rfs_factor * (s / rfs_factor.sum())
+                else:
+                    rfs_factor = torch.ones(s)
+                factors.append(rfs_factor)
+                st = st + s
+            factors = torch.cat(factors).numpy()
+            if cache_path:
+                tmp_path = cache_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(factors, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+                logger.info("Saved repeat factors to {}".format(cache_path))
+    if comm.get_world_size() > 1:
+        factors = comm.all_gather(factors)[0]
+    assert len(factors) == sum(sizes), \
+        "Repeat factors of {} images for {} images".format(len(factors), sum(sizes))
+    return torch.from_numpy(factors)
+
+
+def class_histogram(dataset_dicts, num_classes):
+    """
+    Number of non-crowd instances of every class.
+    """
+    if isinstance(dataset_dicts, (AnnotationStore, AnnotationStoreView)):
+        # iscrowd -1: not given, counted like the dicts without it
+        classes = np.asarray(dataset_dicts.category_ids)[
+            np.asarray(dataset_dicts.iscrowd) <= 0]
+    else:
+        classes = np.fromiter(
+            (x["category_id"] for d in dataset_dicts for x in d["annotations"]
+                if not x.get("iscrowd", 0)), dtype=np.int64)
+    if len(classes):
+        assert classes.min() >= 0
+        assert classes.max() < num_classes
+    return np.bincount(classes, minlength=num_classes)
+
+
+def print_class_histogram(dataset_dicts, class_names):
+    """
+    detectron2's print_instances_class_histogram, counting the classes with
+    one bincount.
+    """
+    num_classes = len(class_names)
+    histogram = class_histogram(dataset_dicts, num_classes)
+    N_COLS = min(6, len(class_names) * 2)
+
+    def short_name(x):
+        # make long class names shorter. useful for lvis
+        if len(x) > 13:
+            return x[:11] + ".."
+        return x
+
+    data = list(itertools.chain(
+        *[[short_name(class_names[i]), int(v)] for i, v in enumerate(histogram)]))
+    total_num_instances = sum(data[1::2])
+    data.extend([None] * (N_COLS - (len(data) % N_COLS)))
+    if num_classes > 1:
+        data.extend(["total", total_num_instances])
+    data = itertools.zip_longest(*[data[i::N_COLS] for i in range(N_COLS)])
+    table = tabulate(
+        data,
+        headers=["category", "#instances"] * (N_COLS // 2),
+        tablefmt="pipe",
+        numalign="left",
+        stralign="center",
+    )
+    log_first_n(
+        logging.INFO,
+        "Distribution of instances among all {} categories:\n".format(num_classes)
+        + colored(table, "cyan"),
+        key="message",
+    )
@@ -1,9 +1,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 import os
 
-from detectron2.data.datasets.register_coco import register_coco_instances
 from detectron2.data.datasets.builtin_meta import _get_builtin_metadata
 from detectron2.data import MetadataCatalog
+from .snapshot import register_coco_instances
+from .zeroshot_splits import get_zeroshot_split_ids
 # 48 base classes
 categories_seen = [
     {'id': 1, 'name': 'person'},
@@ -114,17 +115,4 @@ for key, (image_root, json_file, cat) in _PREDEFINED_SPLITS_COCO.items():
 
 def get_contigous_ids(cat):
     # 直接输出 相对于 80 类别的continuous id, 
-    if cat == 'all':
-        return list(range(80))
-    elif cat == 'seen':
-        id_to_name = {x['id']: x['name'] for x in categories_seen}
-    elif cat == 'unseen':
-        id_to_name = {x['id']: x['name'] for x in categories_unseen}
-    elif cat == 'seen_unseen' or cat == 'unused':
-        id_to_name = categories_seen + categories_unseen
-        id_to_name = {x['id']: x['name'] for x in id_to_name}
-    thing_dataset_id_to_contiguous_id = _get_metadata('all')["thing_dataset_id_to_contiguous_id"]
-    contiguous_ids = [thing_dataset_id_to_contiguous_id[x] for x in id_to_name.keys()]
-    if cat == 'unused':
-        contiguous_ids = list(set(range(80)) - set(contiguous_ids))
-    return contiguous_ids
+    return get_zeroshot_split_ids('coco', cat)
@@ -7,6 +7,7 @@ from detectron2.structures import BoxMode
 from fvcore.common.file_io import PathManager
 from detectron2.data import DatasetCatalog, MetadataCatalog
 from detectron2.data.datasets.lvis import get_lvis_instances_meta
+from .snapshot import snapshot_loader
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +17,8 @@ __all__ = ["custom_load_lvis_json", "custom_register_lvis_instances"]
 def custom_register_lvis_instances(name, metadata, json_file, image_root):
     """
     """
-    DatasetCatalog.register(name, lambda: custom_load_lvis_json(
-        json_file, image_root, name))
+    DatasetCatalog.register(name, snapshot_loader(
+        custom_load_lvis_json, json_file, image_root, name))
     MetadataCatalog.get(name).set(
         json_file=json_file, image_root=image_root, 
         evaluator_type="lvis", **metadata
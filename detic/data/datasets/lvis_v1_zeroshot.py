@@ -7,8 +7,9 @@ from detectron2.structures import BoxMode
 from fvcore.common.file_io import PathManager
 from detectron2.data import DatasetCatalog, MetadataCatalog
 from detectron2.data.datasets.lvis import get_lvis_instances_meta
+from .snapshot import snapshot_loader
+from .zeroshot_splits import get_zeroshot_split_ids
 import json
-from lvis import LVIS
 
 from detectron2.data.datasets.lvis_v1_categories import LVIS_CATEGORIES as LVIS_V1_CATEGORIES
 logger = logging.getLogger(__name__)
@@ -18,8 +19,8 @@ __all__ = ["custom_load_lvis_json", "custom_register_lvis_instances"]
 def custom_register_lvis_instances(name, metadata, json_file, image_root):
     """
     """
-    DatasetCatalog.register(name, lambda: custom_load_lvis_json(
-        json_file, image_root, name))
+    DatasetCatalog.register(name, snapshot_loader(
+        custom_load_lvis_json, json_file, image_root, name))
     MetadataCatalog.get(name).set(
         json_file=json_file, image_root=image_root, 
         evaluator_type="lvis", **metadata
@@ -133,20 +134,8 @@ for key, (image_root, json_file) in _CUSTOM_SPLITS_LVIS.items():
 
 def get_contigous_ids_lvis(cat):
     # 直接输出 相对于1203类别的continuous id, 
-    if cat == 'all':
-        return list(range(1203))
-    elif cat == 'seen':
-        # 拿到所有的 seen id
-        json_file =  "lvis/zero-shot/lvis_v1_train_seen.json"
-        json_file = os.path.join(detectron_datasets, json_file) 
-        lvis_api = LVIS(json_file)
-        catid2contid = {x['id']: i for i, x in enumerate(
-            sorted(lvis_api.dataset['categories'], key=lambda x: x['id']))}
-        base_ids = [x['id'] for x in lvis_api.dataset['categories'] if x['frequency'] not in 'r']
-        contiguous_ids = [catid2contid[x] for x in base_ids]
-    else:
-        assert NotImplementedError
-    return contiguous_ids
+    # 'seen' 是非 rare 的类别, 预先存在 datasets/metadata/zeroshot_split_ids.json
+    return get_zeroshot_split_ids('lvis', cat)
 
 
 # register 
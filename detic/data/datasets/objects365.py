@@ -1,7 +1,9 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
-from detectron2.data.datasets.register_coco import register_coco_instances
 import os
 
+from .register_oid import load_coco_json_streaming
+from .snapshot import register_coco_instances
+
 # categories_v2 = [
 #     {'id': 1, 'name': 'Person'},
 #     {'id': 2, 'name': 'Sneakers'},
@@ -767,4 +769,5 @@ for key, (image_root, json_file) in _PREDEFINED_SPLITS_OBJECTS365.items():
         _get_builtin_metadata(),
         os.path.join("datasets", json_file) if "://" not in json_file else json_file,
         os.path.join("datasets", image_root),
+        load_func=load_coco_json_streaming,
     )
\ No newline at end of file
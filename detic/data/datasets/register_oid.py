@@ -11,10 +11,17 @@ import numpy as np
 
 from PIL import Image
 
+try:
+    import ijson
+except ImportError:
+    # ijson is optional, without it the json is parsed at once
+    ijson = None
+
 from fvcore.common.timer import Timer
 from fvcore.common.file_io import PathManager, file_lock
 from detectron2.structures import BoxMode, PolygonMasks, Boxes
 from detectron2.data import DatasetCatalog, MetadataCatalog
+from .snapshot import snapshot_loader
 
 logger = logging.getLogger(__name__)
 
@@ -30,8 +37,8 @@ def register_oid_instances(name, metadata, json_file, image_root):
     """
     """
     # 1. register a function which returns dicts
-    DatasetCatalog.register(name, lambda: load_coco_json_mem_efficient(
-        json_file, image_root, name))
+    DatasetCatalog.register(name, snapshot_loader(
+        load_coco_json_streaming, json_file, image_root, name))
 
     # 2. Optionally, add metadata about this dataset,
     # since they might be useful in evaluation, visualization or logging
@@ -119,4 +126,152 @@ def load_coco_json_mem_efficient(json_file, image_root, dataset_name=None, extra
         dataset_dicts.append(record)
     
     del coco_api
-    return dataset_dicts
\ No newline at end of file
+    return dataset_dicts
+
+
+def load_coco_json_streaming(json_file, image_root, dataset_name=None, extra_annotation_keys=None):
+    """
+    Same records as `load_coco_json_mem_efficient`, without building a COCO
+    api object. `categories`, `images` and `annotations` are streamed with
+    ijson (when installed) and kept in compact arrays until the records are
+    emitted, so the peak memory is roughly the size of the output dicts
+    instead of the parsed json plus two annotation indexes. Without ijson the
+    json is parsed once and every list is released once read.
+    """
+    timer = Timer()
+    json_file = PathManager.get_local_path(json_file)
+    iter_json_items = _json_items_reader(json_file)
+
+    cats = list(iter_json_items("categories"))
+    cat_ids = sorted(c["id"] for c in cats)
+    id_map = None
+    if dataset_name is not None:
+        meta = MetadataCatalog.get(dataset_name)
+        # The categories in a custom json file may not be sorted.
+        thing_classes = [c["name"] for c in sorted(cats, key=lambda x: x["id"])]
+        meta.thing_classes = thing_classes
+
+        if not (min(cat_ids) == 1 and max(cat_ids) == len(cat_ids)):
+            if "coco" not in dataset_name:
+                logger.warning(
+                    """
+                    Category ids in annotations are not in [1, #categories]! We'll apply a mapping for you.
+                    """
+                )
+        id_map = {v: i for i, v in enumerate(cat_ids)}
+        meta.thing_dataset_id_to_contiguous_id = id_map
+    del cats
+
+    img_ids, heights, widths, file_names, neg_category_ids = [], [], [], [], {}
+    for img_dict in iter_json_items("images"):
+        img_ids.append(img_dict["id"])
+        heights.append(img_dict["height"])
+        widths.append(img_dict["width"])
+        file_names.append(img_dict["file_name"])
+        if 'neg_category_ids' in img_dict:
+            neg_category_ids[img_dict["id"]] = img_dict['neg_category_ids']
+    img_ids = np.asarray(img_ids, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int32)
+    widths = np.asarray(widths, dtype=np.int32)
+
+    extra_annotation_keys = extra_annotation_keys or []
+    ann_image_ids, bboxes, category_ids, iscrowds = [], [], [], []
+    segms, extras = {}, {}
+    for anno in iter_json_items("annotations"):
+        assert anno.get("ignore", 0) == 0
+        j = len(ann_image_ids)
+        ann_image_ids.append(anno["image_id"])
+        bboxes.append(anno["bbox"])
+        category_ids.append(anno["category_id"])
+        iscrowds.append(anno.get("iscrowd", -1))
+        if anno.get("segmentation", None):
+            segms[j] = anno["segmentation"]
+        extra = {key: anno[key] for key in extra_annotation_keys if key in anno}
+        if extra:
+            extras[j] = extra
+    ann_image_ids = np.asarray(ann_image_ids, dtype=np.int64)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    category_ids = np.asarray(category_ids, dtype=np.int64)
+    iscrowds = np.asarray(iscrowds, dtype=np.int8)
+    if timer.seconds() > 1:
+        logger.info("Streaming {} takes {:.2f} seconds.".format(json_file, timer.seconds()))
+
+    # group annotations by image, keeping the file order within an image
+    # like COCO.imgToAnns does
+    ann_order = np.argsort(ann_image_ids, kind="stable")
+    sorted_ann_image_ids = ann_image_ids[ann_order]
+    # sort indices for reproducible results
+    img_order = np.argsort(img_ids, kind="stable")
+    starts = np.searchsorted(sorted_ann_image_ids, img_ids[img_order], side="left")
+    ends = np.searchsorted(sorted_ann_image_ids, img_ids[img_order], side="right")
+    logger.info("Loaded {} images in COCO format from {}".format(len(img_ids), json_file))
+
+    dataset_dicts = []
+    num_instances_without_valid_segmentation = 0
+    for i, st, ed in zip(img_order.tolist(), starts.tolist(), ends.tolist()):
+        record = {}
+        record["file_name"] = os.path.join(image_root, file_names[i])
+        record["height"] = int(heights[i])
+        record["width"] = int(widths[i])
+        image_id = record["image_id"] = int(img_ids[i])
+        if image_id in neg_category_ids:
+            record['neg_category_ids'] = \
+                [id_map[x] for x in neg_category_ids[image_id]]
+
+        objs = []
+        inds = ann_order[st:ed]
+        for j, bbox, category_id, iscrowd in zip(
+                inds.tolist(), bboxes[inds].tolist(),
+                category_ids[inds].tolist(), iscrowds[inds].tolist()):
+            obj = {}
+            if iscrowd >= 0:
+                obj["iscrowd"] = iscrowd
+            obj["bbox"] = bbox
+            obj["category_id"] = category_id
+            if j in extras:
+                obj.update(extras[j])
+
+            segm = segms.get(j, None)
+            if segm:  # either list[list[float]] or dict(RLE)
+                if not isinstance(segm, dict):
+                    # filter out invalid polygons (< 3 points)
+                    segm = [poly for poly in segm if len(poly) % 2 == 0 and len(poly) >= 6]
+                    if len(segm) == 0:
+                        num_instances_without_valid_segmentation += 1
+                        continue  # ignore this instance
+                obj["segmentation"] = segm
+
+            obj["bbox_mode"] = BoxMode.XYWH_ABS
+
+            if id_map:
+                obj["category_id"] = id_map[obj["category_id"]]
+            objs.append(obj)
+        record["annotations"] = objs
+        dataset_dicts.append(record)
+
+    if num_instances_without_valid_segmentation > 0:
+        logger.warning(
+            "Filtered out {} instances without valid segmentation.".format(
+                num_instances_without_valid_segmentation))
+    return dataset_dicts
+
+
+def _json_items_reader(json_file):
+    """
+    A function yielding the elements of a top-level list `key` of a json
+    file, each key read once: streamed with ijson, or without it taken from
+    the json parsed once here, the list being dropped from it when read.
+    """
+    if ijson is not None:
+        def iter_items(key):
+            with PathManager.open(json_file, "rb") as f:
+                yield from ijson.items(f, key + ".item", use_float=True)
+        return iter_items
+
+    logger.warning("ijson is not installed, parsing {} at once".format(json_file))
+    with PathManager.open(json_file, "r") as f:
+        data = json.load(f)
+
+    def iter_items(key):
+        yield from data.pop(key, [])
+    return iter_items
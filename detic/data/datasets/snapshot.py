@@ -0,0 +1,121 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import hashlib
+import logging
+import os
+
+from fvcore.common.timer import Timer
+from fvcore.common.file_io import PathManager, file_lock
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets.coco import load_coco_json
+
+from ..annotation_store import AnnotationStore
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["snapshot_loader", "register_coco_instances", "get_dataset_store",
+    "get_snapshot_path", "get_stats_cache_path", "SNAPSHOT_DIR"]
+
+# Binary snapshots of registered datasets are written here. Empty disables them.
+SNAPSHOT_DIR = os.environ.get("DETIC_SNAPSHOT_DIR", "")
+# Metadata that json loaders set as a side effect and that must be restored
+# when the dicts come from a snapshot.
+_SNAPSHOT_META_KEYS = ("thing_classes", "thing_dataset_id_to_contiguous_id")
+# snapshot path of every dataset loaded in this process
+_LOADED_SNAPSHOTS = {}
+
+
+def snapshot_loader(load_func, json_file, image_root, dataset_name=None, **kwargs):
+    """
+    Wrap a `load_func(json_file, image_root, dataset_name, **kwargs)` json
+    loader for `DatasetCatalog.register`. When `DETIC_SNAPSHOT_DIR` is set,
+    the first call parses the json as usual and stores the resulting dicts as
+    a memory-mapped `AnnotationStore`; later calls (other ranks, later
+    launches) read the snapshot instead of parsing the json.
+
+    `DatasetCatalog.get` still returns a list of dicts built from the
+    snapshot. `get_dataset_store` calls the loader with `lazy=True`, which
+    returns the store itself: opening it only maps the files, and a record
+    is built (as a new dict, so writes to it are not kept) when it is indexed.
+
+    The snapshot is keyed by the json path, size, mtime, the loader and its
+    arguments, so editing the json or changing the loader options builds a
+    new snapshot.
+    """
+    def _load(lazy=False):
+        if not SNAPSHOT_DIR:
+            return load_func(json_file, image_root, dataset_name, **kwargs)
+        path = get_snapshot_path(load_func, json_file, image_root, dataset_name, **kwargs)
+        _LOADED_SNAPSHOTS[dataset_name] = path
+        with file_lock(path):
+            if not AnnotationStore.exists(path):
+                dataset_dicts = load_func(json_file, image_root, dataset_name, **kwargs)
+                store = AnnotationStore.from_dicts(dataset_dicts)
+                if dataset_name is not None:
+                    meta = MetadataCatalog.get(dataset_name)
+                    store.metadata = {
+                        k: getattr(meta, k) for k in _SNAPSHOT_META_KEYS if hasattr(meta, k)}
+                store.save(path)
+                logger.info("Saved snapshot of {} to {}".format(dataset_name, path))
+                return dataset_dicts
+        timer = Timer()
+        store = AnnotationStore.load(path)
+        if dataset_name is not None:
+            meta = MetadataCatalog.get(dataset_name)
+            for k, v in store.metadata.items():
+                if not hasattr(meta, k):
+                    meta.set(**{k: v})
+        logger.info("Opened snapshot {} of {} ({} images) in {:.2f} seconds.".format(
+            path, dataset_name, len(store), timer.seconds()))
+        return store if lazy else store.to_dicts()
+    _load.snapshot = True
+    return _load
+
+
+def get_dataset_store(name):
+    """
+    DatasetCatalog.get(name), but a dataset registered through
+    snapshot_loader returns its AnnotationStore when it is read from a
+    snapshot (see snapshot_loader).
+    """
+    load = DatasetCatalog[name] if name in DatasetCatalog else None
+    if getattr(load, "snapshot", False):
+        return load(lazy=True)
+    return DatasetCatalog.get(name)
+
+
+def register_coco_instances(name, metadata, json_file, image_root,
+    load_func=load_coco_json):
+    """
+    detectron2's register_coco_instances, loading the dicts with `load_func`
+    through the dataset snapshot
+    """
+    DatasetCatalog.register(name, snapshot_loader(
+        load_func, json_file, image_root, name))
+    MetadataCatalog.get(name).set(
+        json_file=json_file, image_root=image_root, evaluator_type="coco", **metadata
+    )
+
+
+def get_snapshot_path(load_func, json_file, image_root, dataset_name=None, **kwargs):
+    local_file = PathManager.get_local_path(json_file)
+    stat = os.stat(local_file)
+    key = repr((
+        os.path.abspath(local_file), stat.st_size, stat.st_mtime_ns,
+        load_func.__module__, load_func.__qualname__,
+        image_root, dataset_name, sorted(kwargs.items())))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    name = dataset_name or os.path.splitext(os.path.basename(local_file))[0]
+    return os.path.join(SNAPSHOT_DIR, "{}-{}".format(name, digest))
+
+
+def get_stats_cache_path(name, dataset_names, **kwargs):
+    """
+    Cache file for statistics `name` of the (concatenated) datasets, keyed by
+    their snapshots and `kwargs`; None unless all of them were loaded from
+    snapshots in this process.
+    """
+    if not SNAPSHOT_DIR or any(x not in _LOADED_SNAPSHOTS for x in dataset_names):
+        return None
+    key = repr(([_LOADED_SNAPSHOTS[x] for x in dataset_names], sorted(kwargs.items())))
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SNAPSHOT_DIR, "{}-{}.pkl".format(name, digest))
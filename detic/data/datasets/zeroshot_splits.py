@@ -0,0 +1,65 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Contiguous ids of the base/novel/unused categories of the open-vocabulary
+COCO and LVIS splits. They are precomputed into a small json (see
+tools/dump_zeroshot_split_ids.py) so that building a model does not parse the
+LVIS annotation file.
+"""
+import functools
+import json
+
+from fvcore.common.file_io import PathManager
+
+__all__ = [
+    "ZEROSHOT_SPLITS_PATH", "get_zeroshot_split_ids",
+    "compute_coco_split_ids", "compute_lvis_split_ids"]
+
+ZEROSHOT_SPLITS_PATH = 'datasets/metadata/zeroshot_split_ids.json'
+
+
+@functools.lru_cache(maxsize=None)
+def load_zeroshot_splits(path=ZEROSHOT_SPLITS_PATH):
+    with PathManager.open(path, 'r') as f:
+        return json.load(f)
+
+
+def get_zeroshot_split_ids(dataset, cat, path=ZEROSHOT_SPLITS_PATH):
+    """
+    Returns the contiguous ids (w.r.t. all categories of `dataset`) of split
+    `cat`, e.g. get_zeroshot_split_ids('lvis', 'seen').
+    """
+    splits = load_zeroshot_splits(path)[dataset]
+    assert cat in splits, 'Unknown {} split {}, expected one of {}'.format(
+        dataset, cat, sorted(splits))
+    return list(splits[cat])
+
+
+def compute_coco_split_ids(categories_seen, categories_unseen, thing_dataset_id_to_contiguous_id):
+    """
+    Split ids of the 48/17 open-vocabulary COCO split, relative to the 80
+    COCO categories. 'unused' are the 15 categories in neither split.
+    """
+    seen = [thing_dataset_id_to_contiguous_id[x['id']] for x in categories_seen]
+    unseen = [thing_dataset_id_to_contiguous_id[x['id']] for x in categories_unseen]
+    num_classes = len(thing_dataset_id_to_contiguous_id)
+    return {
+        'all': list(range(num_classes)),
+        'seen': seen,
+        'unseen': unseen,
+        'seen_unseen': seen + unseen,
+        'unused': sorted(set(range(num_classes)) - set(seen + unseen)),
+    }
+
+
+def compute_lvis_split_ids(categories):
+    """
+    Split ids of open-vocabulary LVIS: the rare categories are novel.
+    `categories` is the `categories` field of an LVIS v1 json.
+    """
+    catid2contid = {x['id']: i for i, x in enumerate(
+        sorted(categories, key=lambda x: x['id']))}
+    return {
+        'all': list(range(len(categories))),
+        'seen': sorted(catid2contid[x['id']] for x in categories if x['frequency'] != 'r'),
+        'unseen': sorted(catid2contid[x['id']] for x in categories if x['frequency'] == 'r'),
+    }
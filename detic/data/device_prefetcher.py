@@ -0,0 +1,184 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import logging
+import queue
+import threading
+import time
+import torch
+
+from detectron2.structures import Instances
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["DevicePrefetcher"]
+
+_END = object()
+
+
+class DevicePrefetcher(object):
+    """
+    Wraps a train or test data loader (yielding lists of dataset dicts):
+    a background thread takes the batches out of the loader and pins their
+    tensors, and the copy of the next batch to `device` is issued on a side
+    CUDA stream while the current batch is being computed. The model's own
+    `.to(device)` calls are then no-ops.
+
+    On CPU (or with pin_memory=False) the batches are only read ahead.
+
+    With read_in_thread=False the batches are read (and pinned) in the
+    consuming thread, one batch ahead, and only the copy to `device`
+    overlaps with the compute. Use it when the loader maps the dicts in the
+    main process (num_workers=0): the mapping then draws from the global
+    python/numpy/torch RNGs (or reseeds them, see _PositionSeededDataset),
+    which must not happen in another thread while the model trains.
+
+    `wait_time` is the time the last `next()` waited for data (i.e. the
+    loader could not keep up), `total_wait_time` / `num_batches` the totals.
+
+    The state of a checkpointable loader (see
+    MDAspectRatioGroupedDataset.state_dict) is the state right after the
+    last batch that was returned, not after the batches read ahead.
+    """
+    def __init__(self, data_loader, device, num_prefetch=2, pin_memory=True,
+        read_in_thread=True):
+        self.data_loader = data_loader
+        self.read_in_thread = read_in_thread
+        self.device = torch.device(device)
+        self.num_prefetch = max(num_prefetch, 1)
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.pin_memory = pin_memory and self.use_cuda
+        self.wait_time = 0.
+        self.total_wait_time = 0.
+        self.num_batches = 0
+        self._state = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        if not self.read_in_thread:
+            items = self._items()
+            yield from self._iter_batches(lambda: next(items), stream)
+            return
+        queue_ = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._read, args=(queue_, stop), daemon=True)
+        thread.start()
+        try:
+            yield from self._iter_batches(queue_.get, stream)
+        finally:
+            stop.set()
+            # unblock the reader if it is waiting for a free slot
+            while thread.is_alive():
+                try:
+                    queue_.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
+
+    def _iter_batches(self, get, stream):
+        next_batch = self._next(get, stream)
+        while next_batch is not _END:
+            batch, state = next_batch
+            if stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(stream)
+                _record_stream(batch, current_stream)
+            # the copy of the next batch overlaps with the compute of this one
+            next_batch = self._next(get, stream)
+            self._state = state
+            yield batch
+
+    def _next(self, get, stream):
+        start_time = time.perf_counter()
+        item = get()
+        self.wait_time = time.perf_counter() - start_time
+        self.total_wait_time += self.wait_time
+        if item is _END:
+            return _END
+        if isinstance(item, BaseException):
+            raise item
+        self.num_batches += 1
+        batch, state = item
+        if stream is not None:
+            with torch.cuda.stream(stream):
+                batch = _to_device(batch, self.device)
+        return batch, state
+
+    def _items(self):
+        for batch in self.data_loader:
+            if self.pin_memory:
+                batch = _pin(batch)
+            state = self.data_loader.state_dict() \
+                if hasattr(self.data_loader, 'state_dict') else None
+            yield batch, state
+        yield _END
+
+    def _read(self, queue_, stop):
+        try:
+            for item in self._items():
+                if item is _END:
+                    break
+                while not stop.is_set():
+                    try:
+                        queue_.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = _END
+        except BaseException as e:  # raised in the consumer
+            item = e
+        while not stop.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def state_dict(self):
+        if self._state is not None:
+            return self._state
+        if hasattr(self.data_loader, 'state_dict'):
+            return self.data_loader.state_dict()
+        return {}
+
+    def load_state_dict(self, state):
+        self._state = None
+        self.data_loader.load_state_dict(state)
+
+
+def _map_tensors(x, fn):
+    if isinstance(x, torch.Tensor):
+        return fn(x)
+    if isinstance(x, dict):
+        return {k: _map_tensors(v, fn) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_map_tensors(v, fn) for v in x)
+    if isinstance(x, Instances):
+        ret = Instances(x.image_size)
+        for k, v in x.get_fields().items():
+            ret.set(k, _map_tensors(v, fn))
+        return ret
+    if isinstance(getattr(x, 'tensor', None), torch.Tensor):
+        # Boxes, BitMasks, ...
+        return type(x)(fn(x.tensor))
+    return x
+
+
+def _pin(batch):
+    return _map_tensors(batch, lambda x: x.pin_memory())
+
+
+def _to_device(batch, device):
+    return _map_tensors(batch, lambda x: x.to(device, non_blocking=True))
+
+
+def _record_stream(batch, stream):
+    # keep the caching allocator from reusing the memory while `stream` uses it
+    def record(x):
+        if x.is_cuda:
+            x.record_stream(stream)
+        return x
+    _map_tensors(batch, record)
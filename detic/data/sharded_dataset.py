@@ -0,0 +1,248 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import pickle
+import tarfile
+from collections import defaultdict
+import numpy as np
+import torch.utils.data
+
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["write_shards", "ShardedStreamDataset"]
+
+_FORMAT_VERSION = 1
+_META_FILE = "shards.json"
+# records and images are read in this many bytes per read() call
+_READ_BUFFER = 16 << 20
+
+
+def write_shards(dataset_dicts, out_dir, shard_bytes=256 << 20, prefix="shard"):
+    """
+    Pack `dataset_dicts` and their image files into uncompressed tar shards
+    of about `shard_bytes` each in `out_dir`. Every record is stored as
+    "<index>.pkl" (the dict, polygons as float32 arrays) followed by
+    "<index>.img" (the raw image file). `out_dir/shards.json` lists the
+    shards and the per-category image counts used for repeat factors.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    cat_image_count = defaultdict(int)
+    tag_image_count = defaultdict(int)
+    tar, num_records, num_bytes = None, 0, 0
+    for index, record in enumerate(dataset_dicts):
+        if tar is None:
+            name = "{}-{:05d}.tar".format(prefix, len(shards))
+            tar = tarfile.open(os.path.join(out_dir, name), "w", format=tarfile.GNU_FORMAT)
+        with open(record["file_name"], "rb") as f:
+            image = f.read()
+        record = _compact_record(record)
+        for cat in {obj["category_id"] for obj in record.get("annotations", [])}:
+            cat_image_count[cat] += 1
+        for cat in set(record.get("pos_category_ids", [])):
+            tag_image_count[cat] += 1
+        key = "{:09d}".format(index)
+        _add_member(tar, key + ".pkl", pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        _add_member(tar, key + ".img", image)
+        num_records += 1
+        num_bytes += len(image)
+        if num_bytes >= shard_bytes:
+            tar.close()
+            shards.append({"file": name, "num_records": num_records})
+            tar, num_records, num_bytes = None, 0, 0
+    if tar is not None:
+        tar.close()
+        shards.append({"file": name, "num_records": num_records})
+    meta = {
+        "version": _FORMAT_VERSION,
+        "num_records": sum(x["num_records"] for x in shards),
+        "shards": shards,
+        # json keys are strings
+        "category_image_count": {str(k): v for k, v in cat_image_count.items()},
+        "tag_image_count": {str(k): v for k, v in tag_image_count.items()},
+    }
+    with open(os.path.join(out_dir, _META_FILE), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_shards_meta(shard_dir):
+    with open(os.path.join(shard_dir, _META_FILE)) as f:
+        meta = json.load(f)
+    assert meta["version"] == _FORMAT_VERSION, \
+        "{} has format version {}, expected {}".format(
+            shard_dir, meta["version"], _FORMAT_VERSION)
+    return meta
+
+
+def _compact_record(record):
+    record = dict(record)
+    if "annotations" in record:
+        annos = []
+        for obj in record["annotations"]:
+            obj = dict(obj)
+            segm = obj.get("segmentation")
+            if isinstance(segm, list):
+                obj["segmentation"] = [np.asarray(p, dtype=np.float32) for p in segm]
+            annos.append(obj)
+        record["annotations"] = annos
+    return record
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def read_shard(path, part=0, num_parts=1):
+    """
+    Yields the records of a shard, in order, with the image file content in
+    "image_bytes". The file is read front to back. With `num_parts`, only
+    the records whose position in the shard is `part` modulo `num_parts`
+    are decoded, the members of the others are skipped.
+    """
+    with open(path, "rb", buffering=_READ_BUFFER) as f, \
+            tarfile.open(fileobj=f, mode="r|") as tar:
+        record, i = None, -1
+        for member in tar:
+            if member.name.endswith(".pkl"):
+                i += 1
+            if i % num_parts != part:
+                continue
+            data = tar.extractfile(member).read()
+            if member.name.endswith(".pkl"):
+                record = pickle.loads(data)
+            else:
+                assert record is not None, "{}: {} without a record".format(path, member.name)
+                record["image_bytes"] = data
+                yield record
+                record = None
+
+
+class ShardedStreamDataset(torch.utils.data.IterableDataset):
+    """
+    Infinite stream of the records written by `write_shards`, for datasets
+    whose many small image files are slow to open (network filesystems):
+    every rank and DataLoader worker reads its own shards front to back, in
+    an order reshuffled every pass, and shuffles the records through a
+    buffer of `shuffle_buffer` records per source. A source with fewer
+    shards than streams gives every stream one shard per pass, whose
+    records are split between the streams reading it.
+
+    Sources (one shard directory per training dataset) are drawn with the
+    probabilities of MultiDatasetSampler: proportional to `dataset_ratio`.
+    With `use_rfs[i]` the records of source i are repeated by their repeat
+    factor (LVIS-style, on annotation categories for 'box' sources and on
+    `pos_category_ids` otherwise), floor(r) times plus once more with
+    probability r - floor(r).
+
+    The records carry "image_bytes" instead of reading "file_name", see
+    SamDatasetMapper.
+    """
+    def __init__(
+        self,
+        shard_dirs,
+        dataset_ratio=None,
+        use_rfs=None,
+        dataset_ann=None,
+        repeat_threshold=0.001,
+        shuffle_buffer=1000,
+        seed=None,
+    ):
+        num_sources = len(shard_dirs)
+        self.shard_dirs = shard_dirs
+        self.metas = [load_shards_meta(x) for x in shard_dirs]
+        self.sizes = [x["num_records"] for x in self.metas]
+        dataset_ratio = dataset_ratio or [1] * num_sources
+        assert len(dataset_ratio) == num_sources, \
+            'length of dataset ratio {} should be equal to number if dataset {}'.format(
+                len(dataset_ratio), num_sources)
+        self.source_prob = np.asarray(dataset_ratio, dtype=np.float64) / sum(dataset_ratio)
+        self.use_rfs = use_rfs or [False] * num_sources
+        self.dataset_ann = dataset_ann or ['box'] * num_sources
+        self.repeat_threshold = repeat_threshold
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = int(comm.shared_random_seed() if seed is None else seed)
+        self._rank = comm.get_rank()
+        self._world_size = comm.get_world_size()
+        self.category_repeat = [
+            self._category_repeat(meta, ann) if rfs else None
+            for meta, rfs, ann in zip(self.metas, self.use_rfs, self.dataset_ann)]
+        logger.info("Streaming {} records from {}".format(self.sizes, shard_dirs))
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def _category_repeat(self, meta, dataset_ann):
+        key = "category_image_count" if dataset_ann == 'box' else "tag_image_count"
+        num_images = meta["num_records"]
+        return {int(k): max(1.0, math.sqrt(self.repeat_threshold / (v / num_images)))
+            for k, v in meta[key].items()}
+
+    def _repeat_factor(self, source, record):
+        category_repeat = self.category_repeat[source]
+        if self.dataset_ann[source] == 'box':
+            cats = {obj["category_id"] for obj in record.get("annotations", [])}
+        else:
+            cats = record.get("pos_category_ids", [])
+        return max((category_repeat.get(c, 1.0) for c in cats), default=1.0)
+
+    def _stream_id(self):
+        worker = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        return self._rank * num_workers + worker_id, self._world_size * num_workers
+
+    def _source_records(self, source, stream_id, num_streams):
+        shards = [os.path.join(self.shard_dirs[source], x["file"])
+            for x in self.metas[source]["shards"]]
+        num_shards = len(shards)
+        for epoch in itertools.count():
+            # the same shard order in all the streams of a pass
+            order = np.random.default_rng(
+                [self.seed, source, epoch]).permutation(num_shards)
+            if num_shards >= num_streams:
+                # whole shards per stream
+                for k in order[stream_id::num_streams]:
+                    yield from read_shard(shards[k])
+            else:
+                # fewer shards than streams: the streams sharing a shard
+                # (the same stream_id modulo num_shards) split its records
+                slot = stream_id % num_shards
+                num_parts = len(range(slot, num_streams, num_shards))
+                yield from read_shard(
+                    shards[order[slot]], stream_id // num_shards, num_parts)
+
+    def _shuffled(self, source, records, rng):
+        buffer = []
+        for record in records:
+            num_repeats = 1
+            if self.category_repeat[source] is not None:
+                r = self._repeat_factor(source, record)
+                num_repeats = int(r) + (rng.random() < r - int(r))
+            for _ in range(num_repeats):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(record)
+                    continue
+                i = rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = record
+
+    def __iter__(self):
+        stream_id, num_streams = self._stream_id()
+        rng = np.random.default_rng([self.seed, stream_id])
+        streams = [
+            self._shuffled(source, self._source_records(
+                source, stream_id, num_streams), rng)
+            for source in range(len(self.shard_dirs))]
+        while True:
+            source = int(rng.choice(len(streams), p=self.source_prob))
+            record = dict(next(streams[source]))
+            record["dataset_source"] = source
+            yield record
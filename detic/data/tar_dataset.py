@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # Copyright (c) Facebook, Inc. and its affiliates.
+import collections
 import os
 import gzip
+import mmap
 import numpy as np
 import io
 from PIL import Image
@@ -20,56 +22,65 @@ class DiskTarDataset(Dataset):
         tarfile_path='dataset/imagenet/ImageNet-21k/metadata/tar_files.npy',
         tar_index_dir='dataset/imagenet/ImageNet-21k/metadata/tarindex_npy',
         preload=False, 
-        num_synsets="all"):
+        num_synsets="all",
+        max_open_files=64,
+        access_pattern=''):
         """
         - preload (bool): Recommend to set preload to False when using
         - num_synsets (integer or string "all"): set to small number for debugging
             will load subset of dataset
+        - max_open_files (int): number of tar files each process keeps mapped,
+            the least recently used one is closed when a new one is opened
+        - access_pattern (str): madvise hint for the mapped tar files, one of
+            '' (kernel default), 'random' (no readahead, prefetch each sample)
+            or 'sequential' (aggressive readahead, for in-order reading)
         """
         tar_files = np.load(tarfile_path)
 
-        chunk_datasets = []
-        dataset_lens = []
         if isinstance(num_synsets, int):
             assert num_synsets < len(tar_files)
             tar_files = tar_files[:num_synsets]
-        for tar_file in tar_files:
-            dataset = _TarDataset(tar_file, tar_index_dir, preload=preload)
-            chunk_datasets.append(dataset)
-            dataset_lens.append(len(dataset))
+        if os.path.exists(os.path.join(tar_index_dir, 'tar_index.npy')):
+            # consolidated index of tools/index_tar_files.py
+            labels, block_starts, block_ends = _load_consolidated_index(
+                tar_index_dir, len(tar_files))
+        else:
+            labels, block_starts, block_ends = _load_shard_indexes(
+                tar_files, tar_index_dir)
 
-        self.chunk_datasets = chunk_datasets
-        self.dataset_lens = np.array(dataset_lens).astype(np.int32)
+        self.tar_files = [str(x) for x in tar_files]
+        self.dataset_lens = np.bincount(
+            labels, minlength=len(self.tar_files)).astype(np.int32)
         self.dataset_cumsums = np.cumsum(self.dataset_lens)
-        self.num_samples = sum(self.dataset_lens)
-        labels = np.zeros(self.dataset_lens.sum(), dtype=np.int64)
-        sI = 0
-        for k in range(len(self.dataset_lens)):
-            assert (sI+self.dataset_lens[k]) <= len(labels), f"{k} {sI+self.dataset_lens[k]} vs. {len(labels)}"
-            labels[sI:(sI+self.dataset_lens[k])] = k
-            sI += self.dataset_lens[k]
+        self.num_samples = len(labels)
+        # global index: tar file (== label), first and end 512-byte block
+        # of every sample
         self.labels = labels
+        self.block_starts = block_starts
+        self.block_ends = block_ends
+        self.mmap_pool = _MmapPool(max_open_files, access_pattern)
+        if preload:
+            for tar_file in self.tar_files[:max_open_files]:
+                self.mmap_pool.get(tar_file)
 
     def __len__(self):
         return self.num_samples
 
+    def get_bytes(self, index):
+        """
+        Returns the (gunzipped) file content of sample `index`.
+        """
+        d_index = self.labels[index]
+        return _read_tar_member(
+            self.mmap_pool.get(self.tar_files[d_index]),
+            self.block_starts[index], self.block_ends[index],
+            self.mmap_pool.access_pattern == 'random')
+
     def __getitem__(self, index):
         assert index >= 0 and index < len(self)
-        # find the dataset file we need to go to
-        d_index = np.searchsorted(self.dataset_cumsums, index)
-
-        # edge case, if index is at edge of chunks, move right
-        if index in self.dataset_cumsums:
-            d_index += 1
-
-        assert d_index == self.labels[index], f"{d_index} vs. {self.labels[index]} mismatch for {index}"
-
-        # change index to local dataset index
-        if d_index == 0:
-            local_index = index
-        else:
-            local_index = index - self.dataset_cumsums[d_index - 1]
-        data_bytes = self.chunk_datasets[d_index][local_index]
+        # label is the dataset (synset) we indexed into
+        d_index = int(self.labels[index])
+        data_bytes = io.BytesIO(self.get_bytes(index))
         exception_to_catch = UnidentifiedImageError if unidentified_error_available else Exception
         try:
             image = Image.open(data_bytes).convert("RGB")
@@ -77,13 +88,137 @@ class DiskTarDataset(Dataset):
             image = Image.fromarray(np.ones((224,224,3), dtype=np.uint8)*128)
             d_index = -1
 
-        # label is the dataset (synset) we indexed into
         return image, d_index, index
 
     def __repr__(self):
         st = f"DiskTarDataset(subdatasets={len(self.dataset_lens)},samples={self.num_samples})"
         return st
 
+
+class _MmapPool(object):
+    """
+    LRU cache of read-only mmaps of tar files, holding at most `max_open`
+    file descriptors in each process. A forked dataloader worker starts with
+    an empty pool instead of sharing the parent's mappings.
+    """
+    _MADVISE = {
+        'random': getattr(mmap, 'MADV_RANDOM', None),
+        'sequential': getattr(mmap, 'MADV_SEQUENTIAL', None),
+    }
+
+    def __init__(self, max_open=64, access_pattern=''):
+        assert max_open > 0
+        assert access_pattern in ('', 'random', 'sequential'), access_pattern
+        self.max_open = max_open
+        self.access_pattern = access_pattern
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._mmaps = collections.OrderedDict()
+
+    def get(self, filename):
+        if self._pid != os.getpid():
+            self._reset()
+        mm = self._mmaps.get(filename)
+        if mm is not None:
+            self._mmaps.move_to_end(filename)
+            return mm
+        while len(self._mmaps) >= self.max_open:
+            self._mmaps.popitem(last=False)[1].close()
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        advice = self._MADVISE.get(self.access_pattern)
+        if advice is not None and hasattr(mm, 'madvise'):
+            mm.madvise(advice)
+        self._mmaps[filename] = mm
+        return mm
+
+    def __len__(self):
+        return len(self._mmaps)
+
+    def __getstate__(self):
+        # mmaps can not be pickled (spawned workers), reopen them lazily
+        return {'max_open': self.max_open, 'access_pattern': self.access_pattern}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+
+def _load_shard_indexes(tar_files, tar_index_dir):
+    """
+    Global index from the per-shard `{synset}_names.npy` / `_offsets.npy`
+    files of tools/preprocess_imagenet22k.py.
+    """
+    dataset_lens = []
+    offsets = []
+    for tar_file in tar_files:
+        names, tar_offsets = _load_tar_index(tar_file, tar_index_dir)
+        assert len(tar_offsets) > len(names), tar_file
+        dataset_lens.append(len(names))
+        offsets.append(tar_offsets[:len(names) + 1])
+    labels = np.repeat(np.arange(len(tar_files), dtype=np.int64), dataset_lens)
+    block_starts = np.concatenate(
+        [x[:-1] for x in offsets] + [np.zeros(0)]).astype(np.int64)
+    block_ends = np.concatenate(
+        [x[1:] for x in offsets] + [np.zeros(0)]).astype(np.int64)
+    return labels, block_starts, block_ends
+
+
+def _load_consolidated_index(tar_index_dir, num_tar_files):
+    """
+    Memory-mapped `tar_index.npy` (num_samples x [start block, end block])
+    and `tar_labels.npy` (tar file of each sample, sorted).
+    """
+    tar_index = np.load(os.path.join(tar_index_dir, 'tar_index.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(tar_index_dir, 'tar_labels.npy'), mmap_mode='r')
+    assert len(tar_index) == len(labels)
+    # keep the samples of the first `num_tar_files` tar files
+    num_samples = np.searchsorted(labels, num_tar_files)
+    return labels[:num_samples], tar_index[:num_samples, 0], tar_index[:num_samples, 1]
+
+
+def _load_tar_index(filename, npy_index_dir):
+    basename = os.path.basename(filename)
+    basename = os.path.splitext(basename)[0]
+    names = np.load(os.path.join(npy_index_dir, f"{basename}_names.npy"))
+    offsets = np.load(os.path.join(npy_index_dir, f"{basename}_offsets.npy"))
+    return names, offsets
+
+
+def _tar_member_size(header):
+    size = bytes(header[124:136])
+    if size[0] & 0x80:
+        # GNU base-256 encoding for members larger than 8GB
+        return int.from_bytes(size[1:], 'big')
+    return int(size.rstrip(b'\0 ') or b'0', 8)
+
+
+def _read_tar_member(data, start_block, end_block, prefetch=False):
+    """
+    Read the member whose header starts at 512-byte block `start_block` of
+    the tar file `data` (bytes-like) and ends before `end_block`.
+    """
+    ofs = int(start_block) * 512
+    end = int(end_block) * 512
+    if prefetch and hasattr(data, 'madvise'):
+        aligned = ofs - ofs % mmap.PAGESIZE
+        data.madvise(mmap.MADV_WILLNEED, aligned, min(end, len(data)) - aligned)
+    header = data[ofs:ofs + 512]
+    if header[:13] == b'././@LongLink':
+        # GNU long name: the name follows in its own blocks, then the real header
+        ofs += 512 * (1 + (_tar_member_size(header) + 511) // 512)
+        header = data[ofs:ofs + 512]
+    ofs += 512
+    sdata = data[ofs:min(ofs + _tar_member_size(header), end)]
+    # just to make it more fun a few JPEGs are GZIP compressed...
+    # catch this case
+    if sdata[:2] == b'\x1f\x8b':
+        sdata = gzip.GzipFile(None, 'r', 0, io.BytesIO(sdata)).read()
+    return sdata
+
+
 class _TarDataset(object):
 
     def __init__(self, filename, npy_index_dir, preload=False):
@@ -107,32 +242,13 @@ class _TarDataset(object):
         return self.num_samples
 
     def load_index(self):
-        basename = os.path.basename(self.filename)
-        basename = os.path.splitext(basename)[0]
-        names = np.load(os.path.join(self.npy_index_dir, f"{basename}_names.npy"))
-        offsets = np.load(os.path.join(self.npy_index_dir, f"{basename}_offsets.npy"))
-        return names, offsets
+        return _load_tar_index(self.filename, self.npy_index_dir)
 
     def __getitem__(self, idx):
         if self.data is None:
             self.data = np.memmap(self.filename, mode='r', dtype='uint8')
             _, self.offsets = self.load_index()
 
-        ofs = self.offsets[idx] * 512
-        fsize = 512 * (self.offsets[idx + 1] - self.offsets[idx])
-        data = self.data[ofs:ofs + fsize]
-
-        if data[:13].tostring() == '././@LongLink':
-            data = data[3 * 512:]
-        else:
-            data = data[512:]
-
-        # just to make it more fun a few JPEGs are GZIP compressed...
-        # catch this case
-        if tuple(data[:2]) == (0x1f, 0x8b):
-            s = io.BytesIO(data.tostring())
-            g = gzip.GzipFile(None, 'r', 0, s)
-            sdata = g.read()
-        else:
-            sdata = data.tostring()
-        return io.BytesIO(sdata)
\ No newline at end of file
+        sdata = _read_tar_member(
+            memoryview(self.data), self.offsets[idx], self.offsets[idx + 1])
+        return io.BytesIO(bytes(sdata))
@@ -20,12 +20,49 @@ from detectron2.config import CfgNode
 from detectron2.data import MetadataCatalog
 from detectron2.data.datasets.coco import convert_to_coco_json
 from detectron2.evaluation.coco_evaluation import COCOEvaluator
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json as _instances_to_coco_json
+from detectron2.structures import Instances
 from detectron2.structures import Boxes, BoxMode, pairwise_iou
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import create_small_table
 from ..data.datasets.coco_zeroshot import categories_seen, categories_unseen
 
-class CustomCOCOEvaluator(COCOEvaluator):
+def instances_to_coco_json(instances, img_id):
+    """
+    detectron2's instances_to_coco_json, also reading the masks from the
+    COCO RLEs in `pred_masks_rle` (TEST.MASK_FORMAT 'rle').
+    """
+    if not instances.has("pred_masks_rle"):
+        return _instances_to_coco_json(instances, img_id)
+    fields = instances.get_fields()
+    rles = fields["pred_masks_rle"]
+    results = _instances_to_coco_json(Instances(instances.image_size, **{
+        k: v for k, v in fields.items() if k != "pred_masks_rle"}), img_id)
+    for result, rle in zip(results, rles):
+        # json needs the counts as str
+        result["segmentation"] = dict(rle, counts=rle["counts"].decode("utf-8"))
+    return results
+
+
+class RLECOCOEvaluator(COCOEvaluator):
+    """
+    COCOEvaluator also taking the masks from `pred_masks_rle`, see
+    instances_to_coco_json.
+    """
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            prediction = {"image_id": input["image_id"]}
+
+            if "instances" in output:
+                instances = output["instances"].to(self._cpu_device)
+                prediction["instances"] = instances_to_coco_json(instances, input["image_id"])
+            if "proposals" in output:
+                prediction["proposals"] = output["proposals"].to(self._cpu_device)
+            if len(prediction) > 1:
+                self._predictions.append(prediction)
+
+
+class CustomCOCOEvaluator(RLECOCOEvaluator):
     def _derive_coco_results(self, coco_eval, iou_type, class_names=None):
         """
         Additionally plot mAP for 'seen classes' and 'unseen classes'
@@ -8,7 +8,19 @@ from collections import defaultdict
 import json
 import detectron2.utils.comm as comm
 from detectron2.utils.logger import create_small_table
+from .custom_coco_eval import instances_to_coco_json
 class CustomLVISEvaluator(LVISEvaluator):
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            prediction = {"image_id": input["image_id"]}
+
+            if "instances" in output:
+                instances = output["instances"].to(self._cpu_device)
+                prediction["instances"] = instances_to_coco_json(instances, input["image_id"])
+            if "proposals" in output:
+                prediction["proposals"] = output["proposals"].to(self._cpu_device)
+            self._predictions.append(prediction)
+
     def _eval_box_proposals(self, predictions):
         """
         Evaluate the box proposals in predictions. AP100,300,1000
@@ -59,18 +71,9 @@ class LVISEvaluatorFixedAP(LVISEvaluator):
             image_id = input["image_id"]
             instances = output["instances"].to("cpu")
 
-            scores = instances.scores.tolist()
-            classes = instances.pred_classes.tolist()
-            boxes = instances.pred_boxes.tensor.tolist()
-            masks = instances.pred_masks.tensor.tolist()
-            for score, cls, box in zip(scores, classes, boxes):
-                self.by_cat[cls].append({
-                    "image_id": image_id,
-                    "category_id": cls,
-                    "bbox": box,
-                    "score": score,
-                    "segmentation": masks
-                })
+            # COCO json, xywh boxes and RLE masks
+            for result in instances_to_coco_json(instances, image_id):
+                self.by_cat[result["category_id"]].append(result)
 
     def evaluate(self):
         if self._distributed:
@@ -28,7 +28,7 @@ import pycocotools.mask as mask_utils
 from fvcore.common.file_io import PathManager
 import detectron2.utils.comm as comm
 from detectron2.data import MetadataCatalog
-from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from .custom_coco_eval import instances_to_coco_json
 from detectron2.utils.logger import create_small_table
 from detectron2.evaluation import DatasetEvaluator
 
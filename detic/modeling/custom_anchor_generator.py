@@ -1,2 +1,37 @@
-from detectron2.modeling.anchor_generator import DefaultAnchorGenerator
-from detectron2.modeling.anchor_generator import build_anchor_generator
\ No newline at end of file
+from detectron2.config import configurable
+from detectron2.modeling.anchor_generator import ANCHOR_GENERATOR_REGISTRY, DefaultAnchorGenerator
+from detectron2.modeling.anchor_generator import build_anchor_generator
+from detectron2.structures import Boxes
+from detectron2.utils.events import get_event_storage
+
+from .utils import GeometryCache
+
+
+@ANCHOR_GENERATOR_REGISTRY.register()
+class CachedAnchorGenerator(DefaultAnchorGenerator):
+    """
+    DefaultAnchorGenerator reusing the anchors of the feature map sizes it
+    has seen: the inputs are padded to a fixed size, so the grids are the
+    same every step. Keyed by the grid sizes and the dtype / device of the
+    cell anchors (the strides and cell anchors are fixed per instance).
+    """
+    @configurable
+    def __init__(self, *, cache_size=8, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = GeometryCache(cache_size)
+
+    @classmethod
+    def from_config(cls, cfg, input_shape):
+        ret = super().from_config(cfg, input_shape)
+        ret["cache_size"] = cfg.MODEL.GEOMETRY_CACHE_SIZE
+        return ret
+
+    def forward(self, features):
+        grid_sizes = [tuple(feature_map.shape[-2:]) for feature_map in features]
+        cell_anchors = self.cell_anchors[0]
+        key = (tuple(grid_sizes), tuple(self.strides), cell_anchors.dtype, cell_anchors.device)
+        anchors_over_all_feature_maps = self.cache.get(
+            key, lambda: self._grid_anchors(grid_sizes))
+        if self.training:
+            self.cache.put_scalars(get_event_storage(), "geometry_cache/anchors")
+        return [Boxes(x) for x in anchors_over_all_feature_maps]
@@ -1,4 +1,6 @@
-from typing import List, Union
+from typing import Dict, List, Union
+import torch
+from torch import nn
 from detectron2.modeling.poolers import ROIPooler
 from torch import Tensor
 from detectron2.structures import Boxes
@@ -15,4 +17,68 @@ class customRoiPooler(ROIPooler):
         """
         output = super().forward(x, box_lists)
         pooler_fmt_boxes = convert_boxes_to_pooler_format(box_lists)
-        return output, pooler_fmt_boxes[:,0]
\ No newline at end of file
+        return output, pooler_fmt_boxes[:,0]
+
+
+class FusedROIPooler(nn.Module):
+    """
+    Several ROIPoolers run on the same boxes: the boxes are converted to the
+    pooler format once, the level assignment is computed once per distinct
+    level configuration (from the converted boxes, as assign_boxes_to_levels)
+    and the boxes of every level are dispatched with one host sync per level
+    configuration instead of a nonzero per level. Same outputs as calling
+    the poolers one by one.
+    """
+    def __init__(self, poolers: Dict[str, ROIPooler]):
+        super().__init__()
+        self.poolers = nn.ModuleDict(poolers)
+
+    @staticmethod
+    def _level_key(pooler):
+        return (pooler.min_level, pooler.max_level, pooler.canonical_level, pooler.canonical_box_size)
+
+    @staticmethod
+    def _assign_levels(pooler_fmt_boxes, pooler):
+        boxes = pooler_fmt_boxes[:, 1:]
+        box_sizes = torch.sqrt((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+        level_assignments = torch.floor(
+            pooler.canonical_level + torch.log2(box_sizes / pooler.canonical_box_size + 1e-8))
+        level_assignments = torch.clamp(
+            level_assignments, min=pooler.min_level, max=pooler.max_level)
+        return level_assignments.to(torch.int64) - pooler.min_level
+
+    def forward(self, features: Dict[str, List[Tensor]], box_lists: List[Boxes]) -> Dict[str, Tensor]:
+        """
+        Args:
+            features: the feature maps of every pooler to run, by name
+            box_lists: the boxes of every image, shared by all of them
+
+        Returns:
+            the (M, C, output_size, output_size) output of every pooler in
+            `features`, by name
+        """
+        pooler_fmt_boxes = convert_boxes_to_pooler_format(box_lists)
+        dispatch = {}
+        outputs = {}
+        for name, x in features.items():
+            pooler = self.poolers[name]
+            num_levels = len(pooler.level_poolers)
+            assert len(x) == num_levels, \
+                "{} pooler has {} levels, given {} feature maps".format(name, num_levels, len(x))
+            if num_levels == 1:
+                outputs[name] = pooler.level_poolers[0](x[0], pooler_fmt_boxes)
+                continue
+            key = self._level_key(pooler)
+            if key not in dispatch:
+                levels = self._assign_levels(pooler_fmt_boxes, pooler)
+                counts = torch.bincount(levels, minlength=num_levels).tolist()
+                order = torch.argsort(levels, stable=True)
+                dispatch[key] = list(zip(order.split(counts), counts))
+            output_size = pooler.output_size
+            output = pooler_fmt_boxes.new_zeros(
+                (len(pooler_fmt_boxes), x[0].shape[1]) + tuple(output_size), dtype=x[0].dtype)
+            for level, (inds, count) in enumerate(dispatch[key]):
+                if count:
+                    output[inds] = pooler.level_poolers[level](x[level], pooler_fmt_boxes[inds])
+            outputs[name] = output
+        return outputs
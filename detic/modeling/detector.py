@@ -21,6 +21,8 @@ from torch.cuda.amp import autocast
 import detectron2.utils.comm as comm
 import pickle
 from detic.modeling.utils import load_class_freq
+from detic.modeling.mask_postprocess import masks_to_rles, paste_masks, resized_mask_chunks
+import pycocotools.mask as mask_util
 import sys
 
 @META_ARCH_REGISTRY.register()
@@ -35,6 +37,8 @@ class ClipOpenDetector(GeneralizedRCNN):
         clip_train_size=1024,
         eval_ar= False,
         amp_enabled=True,
+        mask_format='bitmask',
+        mask_chunk_pixels=1 << 24,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -58,6 +62,9 @@ class ClipOpenDetector(GeneralizedRCNN):
         self.clip_train_size = clip_train_size
         self.eval_ar = eval_ar
         self.amp_enabled = amp_enabled
+        assert mask_format in ('bitmask', 'rle'), mask_format
+        self.mask_format = mask_format
+        self.mask_chunk_pixels = mask_chunk_pixels
 
     @classmethod
     def from_config(cls, cfg):
@@ -80,7 +87,9 @@ class ClipOpenDetector(GeneralizedRCNN):
             "mask_thr_binary":cfg.TEST.MASK_THR_BINARY,
             'fpn_in_features': cfg.MODEL.FPN.IN_FEATURES,
             "eval_ar": cfg.EVAL_AR,
-            "amp_enabled": cfg.SOLVER.AMP.ENABLED
+            "amp_enabled": cfg.SOLVER.AMP.ENABLED,
+            "mask_format": cfg.TEST.MASK_FORMAT,
+            "mask_chunk_pixels": cfg.TEST.MASK_CHUNK_PIXELS,
         })
         return ret
     
@@ -95,7 +104,17 @@ class ClipOpenDetector(GeneralizedRCNN):
         if self.do_postprocess:
             assert not torch.jit.is_scripting(), \
                 "Scripting is not supported for postprocess."
-            return GeneralizedRCNN._postprocess(results, batched_inputs, clip_images.image_sizes)
+            processed_results = []
+            for results_per_image, input_per_image, image_size in zip(
+                results, batched_inputs, clip_images.image_sizes
+            ):
+                height = input_per_image.get("height", image_size[0])
+                width = input_per_image.get("width", image_size[1])
+                r = custom_detector_postprocess(
+                    results_per_image, height, width, mask_threshold=self.mask_thr_binary,
+                    mask_format=self.mask_format, chunk_pixels=self.mask_chunk_pixels)
+                processed_results.append({"instances": r})
+            return processed_results
         else:
             return results
             
@@ -170,12 +189,15 @@ class ClipOpenDetector(GeneralizedRCNN):
         ):
             height = input_per_image.get("height")
             width = input_per_image.get("width")
-            r = custom_detector_postprocess(results_per_image, height, width, mask_threshold=mask_threshold)
+            r = custom_detector_postprocess(results_per_image, height, width, mask_threshold=mask_threshold,
+                mask_format=self.mask_format, chunk_pixels=self.mask_chunk_pixels)
             if not self.eval_ar:
                 processed_results.append({"instances": r})
             else: 
                 r.proposal_boxes = r.pred_boxes
-                r.remove('pred_masks')
+                for name in ('pred_masks', 'pred_masks_rle'):
+                    if r.has(name):
+                        r.remove(name)
                 r.remove('pred_boxes')
                 processed_results.append({"proposals": r})
         return processed_results
@@ -232,13 +254,20 @@ class ClipOpenDetector(GeneralizedRCNN):
         
 @torch.jit.unused
 def custom_detector_postprocess(
-    results: Instances, output_height: int, output_width: int, mask_threshold: float = 0.5
+    results: Instances, output_height: int, output_width: int, mask_threshold: float = 0.5,
+    mask_format: str = 'bitmask', chunk_pixels: int = 1 << 24,
 ):
     """
     Inputs: 
         cut padding mask, and resize boxes and masks
-        results: the pred_masks of (1024,1024), results.image_size: (1024, x) or (x,1024)
+        results: the pred_masks of the RoIs (N, 1, M, M) or of the padded
+            input (N, 1, 1024, 1024), results.image_size: (1024, x) or (x,1024)
         output_height, output_width: the original img sie 
+        mask_format: 'bitmask' for (N, output_height, output_width) bool
+            pred_masks, 'rle' for COCO RLEs in pred_masks_rle instead
+        chunk_pixels: masks are pasted / resized a chunk of at most this
+            many output pixels at a time, so that with 'rle' the memory does
+            not grow with the number of detections
     """
     
     if isinstance(output_width, torch.Tensor):
@@ -261,15 +290,31 @@ def custom_detector_postprocess(
         output_boxes = None
     assert output_boxes is not None, "Predictions must contain boxes!"
 
+    output_boxes.scale(output_width_tmp/input_size[1], output_height_tmp/input_size[0])
+    output_boxes.clip(results.image_size)
     results = results[output_boxes.nonempty()]
     if results.has("pred_masks"):
         mask_tensor = results.pred_masks
-        #2. clip up the paddings
-        mask_tensor = mask_tensor[:, :, :input_size[0], :input_size[1]]
-        #3. resize the box and mask, give it to the results
-        mask_tensor = F.interpolate(mask_tensor, size=new_size, mode="bilinear", align_corners=False).squeeze(1)
-        mask_tensor = (mask_tensor>=mask_threshold).to(torch.bool)
-        results.pred_masks = mask_tensor
-    output_boxes.scale(output_width_tmp/input_size[1], output_height_tmp/input_size[0])
-    results.pred_boxes = output_boxes
-    return results
\ No newline at end of file
+        if mask_tensor.shape[-2] >= input_size[0] and mask_tensor.shape[-1] >= input_size[1]:
+            # masks of the padded input: clip up the paddings and resize
+            chunks = resized_mask_chunks(
+                mask_tensor, input_size, new_size, mask_threshold, chunk_pixels)
+            if mask_format == 'rle':
+                results.pred_masks_rle = [
+                    rle for chunk in chunks for rle in mask_util.encode(np.asfortranarray(
+                        chunk.permute(1, 2, 0).cpu().numpy().astype(np.uint8)))]
+            else:
+                results.pred_masks = torch.cat(list(chunks)) if len(mask_tensor) else \
+                    mask_tensor.new_zeros((0,) + tuple(new_size), dtype=torch.bool)
+        else:
+            # RoI masks: paste them into the boxes
+            boxes = results.pred_boxes.tensor
+            if mask_format == 'rle':
+                results.pred_masks_rle = masks_to_rles(
+                    mask_tensor[:, 0], boxes, new_size, mask_threshold, chunk_pixels)
+            else:
+                results.pred_masks = paste_masks(
+                    mask_tensor[:, 0], boxes, new_size, mask_threshold, chunk_pixels)
+        if mask_format == 'rle':
+            results.remove("pred_masks")
+    return results
@@ -258,4 +258,140 @@ def _soft_nms(
         scores = scores[keep]
         idxs = idxs[keep]
 
-    return torch.tensor(idxs_out).to(boxes.device), torch.tensor(scores_out).to(scores.device)
\ No newline at end of file
+    return torch.tensor(idxs_out).to(boxes.device), torch.tensor(scores_out).to(scores.device)
+
+def _box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def _rowwise_iou(top_boxes, boxes):
+    """
+    IoU of `top_boxes` (C, 4) with every box of the same row of `boxes`
+    (C, M, 4), computed as detectron2's pairwise_iou.
+    """
+    top_boxes = top_boxes[:, None]
+    width_height = torch.min(boxes[..., 2:], top_boxes[..., 2:]) - \
+        torch.max(boxes[..., :2], top_boxes[..., :2])
+    inter = width_height.clamp_(min=0).prod(dim=-1)
+    union = _box_area(top_boxes) + _box_area(boxes) - inter
+    return torch.where(inter > 0, inter / union, torch.zeros(1, dtype=inter.dtype, device=inter.device))
+
+
+def _batched_pairwise_iou(boxes):
+    """
+    (C, M, M) IoU of the boxes of every row of `boxes` (C, M, 4) with each
+    other, computed as detectron2's pairwise_iou.
+    """
+    width_height = torch.min(boxes[:, :, None, 2:], boxes[:, None, :, 2:]) - \
+        torch.max(boxes[:, :, None, :2], boxes[:, None, :, :2])
+    inter = width_height.clamp_(min=0).prod(dim=-1)
+    area = _box_area(boxes)
+    union = area[:, :, None] + area[:, None, :] - inter
+    return torch.where(inter > 0, inter / union, torch.zeros(1, dtype=inter.dtype, device=inter.device))
+
+
+def _decay(ious, method, gaussian_sigma, linear_threshold):
+    if method == "linear":
+        return torch.where(ious > linear_threshold, 1 - ious, torch.ones_like(ious))
+    elif method == "gaussian":
+        return torch.exp(-torch.pow(ious, 2) / gaussian_sigma)
+    elif method == "hard":  # standard NMS
+        return (ious < linear_threshold).to(ious.dtype)
+    raise NotImplementedError("{} soft nms method not implemented.".format(method))
+
+
+def _group_by_class(boxes, scores, idxs):
+    # (C, M) layout of the boxes of every class, in their input order; -1 pads
+    _, class_index, counts = torch.unique(idxs, return_inverse=True, return_counts=True)
+    order = torch.argsort(class_index, stable=True)
+    class_of = class_index[order]
+    starts = torch.cumsum(counts, 0) - counts
+    position = torch.arange(len(order), device=boxes.device) - starts[class_of]
+    num_classes, max_count = len(counts), int(counts.max())
+    index = torch.full((num_classes, max_count), -1, dtype=torch.int64, device=boxes.device)
+    index[class_of, position] = order
+    grouped_scores = scores.new_zeros((num_classes, max_count))
+    grouped_scores[class_of, position] = scores[order]
+    grouped_boxes = boxes.new_zeros((num_classes, max_count, 4))
+    grouped_boxes[class_of, position] = boxes[order]
+    return index, grouped_boxes, grouped_scores
+
+
+def batched_soft_nms_parallel(
+    boxes, scores, idxs, method, gaussian_sigma, linear_threshold, prune_threshold
+):
+    """
+    Soft-NMS of every class, as `soft_nms` run on the boxes of each class
+    (i.e. `batched_soft_nms` without the float rounding of the class offsets),
+    with the classes processed in parallel: one step picks the top box of
+    every class and decays the rest of its class, so the number of steps is
+    the largest number of boxes of a class instead of the number of boxes.
+    Same arguments and returns as `batched_soft_nms` (axis aligned boxes),
+    the kept boxes sorted by their decayed scores.
+    """
+    if boxes.numel() == 0:
+        return (
+            torch.empty((0,), dtype=torch.int64, device=boxes.device),
+            torch.empty((0,), dtype=torch.float32, device=scores.device),
+        )
+    index, grouped_boxes, grouped_scores = _group_by_class(boxes, scores, idxs)
+    alive = index >= 0
+    rows = torch.arange(len(index), device=boxes.device)
+    idxs_out, scores_out = [], []
+    for _ in range(index.shape[1]):
+        top_scores, top = torch.where(
+            alive, grouped_scores, grouped_scores.new_tensor(float("-inf"))).max(dim=1)
+        has_top = alive[rows, top]
+        if not has_top.any():
+            break
+        idxs_out.append(torch.where(has_top, index[rows, top], index.new_tensor(-1)))
+        scores_out.append(top_scores)
+        alive[rows, top] = False
+        ious = _rowwise_iou(grouped_boxes[rows, top], grouped_boxes)
+        grouped_scores = grouped_scores * _decay(ious, method, gaussian_sigma, linear_threshold)
+        alive &= grouped_scores > prune_threshold
+    idxs_out, scores_out = torch.cat(idxs_out), torch.cat(scores_out)
+    kept = idxs_out >= 0
+    idxs_out, scores_out = idxs_out[kept], scores_out[kept]
+    order = torch.argsort(scores_out, descending=True, stable=True)
+    return idxs_out[order], scores_out[order]
+
+
+def batched_matrix_soft_nms(
+    boxes, scores, idxs, method, gaussian_sigma, linear_threshold, prune_threshold
+):
+    """
+    Matrix-decay Soft-NMS (Matrix NMS of SOLOv2, arXiv:2003.10152) in one
+    pass: every box is decayed by all the higher scored boxes of its class
+    at once, each decay divided by the decay that higher scored box itself
+    got from its own highest-overlapping box (with the same `method`
+    penalty as Soft-NMS; 'hard' is not supported). An approximation of the
+    sequential Soft-NMS with no loop; takes a (classes, M, M) IoU tensor, M
+    the largest number of boxes of a class.
+    Same arguments and returns as `batched_soft_nms` (axis aligned boxes).
+    """
+    assert method in ("linear", "gaussian"), method
+    if boxes.numel() == 0:
+        return (
+            torch.empty((0,), dtype=torch.int64, device=boxes.device),
+            torch.empty((0,), dtype=torch.float32, device=scores.device),
+        )
+    order = torch.argsort(scores, descending=True, stable=True)
+    # every class in decreasing score order
+    index, grouped_boxes, grouped_scores = _group_by_class(
+        boxes[order], scores[order], idxs[order])
+    valid = index >= 0
+    index = torch.where(valid, order[index.clamp(min=0)], index)
+    ious = _batched_pairwise_iou(grouped_boxes)
+    # ious[c, i, j]: j decayed by the higher scored i
+    ious = (ious * valid[:, :, None]).triu_(diagonal=1)
+    compensate = ious.max(dim=1).values
+    decay = _decay(ious, method, gaussian_sigma, linear_threshold) / \
+        _decay(compensate, method, gaussian_sigma, linear_threshold)[:, :, None]
+    decay = torch.where(
+        ious > 0, decay, torch.ones_like(decay)).min(dim=1).values.clamp_(max=1)
+    grouped_scores = grouped_scores * decay
+    kept = valid & (grouped_scores > prune_threshold)
+    index, scores = index[kept], grouped_scores[kept]
+    resorted = torch.argsort(scores, descending=True, stable=True)
+    return index[resorted], scores[resorted]
@@ -0,0 +1,142 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+import torch.nn.functional as F
+
+__all__ = [
+    "paste_mask_regions", "region_to_rle", "paste_masks", "masks_to_rles",
+    "resized_mask_chunks",
+]
+
+
+def _box_regions(boxes, height, width):
+    # integer pixel ranges covering the boxes, one pixel more on every side
+    # as detectron2's paste_masks_in_image
+    x0 = (torch.floor(boxes[:, 0]) - 1).clamp(min=0, max=width).long()
+    y0 = (torch.floor(boxes[:, 1]) - 1).clamp(min=0, max=height).long()
+    x1 = (torch.ceil(boxes[:, 2]) + 1).clamp(min=0, max=width).long()
+    y1 = (torch.ceil(boxes[:, 3]) + 1).clamp(min=0, max=height).long()
+    x1 = torch.max(x0, x1)
+    y1 = torch.max(y0, y1)
+    return torch.stack([x0, y0, x1, y1], dim=1).tolist()
+
+
+def _chunks(regions, chunk_pixels):
+    # consecutive masks whose regions, padded to the largest one, fit in
+    # chunk_pixels (a single larger region is a chunk by itself)
+    start, max_h, max_w = 0, 0, 0
+    for i, (x0, y0, x1, y1) in enumerate(regions):
+        h, w = max(max_h, y1 - y0), max(max_w, x1 - x0)
+        if i > start and (i + 1 - start) * h * w > chunk_pixels:
+            yield start, i, max_h, max_w
+            start, h, w = i, y1 - y0, x1 - x0
+        max_h, max_w = h, w
+    if start < len(regions):
+        yield start, len(regions), max_h, max_w
+
+
+def paste_mask_regions(masks, boxes, image_shape, threshold=0.5, chunk_pixels=1 << 24):
+    """
+    Paste the (N, M, M) mask probabilities `masks` into the `boxes` (N, 4,
+    XYXY_ABS) of an image of `image_shape` (height, width), sampled as
+    detectron2's paste_masks_in_image, but only inside the region of every
+    box and for as many masks at a time as fit in `chunk_pixels`.
+
+    Yields (index, (x0, y0, x1, y1), bool tensor of the region) in order; the
+    image outside the region is empty (the values there are below 0.5 of the
+    border of the mask, so exact for threshold >= 0.5).
+    """
+    height, width = int(image_shape[0]), int(image_shape[1])
+    if len(masks) == 0:
+        return
+    boxes = boxes.to(torch.float32)
+    regions = _box_regions(boxes, height, width)
+    for start, end, max_h, max_w in _chunks(regions, chunk_pixels):
+        if max_h == 0 or max_w == 0:
+            for i in range(start, end):
+                yield i, regions[i], torch.zeros(
+                    (regions[i][3] - regions[i][1], regions[i][2] - regions[i][0]),
+                    dtype=torch.bool, device=masks.device)
+            continue
+        origin = torch.tensor(
+            [regions[i][:2] for i in range(start, end)], dtype=torch.float32, device=masks.device)
+        x0, y0, x1, y1 = boxes[start:end].unbind(dim=1)
+        img_x = torch.arange(max_w, device=masks.device, dtype=torch.float32) + 0.5
+        img_y = torch.arange(max_h, device=masks.device, dtype=torch.float32) + 0.5
+        img_x = (img_x[None] + origin[:, :1] - x0[:, None]) / (x1 - x0)[:, None] * 2 - 1
+        img_y = (img_y[None] + origin[:, 1:] - y0[:, None]) / (y1 - y0)[:, None] * 2 - 1
+        num = end - start
+        grid = torch.stack([
+            img_x[:, None, :].expand(num, max_h, max_w),
+            img_y[:, :, None].expand(num, max_h, max_w)], dim=3)
+        pasted = F.grid_sample(
+            masks[start:end, None].to(torch.float32), grid, align_corners=False)[:, 0]
+        pasted = pasted >= threshold
+        for i in range(start, end):
+            rx0, ry0, rx1, ry1 = regions[i]
+            yield i, regions[i], pasted[i - start, :ry1 - ry0, :rx1 - rx0]
+
+
+def region_to_rle(region, x0, y0, height, width):
+    """
+    The compressed COCO RLE of a (height, width) mask that is `region` (a
+    bool array) at (x0, y0) and empty elsewhere, without the dense mask.
+    """
+    region = np.asarray(region, dtype=np.uint8)
+    rh, rw = region.shape
+    if region.size == 0 or not region.any():
+        counts = [height * width]
+    else:
+        # column-major runs of the full-height columns x0 .. x0 + rw
+        stripe = np.zeros((rw, height), dtype=np.uint8)
+        stripe[:, y0:y0 + rh] = region.T
+        flat = stripe.ravel()
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate([[0], changes, [len(flat)]])).tolist()
+        if flat[0]:
+            counts.insert(0, 0)
+        counts[0] += x0 * height
+        trailing = (width - x0 - rw) * height
+        if not flat[-1]:
+            counts[-1] += trailing
+        elif trailing:
+            counts.append(trailing)
+    return mask_util.frPyObjects({"counts": counts, "size": [height, width]}, height, width)
+
+
+def paste_masks(masks, boxes, image_shape, threshold=0.5, chunk_pixels=1 << 24):
+    """
+    (N, height, width) bool masks, see `paste_mask_regions`.
+    """
+    height, width = int(image_shape[0]), int(image_shape[1])
+    ret = torch.zeros((len(masks), height, width), dtype=torch.bool, device=masks.device)
+    for i, (x0, y0, x1, y1), region in paste_mask_regions(
+            masks, boxes, image_shape, threshold, chunk_pixels):
+        ret[i, y0:y1, x0:x1] = region
+    return ret
+
+
+def masks_to_rles(masks, boxes, image_shape, threshold=0.5, chunk_pixels=1 << 24):
+    """
+    COCO RLEs of the masks, see `paste_mask_regions`; the memory does not
+    grow with the number of masks.
+    """
+    height, width = int(image_shape[0]), int(image_shape[1])
+    return [region_to_rle(region.cpu().numpy(), x0, y0, height, width)
+        for _, (x0, y0, _, _), region in paste_mask_regions(
+            masks, boxes, image_shape, threshold, chunk_pixels)]
+
+
+def resized_mask_chunks(masks, input_size, output_size, threshold=0.5, chunk_pixels=1 << 24):
+    """
+    Full image (N, 1, H, W) mask probabilities, cropped to `input_size` and
+    resized to `output_size`, as bool masks of as many masks at a time as fit
+    in `chunk_pixels`.
+    """
+    chunk = max(1, chunk_pixels // max(int(output_size[0]) * int(output_size[1]), 1))
+    for start in range(0, len(masks), chunk):
+        x = masks[start:start + chunk, :, :input_size[0], :input_size[1]].to(torch.float32)
+        x = F.interpolate(x, size=tuple(int(s) for s in output_size),
+            mode="bilinear", align_corners=False)[:, 0]
+        yield x >= threshold
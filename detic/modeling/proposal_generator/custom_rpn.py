@@ -10,6 +10,7 @@ from detectron2.utils.memory import retry_if_cuda_oom
 # rpn changing objectness loss, use centerness loss
 from detectron2.layers import Conv2d, ShapeSpec, cat, diou_loss, ciou_loss
 from ..layers.custom_batchnorm import get_norm
+from ..custom_anchor_generator import CachedAnchorGenerator
 from typing import Dict, List, Union
 import torch
 from fvcore.nn import giou_loss, smooth_l1_loss
@@ -29,6 +30,62 @@ class CustomStandardRPNHead(StandardRPNHead):
     
 @PROPOSAL_GENERATOR_REGISTRY.register()
 class CustomRPN(RPN):
+    @configurable
+    def __init__(
+        self,
+        *,
+        adaptive_topk_test: str = "",
+        adaptive_topk_thresh: float = 0.5,
+        adaptive_topk_mass: float = 0.9,
+        adaptive_topk_min: int = 50,
+        **kwargs
+    ):
+        """
+        Args:
+            adaptive_topk_test: "" keeps post_nms_topk proposals of every
+                test image; "threshold" keeps the ones whose objectness
+                probability is at least adaptive_topk_thresh, "mass" the
+                fewest top ones that hold adaptive_topk_mass of the summed
+                objectness probability of the post_nms_topk proposals.
+                Either way at least adaptive_topk_min and at most
+                post_nms_topk.
+        """
+        super().__init__(**kwargs)
+        assert adaptive_topk_test in ("", "threshold", "mass"), adaptive_topk_test
+        self.adaptive_topk_test = adaptive_topk_test
+        self.adaptive_topk_thresh = adaptive_topk_thresh
+        self.adaptive_topk_mass = adaptive_topk_mass
+        self.adaptive_topk_min = adaptive_topk_min
+
+    @classmethod
+    def from_config(cls, cfg, input_shape):
+        ret = super().from_config(cfg, input_shape)
+        if cfg.MODEL.ANCHOR_GENERATOR.NAME == "DefaultAnchorGenerator":
+            # the same anchors, reused across steps
+            ret["anchor_generator"] = CachedAnchorGenerator(
+                cfg, [input_shape[f] for f in cfg.MODEL.RPN.IN_FEATURES])
+        ret.update({
+            "adaptive_topk_test": cfg.MODEL.RPN.ADAPTIVE_TOPK_TEST,
+            "adaptive_topk_thresh": cfg.MODEL.RPN.ADAPTIVE_TOPK_THRESH,
+            "adaptive_topk_mass": cfg.MODEL.RPN.ADAPTIVE_TOPK_MASS,
+            "adaptive_topk_min": cfg.MODEL.RPN.ADAPTIVE_TOPK_MIN,
+        })
+        return ret
+
+    def predict_proposals(self, anchors, pred_objectness_logits, pred_anchor_deltas, image_sizes):
+        """
+        The proposals of find_top_rpn_proposals, cut to the adaptive number
+        of every image at test time.
+        """
+        proposals = super().predict_proposals(
+            anchors, pred_objectness_logits, pred_anchor_deltas, image_sizes)
+        if self.training or not self.adaptive_topk_test:
+            return proposals
+        num_proposals = adaptive_num_proposals(
+            [p.objectness_logits for p in proposals], self.adaptive_topk_test,
+            self.adaptive_topk_thresh, self.adaptive_topk_mass, self.adaptive_topk_min)
+        return [p[:n] for p, n in zip(proposals, num_proposals)]
+
     @torch.jit.unused
     def losses(
         self,
@@ -78,7 +135,28 @@ class CustomRPN(RPN):
         }
         losses = {k: v * self.loss_weight.get(k, 1.0) for k, v in losses.items()}
         return losses
-    
+
+
+def adaptive_num_proposals(objectness_logits, mode, thresh=0.5, mass=0.9, min_num=50):
+    """
+    Number of proposals to keep of every image, given its objectness logits
+    sorted in decreasing order (as the proposals after the RPN NMS), see
+    CustomRPN. One host sync for the whole batch.
+    """
+    counts = []
+    for logits in objectness_logits:
+        probs = logits.sigmoid()
+        if mode == "threshold":
+            counts.append((probs >= thresh).sum())
+        elif mode == "mass":
+            cum_probs = probs.cumsum(0)
+            target = cum_probs[-1:] * mass if len(probs) else cum_probs.new_zeros(1)
+            counts.append(torch.searchsorted(cum_probs, target)[0] + 1)
+        else:
+            raise ValueError(f"Invalid adaptive proposal mode '{mode}'")
+    counts = torch.stack(counts).tolist() if counts else []
+    return [max(min(n, len(l)), min(min_num, len(l))) for n, l in zip(counts, objectness_logits)]
+
 
 def dense_box_regression_loss(
     anchors: List[Union[Boxes, torch.Tensor]],
@@ -91,48 +169,37 @@ def dense_box_regression_loss(
 ):
     """
     add huber loss
+
+    Only the foreground anchors of every image are encoded / decoded: the
+    anchors, deltas and targets are gathered first, in one batched call.
     """
     if isinstance(anchors[0], Boxes):
         anchors = type(anchors[0]).cat(anchors).tensor  # (R, 4)
     else:
         anchors = cat(anchors)
+    # (M, 4) over the M foreground anchors, in the order of fg_mask[fg_mask]
+    fg_anchors = anchors[fg_mask.nonzero(as_tuple=True)[1]]
+    fg_pred_deltas = cat(pred_anchor_deltas, dim=1)[fg_mask]
+    fg_gt_boxes = cat([k[m] for k, m in zip(gt_boxes, fg_mask)])
     if box_reg_loss_type == "smooth_l1":
-        gt_anchor_deltas = [box2box_transform.get_deltas(anchors, k) for k in gt_boxes]
-        gt_anchor_deltas = torch.stack(gt_anchor_deltas)  # (N, R, 4)
         loss_box_reg = smooth_l1_loss(
-            cat(pred_anchor_deltas, dim=1)[fg_mask],
-            gt_anchor_deltas[fg_mask],
+            fg_pred_deltas,
+            box2box_transform.get_deltas(fg_anchors, fg_gt_boxes),
             beta=smooth_l1_beta,
             reduction="sum",
         )
     elif box_reg_loss_type == "giou":
-        pred_boxes = [
-            box2box_transform.apply_deltas(k, anchors) for k in cat(pred_anchor_deltas, dim=1)
-        ]
-        loss_box_reg = giou_loss(
-            torch.stack(pred_boxes)[fg_mask], torch.stack(gt_boxes)[fg_mask], reduction="sum"
-        )
+        pred_boxes = box2box_transform.apply_deltas(fg_pred_deltas, fg_anchors)
+        loss_box_reg = giou_loss(pred_boxes, fg_gt_boxes, reduction="sum")
     elif box_reg_loss_type == "diou":
-        pred_boxes = [
-            box2box_transform.apply_deltas(k, anchors) for k in cat(pred_anchor_deltas, dim=1)
-        ]
-        loss_box_reg = diou_loss(
-            torch.stack(pred_boxes)[fg_mask], torch.stack(gt_boxes)[fg_mask], reduction="sum"
-        )
+        pred_boxes = box2box_transform.apply_deltas(fg_pred_deltas, fg_anchors)
+        loss_box_reg = diou_loss(pred_boxes, fg_gt_boxes, reduction="sum")
     elif box_reg_loss_type == "ciou":
-        pred_boxes = [
-            box2box_transform.apply_deltas(k, anchors) for k in cat(pred_anchor_deltas, dim=1)
-        ]
-        loss_box_reg = ciou_loss(
-            torch.stack(pred_boxes)[fg_mask], torch.stack(gt_boxes)[fg_mask], reduction="sum"
-        )
+        pred_boxes = box2box_transform.apply_deltas(fg_pred_deltas, fg_anchors)
+        loss_box_reg = ciou_loss(pred_boxes, fg_gt_boxes, reduction="sum")
     elif box_reg_loss_type == 'huber': 
-        pred_boxes = [
-            box2box_transform.apply_deltas(k, anchors) for k in cat(pred_anchor_deltas, dim=1)
-        ]
-        loss_box_reg = huber_loss(
-            torch.stack(pred_boxes)[fg_mask], torch.stack(gt_boxes)[fg_mask], reduction="mean"
-        )
+        pred_boxes = box2box_transform.apply_deltas(fg_pred_deltas, fg_anchors)
+        loss_box_reg = huber_loss(pred_boxes, fg_gt_boxes, reduction="mean")
     else:
         raise ValueError(f"Invalid dense box regression loss type '{box_reg_loss_type}'")
     return loss_box_reg
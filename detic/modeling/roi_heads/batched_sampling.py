@@ -0,0 +1,101 @@
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+__all__ = ["batched_pairwise_iou", "pad_boxes", "batched_match", "batched_subsample_labels"]
+
+
+def _box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def batched_pairwise_iou(gt_boxes, proposal_boxes, gt_valid=None):
+    """
+    (B, G, P) IoU of the (B, G, 4) ground truth with the (B, P, 4) proposals
+    of every image, computed as detectron2's pairwise_iou; -1 on the rows of
+    the padded ground truth (`gt_valid` False), which overlap nothing.
+    """
+    # contiguous (B, G, 1) and (B, 1, P) coordinates rather than the strided
+    # (..., 2) pairs of pairwise_intersection; the same arithmetic
+    g = gt_boxes.permute(2, 0, 1).contiguous()[..., None]
+    p = proposal_boxes.permute(2, 0, 1).contiguous()[:, :, None]
+    width = torch.min(g[2], p[2]).sub_(torch.max(g[0], p[0])).clamp_(min=0)
+    height = torch.min(g[3], p[3]).sub_(torch.max(g[1], p[1])).clamp_(min=0)
+    inter = width.mul_(height)
+    union = (_box_area(gt_boxes)[:, :, None] + _box_area(proposal_boxes)[:, None, :]).sub_(inter)
+    iou = torch.div(inter, union, out=union)
+    if gt_valid is None:
+        empty = torch.zeros(1, dtype=inter.dtype, device=inter.device)
+    else:
+        empty = (gt_valid.to(inter.dtype) - 1)[:, :, None]
+    return torch.where(inter > 0, iou, empty)
+
+
+def pad_boxes(box_tensors):
+    """
+    The (B, max N, 4) zero padded boxes and the (B, max N) mask of the real
+    ones.
+    """
+    lengths = torch.as_tensor([len(b) for b in box_tensors], device=box_tensors[0].device)
+    padded = pad_sequence(box_tensors, batch_first=True)
+    valid = torch.arange(padded.shape[1], device=padded.device)[None] < lengths[:, None]
+    return padded, valid
+
+
+def batched_match(matcher, match_quality_matrix, gt_valid):
+    """
+    detectron2's Matcher on the padded (B, G, P) matrix of
+    batched_pairwise_iou (the padded ground truth rows are negative), with
+    the same matches and labels on the real proposals as running `matcher`
+    on every image (images without ground truth get the default match 0 and
+    label `matcher.labels[0]`).
+
+    Returns:
+        matches (B, P) int64, match_labels (B, P) int8
+    """
+    B, G, P = match_quality_matrix.shape
+    if G == 0:
+        matches = match_quality_matrix.new_zeros((B, P), dtype=torch.int64)
+        return matches, matches.new_full(matches.size(), matcher.labels[0], dtype=torch.int8)
+    # padded ground truth never wins: the real qualities are >= 0
+    matched_vals, matches = match_quality_matrix.max(dim=1)
+    match_labels = matches.new_full(matches.size(), 1, dtype=torch.int8)
+    for (l, low, high) in zip(matcher.labels, matcher.thresholds[:-1], matcher.thresholds[1:]):
+        low_high = (matched_vals >= low) & (matched_vals < high)
+        match_labels[low_high] = l
+    if matcher.allow_low_quality_matches:
+        # the padded proposals (0 with every real ground truth) do not change
+        # the highest quality of a real ground truth, which is >= 0
+        highest_quality_foreach_gt = match_quality_matrix.max(dim=2, keepdim=True).values
+        highest_quality_foreach_gt.masked_fill_(~gt_valid[:, :, None], float('inf'))
+        low_quality = (match_quality_matrix == highest_quality_foreach_gt).any(dim=1)
+        match_labels[low_quality] = 1
+    has_gt = gt_valid.any(dim=1)[:, None]
+    matches = matches.masked_fill(~has_gt, 0)
+    match_labels = match_labels.masked_fill(~has_gt, matcher.labels[0])
+    return matches, match_labels
+
+
+def batched_subsample_labels(labels, valid, num_samples, positive_fraction, bg_label):
+    """
+    detectron2's subsample_labels on every row of the (B, P) labels: at most
+    num_samples * positive_fraction positives (not -1 nor bg_label), filled
+    up with negatives (bg_label), each drawn uniformly without replacement,
+    by the top-k of random keys.
+
+    Returns:
+        (list of sampled positive indices, list of sampled negative indices)
+        of every image
+    """
+    positive = (labels != -1) & (labels != bg_label) & valid
+    negative = (labels == bg_label) & valid
+    max_pos = int(num_samples * positive_fraction)
+    num_pos = positive.sum(dim=1).clamp(max=max_pos)
+    num_neg = negative.sum(dim=1).clamp(max=num_samples - num_pos)
+    keys = torch.rand(labels.shape, device=labels.device)
+    pos_idx = torch.where(positive, keys, keys.new_full((), -1.)).topk(
+        min(max_pos, labels.shape[1]), dim=1).indices
+    neg_idx = torch.where(negative, keys, keys.new_full((), -1.)).topk(
+        min(num_samples, labels.shape[1]), dim=1).indices
+    counts = torch.stack([num_pos, num_neg], dim=1).tolist()
+    return [p[:n] for p, (n, _) in zip(pos_idx, counts)], \
+        [q[:n] for q, (_, n) in zip(neg_idx, counts)]
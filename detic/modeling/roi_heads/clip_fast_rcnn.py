@@ -2,7 +2,7 @@
 import logging
 import torch
 import torch.nn as nn
-from typing import  List, Tuple
+from typing import  List, Optional, Tuple
 from fvcore.nn import giou_loss, smooth_l1_loss
 
 from detectron2.layers import cat
@@ -18,6 +18,7 @@ from ...data.datasets.coco_zeroshot import get_contigous_ids
 from ...data.datasets.lvis_v1_zeroshot import get_contigous_ids_lvis
 import torch.nn.functional as F
 from detectron2.utils.events import get_event_storage
+from ..layers.soft_nms import batched_soft_nms_parallel, batched_matrix_soft_nms
 
 __all__ = ["ClipRCNNOutputLayers"]
 logger = logging.getLogger(__name__)
@@ -43,6 +44,14 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         background_weight: float,
         use_focal_ce: bool,
         dataset: str,
+        sparse_fed_loss: bool = True,
+        nms_type: str = 'hard',
+        soft_nms_method: str = 'linear',
+        soft_nms_sigma: float = 0.5,
+        soft_nms_prune: float = 0.001,
+        max_candidates_test: int = 0,
+        class_agnostic_nms: bool = False,
+        topk_classes_per_box: int = 0,
         **kwargs
     ):
         super().__init__(input_shape, **kwargs)
@@ -95,6 +104,18 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         self.register_buffer('text_feats', text_feats)
         self.register_buffer('text_feats_base', text_feats_base)
         self.use_focal_ce = use_focal_ce
+        self.sparse_fed_loss = sparse_fed_loss
+        assert nms_type in ('hard', 'soft', 'matrix'), nms_type
+        self.nms_type = nms_type
+        self.soft_nms_method = soft_nms_method
+        self.soft_nms_sigma = soft_nms_sigma
+        self.soft_nms_prune = soft_nms_prune
+        self.max_candidates_test = max_candidates_test
+        self.class_agnostic_nms = class_agnostic_nms
+        # class agnostic matrix NMS takes a dense IoU over all the candidates
+        assert not (class_agnostic_nms and nms_type == 'matrix') or max_candidates_test > 0, \
+            'CLASS_AGNOSTIC_NMS with NMS_TYPE matrix needs a positive MAX_CANDIDATES_TEST'
+        self.topk_classes_per_box = topk_classes_per_box
 
     @classmethod
     def from_config(cls, cfg, input_shape):
@@ -115,6 +136,14 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         ret['test_pooler'] = test_pooler
         ret['use_focal_ce'] = cfg.MODEL.ROI_BOX_HEAD.USE_FOCAL_CE
         ret['dataset'] = cfg.DATASETS.TRAIN[0]
+        ret['sparse_fed_loss'] = cfg.MODEL.ROI_BOX_HEAD.SPARSE_FED_LOSS
+        ret['nms_type'] = cfg.MODEL.ROI_HEADS.NMS_TYPE
+        ret['soft_nms_method'] = cfg.MODEL.ROI_HEADS.SOFT_NMS_METHOD
+        ret['soft_nms_sigma'] = cfg.MODEL.ROI_HEADS.SOFT_NMS_SIGMA
+        ret['soft_nms_prune'] = cfg.MODEL.ROI_HEADS.SOFT_NMS_PRUNE
+        ret['max_candidates_test'] = cfg.MODEL.ROI_HEADS.MAX_CANDIDATES_TEST
+        ret['class_agnostic_nms'] = cfg.MODEL.ROI_HEADS.CLASS_AGNOSTIC_NMS
+        ret['topk_classes_per_box'] = cfg.MODEL.ROI_HEADS.TOPK_CLASSES_PER_BOX
         return ret 
     
     def forward(self,x):
@@ -187,6 +216,9 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         """
         if pred_class_logits.numel() == 0:
             return pred_class_logits.new_zeros([1])[0]
+        if self.use_fed_loss and self.sparse_fed_loss:
+            return self.sparse_fed_sigmoid_cross_entropy_loss(
+                pred_class_logits, gt_classes, consider_background)
 
         N = pred_class_logits.shape[0]
         K = pred_class_logits.shape[1] - 1
@@ -217,6 +249,32 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
             weight = 1
         loss = torch.sum(cls_loss * weight) / N
         return loss
+
+    def sparse_fed_sigmoid_cross_entropy_loss(
+            self, pred_class_logits, gt_classes, consider_background=False):
+        """
+        The federated sigmoid CE of sigmoid_cross_entropy_loss on the N x S
+        logits of the S sampled classes only (which include the ground truth
+        classes), instead of an N x K loss masked down to them; the gradient of
+        the gather goes to those columns only.
+        With `consider_background` the background column is always included.
+        """
+        N = pred_class_logits.shape[0]
+        K = pred_class_logits.shape[1] - 1
+        fed_loss_classes = self.get_fed_loss_classes(
+            gt_classes,
+            num_fed_loss_classes=self.fed_loss_num_classes,
+            num_classes=K,
+            weight=self.fed_loss_cls_weights,
+        )
+        fed_loss_classes = fed_loss_classes[fed_loss_classes < K]
+        if consider_background:
+            fed_loss_classes = torch.cat(
+                [fed_loss_classes, fed_loss_classes.new_full((1,), K)])
+        logits = pred_class_logits[:, fed_loss_classes]
+        target = (gt_classes[:, None] == fed_loss_classes[None, :]).to(logits.dtype)
+        cls_loss = F.binary_cross_entropy_with_logits(logits, target, reduction="sum")
+        return cls_loss / N
     
     def softmax_focal_loss(self, inputs, targets, gamma=0.5, reduction="mean"):
         """Inspired by RetinaNet implementation"""
@@ -294,9 +352,11 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
 
     def inference(self, predictions: Tuple[torch.Tensor, torch.Tensor], 
                   proposals: List[Instances], clip_feats: torch.Tensor,
-                  attenpool: nn.AdaptiveAvgPool2d):
+                  attenpool: nn.AdaptiveAvgPool2d, vlm_box_features: Optional[torch.Tensor] = None):
         """
         align vlm_box_features with text_feats
+        vlm_box_features: the proposals pooled from clip_feats by test_pooler,
+            if already done (see samAnchorPromptRoiHeads.fused_roi_pooler)
         """
         boxes = self.predict_boxes(predictions, proposals)
         scores = self.predict_probs(predictions, proposals) # already softmax or sigmoid
@@ -305,7 +365,8 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         proposal_boxes = [p.proposal_boxes for p in proposals]
     
         # vlm_box_features = self.test_pooler([clip_feats], [Boxes(box) for box in boxes])
-        vlm_box_features = self.test_pooler([clip_feats], proposal_boxes)
+        if vlm_box_features is None:
+            vlm_box_features = self.test_pooler([clip_feats], proposal_boxes)
 
         # vlm pooler layer: clip attenpool
         vlm_box_features = attenpool(vlm_box_features.half())
@@ -381,6 +442,10 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         # 1. Filter results based on detection scores. It can make NMS more efficient
         #    by filtering out low-confidence detections.
         filter_mask = ensembled_scores > self.test_score_thresh  # R x K
+        if 0 < self.topk_classes_per_box < filter_mask.shape[1]:
+            # only the top k classes of every box are candidates
+            topk_classes = ensembled_scores.topk(self.topk_classes_per_box, dim=1).indices
+            filter_mask &= torch.zeros_like(filter_mask).scatter_(1, topk_classes, True)
         # R' x 2. First column contains indices of the R predictions;
         # Second column contains indices of classes.
         filter_inds = filter_mask.nonzero()
@@ -389,9 +454,24 @@ class ClipRCNNOutputLayers(FastRCNNOutputLayers):
         else:
             boxes = boxes[filter_mask]
         ensembled_scores = ensembled_scores[filter_mask]
+        if 0 < self.max_candidates_test < len(ensembled_scores):
+            # the NMS time and memory grow with the candidates: keep the top
+            # scored ones
+            ensembled_scores, top = ensembled_scores.topk(self.max_candidates_test)
+            boxes, filter_inds = boxes[top], filter_inds[top]
 
-        # 2. Apply NMS for each class independently.
-        keep = batched_nms(boxes, ensembled_scores, filter_inds[:, 1], self.test_nms_thresh)
+        # 2. Apply NMS for each class independently (or across the classes).
+        nms_classes = torch.zeros_like(filter_inds[:, 1]) if self.class_agnostic_nms \
+            else filter_inds[:, 1]
+        if self.nms_type == 'hard':
+            keep = batched_nms(boxes, ensembled_scores, nms_classes, self.test_nms_thresh)
+        else:
+            # the scores are decayed instead of removing the overlapping boxes
+            soft_nms = batched_soft_nms_parallel if self.nms_type == 'soft' else batched_matrix_soft_nms
+            keep, soft_scores = soft_nms(
+                boxes, ensembled_scores, nms_classes, self.soft_nms_method,
+                self.soft_nms_sigma, self.test_nms_thresh, self.soft_nms_prune)
+            ensembled_scores[keep] = soft_scores.to(ensembled_scores.dtype)
         if self.test_topk_per_image >= 0:
             keep = keep[:self.test_topk_per_image]
         boxes, ensembled_scores, filter_inds = boxes[keep], ensembled_scores[keep], filter_inds[keep]
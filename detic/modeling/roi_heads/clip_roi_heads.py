@@ -7,7 +7,13 @@ from detectron2.modeling.roi_heads import select_foreground_proposals, ROIHeads
 from detectron2.modeling.poolers import ROIPooler
 from detectron2.structures import Instances, Boxes
 from detectron2.modeling.matcher import Matcher
+from detectron2.modeling.proposal_generator.proposal_utils import add_ground_truth_to_proposals
+from torch.nn.utils.rnn import pad_sequence
 from .clip_fast_rcnn import ClipRCNNOutputLayers
+from ..utils import GeometryCache
+from ..custom_poolers import FusedROIPooler
+from .batched_sampling import batched_pairwise_iou, pad_boxes, batched_match, batched_subsample_labels
+from detectron2.utils.events import get_event_storage
 from torch import Tensor
 import math
 import inspect
@@ -30,12 +36,22 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         roi_prompter: str = "",
         roi_prompter_fuse_type: str = "",
         add_fpn_pe: bool = False,
+        geometry_cache_size: int = 8,
+        fused_pooler: bool = True,
+        batched_sampling: bool = True,
         **kwargs
     ):
         """
         NOTE: this interface is experimental.
         Args:
             positional_encoding: added to FPN features
+            geometry_cache_size: number of FPN shapes whose interpolated
+                positional encodings are kept
+            fused_pooler: at test time, pool the FPN box features and the
+                res5 VLM features of the proposals in one FusedROIPooler
+                call, and the mask features through it as well
+            batched_sampling: match and sample the proposals of all images
+                of the batch at once, see label_and_sample_proposals
         """
         super().__init__(**kwargs)
         for name, value in locals().items():
@@ -44,6 +60,13 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
             else:
                 setattr(self, name, value)
         self.generator_pe = SinePositionalEncoding(num_feats=128, normalize=True)
+        self.pe_cache = GeometryCache(geometry_cache_size)
+        self.fused_roi_pooler = None
+        if fused_pooler:
+            poolers = {'box': self.box_pooler, 'vlm': self.box_predictor.test_pooler}
+            if getattr(self, 'mask_pooler', None) is not None:
+                poolers['mask'] = self.mask_pooler
+            self.fused_roi_pooler = FusedROIPooler(poolers)
 
     @classmethod
     def from_config(cls, cfg, input_shape):
@@ -70,6 +93,9 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         ret['roi_prompter'] = cfg.MODEL.ROI_MASK_HEAD.ROI_PROMPTER
         ret['roi_prompter_fuse_type'] = cfg.MODEL.ROI_MASK_HEAD.ROI_PROMPTER_FUSE_TYPE
         ret['add_fpn_pe'] = cfg.MODEL.FPN.ADD_PE
+        ret['geometry_cache_size'] = cfg.MODEL.GEOMETRY_CACHE_SIZE
+        ret['fused_pooler'] = cfg.MODEL.ROI_HEADS.FUSED_POOLER
+        ret['batched_sampling'] = cfg.MODEL.ROI_HEADS.BATCHED_SAMPLING
         return ret
     
     @classmethod
@@ -82,6 +108,52 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         ################
         return ret
 
+    @torch.no_grad()
+    def label_and_sample_proposals(self, proposals: List[Instances], targets: List[Instances]) -> List[Instances]:
+        """
+        StandardROIHeads.label_and_sample_proposals with the proposals and
+        ground truth padded to the largest image of the batch: one batched
+        IoU and matching (the same matches and labels as the Matcher on every
+        image, including the low quality matches) and the positives and
+        negatives sampled by the top-k of random keys.
+        """
+        if not self.batched_sampling or type(self.proposal_matcher) is not Matcher:
+            return super().label_and_sample_proposals(proposals, targets)
+        if self.proposal_append_gt:
+            proposals = add_ground_truth_to_proposals(targets, proposals)
+        proposal_boxes, proposal_valid = pad_boxes([x.proposal_boxes.tensor for x in proposals])
+        gt_boxes, gt_valid = pad_boxes([x.gt_boxes.tensor for x in targets])
+        matches, match_labels = batched_match(
+            self.proposal_matcher, batched_pairwise_iou(gt_boxes, proposal_boxes, gt_valid), gt_valid)
+        if gt_valid.shape[1]:
+            gt_classes = pad_sequence([x.gt_classes for x in targets], batch_first=True)
+            gt_classes = gt_classes.gather(1, matches)
+        else:
+            gt_classes = matches.clone()
+        gt_classes[match_labels == 0] = self.num_classes
+        gt_classes[match_labels == -1] = -1
+        gt_classes[~gt_valid.any(dim=1)] = self.num_classes
+        fg_inds, bg_inds = batched_subsample_labels(
+            gt_classes, proposal_valid, self.batch_size_per_image,
+            self.positive_fraction, self.num_classes)
+
+        proposals_with_gt = []
+        for i, (proposals_per_image, targets_per_image) in enumerate(zip(proposals, targets)):
+            sampled_idxs = torch.cat([fg_inds[i], bg_inds[i]], dim=0)
+            proposals_per_image = proposals_per_image[sampled_idxs]
+            proposals_per_image.gt_classes = gt_classes[i, sampled_idxs]
+            if len(targets_per_image) > 0:
+                sampled_targets = matches[i, sampled_idxs]
+                for (trg_name, trg_value) in targets_per_image.get_fields().items():
+                    if trg_name.startswith("gt_") and not proposals_per_image.has(trg_name):
+                        proposals_per_image.set(trg_name, trg_value[sampled_targets])
+            proposals_with_gt.append(proposals_per_image)
+
+        storage = get_event_storage()
+        storage.put_scalar("roi_head/num_fg_samples", sum(len(x) for x in fg_inds) / len(fg_inds))
+        storage.put_scalar("roi_head/num_bg_samples", sum(len(x) for x in bg_inds) / len(bg_inds))
+        return proposals_with_gt
+
     def _forward_box(self, attenpool, clip_final_feats: torch.Tensor, 
                      fpn_feats: Dict[str, torch.Tensor], 
                      proposals: List[Instances]):
@@ -90,7 +162,14 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         clip_feats: [bsz, 2048, 32, 32]
         """
         features = [fpn_feats[f] for f in self.box_in_features]
-        box_features = self.box_pooler(features, [x.proposal_boxes for x in proposals])
+        proposal_boxes = [x.proposal_boxes for x in proposals]
+        vlm_box_features = None
+        if self.training or self.fused_roi_pooler is None:
+            box_features = self.box_pooler(features, proposal_boxes)
+        else:
+            pooled = self.fused_roi_pooler(
+                {'box': features, 'vlm': [clip_final_feats]}, proposal_boxes)
+            box_features, vlm_box_features = pooled['box'], pooled['vlm']
         box_features = self.box_head(box_features) # here, box
         predictions = self.box_predictor(box_features)
         del box_features
@@ -108,10 +187,37 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         else:
             # propsal_boxes is relative to the original image size.
             # roi align will assign level
-            pred_instances, _ = self.box_predictor.inference(predictions, proposals, clip_final_feats, attenpool)
+            pred_instances, _ = self.box_predictor.inference(
+                predictions, proposals, clip_final_feats, attenpool, vlm_box_features)
             return pred_instances
+
+    def _forward_mask(self, features: Dict[str, torch.Tensor], instances: List[Instances]):
+        """
+        At test time, pool the mask features of the predicted boxes with the
+        fused pooler.
+        """
+        if self.training or self.fused_roi_pooler is None \
+                or 'mask' not in self.fused_roi_pooler.poolers:
+            return super()._forward_mask(features, instances)
+        if not self.mask_on:
+            return instances
+        features = [features[f] for f in self.mask_in_features]
+        mask_features = self.fused_roi_pooler(
+            {'mask': features}, [x.pred_boxes for x in instances])['mask']
+        return self.mask_head(mask_features, instances)
         
 
+    def _fpn_pe(self, x):
+        """
+        The positional encoding of the last level, interpolated to every
+        level; (1, C, h, w) each, the same for all images of the batch.
+        """
+        _, _, h, w = x[-1].shape
+        mask_pe = torch.zeros((1, h, w), device=x[0].device, dtype=torch.bool)
+        img_feat_pe = self.generator_pe(mask_pe)
+        return [torch.nn.functional.interpolate(img_feat_pe, size=item.shape[-2:], mode='bilinear', align_corners=False)
+            for item in x]
+
     def forward( 
             self,
             clip_features,
@@ -133,11 +239,14 @@ class samAnchorPromptRoiHeads(StandardROIHeads):
         ###########
         if self.add_fpn_pe:
             x = [item[1] for item in list(clip_fpn_feats.items())]
-            bs, _, h, w = x[-1].shape
-            mask_pe = torch.zeros((bs, h, w), device=x[0].device, dtype=torch.bool)
-            img_feat_pe = self.generator_pe(mask_pe)
+            level_pe = self.pe_cache.get(
+                (tuple(tuple(item.shape[-2:]) for item in x), x[0].dtype, x[0].device,
+                    torch.is_autocast_enabled()),
+                lambda: self._fpn_pe(x))
+            if self.training:
+                self.pe_cache.put_scalars(get_event_storage(), "geometry_cache/fpn_pe")
             for i in range(len(x)):
-                x[i] = x[i] + torch.nn.functional.interpolate(img_feat_pe, size=x[i].shape[-2:], mode='bilinear', align_corners=False)
+                x[i] = x[i] + level_pe[i]
             clip_fpn_feats = {list(clip_fpn_feats.keys())[i]: x[i] for i in range(len(clip_fpn_feats))}
         ############
         if self.training:
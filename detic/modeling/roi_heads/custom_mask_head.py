@@ -1,7 +1,9 @@
 from detectron2.modeling.roi_heads import MaskRCNNConvUpsampleHead, ROI_MASK_HEAD_REGISTRY, BaseMaskRCNNHead
+from detectron2.modeling.roi_heads.mask_head import mask_rcnn_inference, mask_rcnn_loss
 from detectron2.config import configurable
 from detectron2.layers import Conv2d, ConvTranspose2d, ShapeSpec, cat
 from ..layers.custom_batchnorm import get_norm
+import torch
 from torch import nn
 import fvcore.nn.weight_init as weight_init
 
@@ -9,10 +11,16 @@ import fvcore.nn.weight_init as weight_init
 class CustomMaskRCNNConvUpsampleHead(MaskRCNNConvUpsampleHead):
     '''
     add norm after deconv
+
+    With gathered_predictor, only the channel of its ground truth
+    (training) or predicted (inference) class is computed for every RoI,
+    which is the one channel mask_rcnn_loss / mask_rcnn_inference read.
     '''
     @configurable
-    def __init__(self, input_shape: ShapeSpec, *, num_classes, conv_dims, conv_norm="", **kwargs):
+    def __init__(self, input_shape: ShapeSpec, *, num_classes, conv_dims, conv_norm="",
+            gathered_predictor=False, **kwargs):
         BaseMaskRCNNHead.__init__(self, **kwargs)
+        self.gathered_predictor = gathered_predictor and num_classes > 1
         nn.Sequential.__init__(self)
         assert len(conv_dims) >= 1, "conv_dims have to be non-empty!"
 
@@ -49,3 +57,40 @@ class CustomMaskRCNNConvUpsampleHead(MaskRCNNConvUpsampleHead):
         nn.init.normal_(self.predictor.weight, std=0.001)
         if self.predictor.bias is not None:
             nn.init.constant_(self.predictor.bias, 0)
+
+    @classmethod
+    def from_config(cls, cfg, input_shape):
+        ret = super().from_config(cfg, input_shape)
+        ret["gathered_predictor"] = cfg.MODEL.ROI_MASK_HEAD.GATHERED_PREDICTOR
+        return ret
+
+    def forward(self, x, instances):
+        if not self.gathered_predictor:
+            return super().forward(x, instances)
+        for layer in self:
+            if layer is not self.predictor:
+                x = layer(x)
+        if self.training:
+            classes = cat([i.gt_classes for i in instances])
+        else:
+            classes = cat([i.pred_classes for i in instances])
+        # (R, 1, Hmask, Wmask): read as a class-agnostic prediction by the
+        # loss and inference
+        x = self.gathered_layer(x, classes)
+        if self.training:
+            return {"loss_mask": mask_rcnn_loss(x, instances, self.vis_period) * self.loss_weight}
+        else:
+            mask_rcnn_inference(x, instances)
+            return instances
+
+    def gathered_layer(self, x, classes):
+        """
+        The `classes[i]` channel of `self.predictor(x)[i]`: the 1x1 conv
+        weights of the class of every RoI, applied with one batched matmul.
+        """
+        num_rois, channels, height, width = x.shape
+        weight = self.predictor.weight.view(-1, channels)[classes]  # R x C
+        x = torch.bmm(weight.unsqueeze(1), x.reshape(num_rois, channels, height * width))
+        if self.predictor.bias is not None:
+            x = x + self.predictor.bias[classes].view(num_rois, 1, 1)
+        return x.view(num_rois, 1, height, width)
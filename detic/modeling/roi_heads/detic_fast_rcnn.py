@@ -8,6 +8,7 @@ import torch
 from fvcore.nn import giou_loss, smooth_l1_loss
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 import fvcore.nn.weight_init as weight_init
 import detectron2.utils.comm as comm
 from detectron2.config import configurable
@@ -334,75 +335,60 @@ class DeticFastRCNNOutputLayers(FastRCNNOutputLayers):
         Inputs:
             scores: N x (C + 1)
             image_labels B x 1
+
+        The losses of all (image, label) pairs are computed at once, see
+        _image_label_pair_losses; the pool statistics are those of the last
+        pair, as before, computed once.
         '''
         num_inst_per_image = [len(p) for p in proposals]
         scores = predictions[0]
-        scores = scores.split(num_inst_per_image, dim=0) # B x n x (C + 1)
-        if self.with_softmax_prop:
-            prop_scores = predictions[2].split(num_inst_per_image, dim=0)
-        else:
-            prop_scores = [None for _ in num_inst_per_image]
-        B = len(scores)
-        img_box_count = 0
-        select_size_count = 0
-        select_x_count = 0
-        select_y_count = 0
-        max_score_count = 0
+        prop_scores = predictions[2] if self.with_softmax_prop else None
+        B = len(num_inst_per_image)
         storage = get_event_storage()
-        loss = scores[0].new_zeros([1])[0]
-        caption_loss = scores[0].new_zeros([1])[0]
-        for idx, (score, labels, prop_score, p) in enumerate(zip(
-            scores, image_labels, prop_scores, proposals)):
-            if score.shape[0] == 0:
-                loss += score.new_zeros([1])[0]
-                continue
-            if 'caption' in ann_type:
-                score, caption_loss_img = self._caption_loss(
+        loss = scores.new_zeros([1])[0]
+        caption_loss = scores.new_zeros([1])[0]
+        if 'caption' in ann_type:
+            for idx, score in enumerate(scores.split(num_inst_per_image, dim=0)):
+                if score.shape[0] == 0:
+                    continue
+                _, caption_loss_img = self._caption_loss(
                     score, classifier_info, idx, B)
                 caption_loss += self.caption_weight * caption_loss_img
-                if ann_type == 'caption':
+            # the class columns, as split by _caption_loss
+            scores = scores[:, :scores.shape[1] - classifier_info[2].shape[0]]
+
+        # (image, label) pairs of the images with proposals; every image
+        # weighs its labels by 1 / len(labels)
+        pair_img, pair_label, pair_weight = [], [], []
+        if ann_type != 'caption':
+            for idx, (n, labels) in enumerate(zip(num_inst_per_image, image_labels)):
+                if n == 0 or len(labels) == 0:
                     continue
-
+                pair_img.extend([idx] * len(labels))
+                pair_label.extend(labels)
+                pair_weight.extend([1. / len(labels)] * len(labels))
+        if self.debug:
+            for p in proposals:
+                p.selected = scores.new_zeros((len(p),), dtype=torch.long) - 1
+
+        stats = None
+        if len(pair_img):
+            if self.dynamic_classifier and pair_img[0] == 0 and comm.is_main_process():
+                storage.put_scalar('stats_label', pair_label[0])
+            pair_img = torch.as_tensor(pair_img, device=scores.device)
+            pair_label = torch.as_tensor(pair_label, device=scores.device)
+            pair_weight = torch.as_tensor(pair_weight, dtype=scores.dtype, device=scores.device)
+            if self.dynamic_classifier:
+                pair_label = classifier_info[1][1][pair_label]
+                assert pair_label.max().item() < scores.shape[1]
+            pair_losses, rows = self._image_label_pair_losses(
+                scores, prop_scores, num_inst_per_image, pair_img, pair_label, proposals)
+            loss = loss + (pair_losses * pair_weight).sum()
             if self.debug:
-                p.selected = score.new_zeros(
-                    (len(p),), dtype=torch.long) - 1
-            for i_l, label in enumerate(labels):
-                if self.dynamic_classifier:
-                    if idx == 0 and i_l == 0 and comm.is_main_process():
-                        storage.put_scalar('stats_label', label)
-                    label = classifier_info[1][1][label]
-                    assert label < score.shape[1]
-                if self.image_label_loss in ['wsod', 'wsddn']: 
-                    loss_i, ind = self._wsddn_loss(score, prop_score, label)
-                elif self.image_label_loss == 'max_score':
-                    loss_i, ind = self._max_score_loss(score, label)
-                elif self.image_label_loss == 'max_size':
-                    loss_i, ind = self._max_size_loss(score, label, p)
-                elif self.image_label_loss == 'first':
-                    loss_i, ind = self._first_loss(score, label)
-                elif self.image_label_loss == 'image':
-                    loss_i, ind = self._image_loss(score, label)
-                elif self.image_label_loss == 'min_loss':
-                    loss_i, ind = self._min_loss_loss(score, label)
-                else:
-                    assert 0
-                loss += loss_i / len(labels)
-                if type(ind) == type([]):
-                    img_box_count = sum(ind) / len(ind)
-                    if self.debug:
-                        for ind_i in ind:
-                            p.selected[ind_i] = label
-                else:
-                    img_box_count = ind
-                    select_size_count = p[ind].proposal_boxes.area() / \
-                        (p.image_size[0] * p.image_size[1])
-                    max_score_count = score[ind, label].sigmoid()
-                    select_x_count = (p.proposal_boxes.tensor[ind, 0] + \
-                        p.proposal_boxes.tensor[ind, 2]) / 2 / p.image_size[1]
-                    select_y_count = (p.proposal_boxes.tensor[ind, 1] + \
-                        p.proposal_boxes.tensor[ind, 3]) / 2 / p.image_size[0]
-                    if self.debug:
-                        p.selected[ind] = label
+                offsets = np.cumsum([0] + num_inst_per_image)
+                for idx, row, label in zip(pair_img.tolist(), rows.tolist(), pair_label.tolist()):
+                    proposals[idx].selected[row - offsets[idx]] = label
+            stats = (pair_img[-1], rows[-1], pair_label[-1])
 
         loss = loss / B
         storage.put_scalar('stats_l_image', loss.item())
@@ -411,6 +397,19 @@ class DeticFastRCNNOutputLayers(FastRCNNOutputLayers):
             loss = loss + caption_loss
             storage.put_scalar('stats_l_caption', caption_loss.item())
         if comm.is_main_process():
+            img_box_count, select_size_count, select_x_count, \
+                select_y_count, max_score_count = 0, 0, 0, 0, 0
+            if stats is not None:
+                idx, row, label = (x.item() for x in stats)
+                p = proposals[idx]
+                ind = row - sum(num_inst_per_image[:idx])
+                box = p.proposal_boxes.tensor[ind]
+                img_box_count = ind
+                select_size_count = ((box[2] - box[0]) * (box[3] - box[1])).item() / \
+                    (p.image_size[0] * p.image_size[1])
+                max_score_count = scores[row, label].sigmoid().item()
+                select_x_count = ((box[0] + box[2]) / 2 / p.image_size[1]).item()
+                select_y_count = ((box[1] + box[3]) / 2 / p.image_size[0]).item()
             storage.put_scalar('pool_stats', img_box_count)
             storage.put_scalar('stats_select_size', select_size_count)
             storage.put_scalar('stats_select_x', select_x_count)
@@ -419,8 +418,106 @@ class DeticFastRCNNOutputLayers(FastRCNNOutputLayers):
 
         return {
             'image_loss': loss * self.image_loss_weight,
-            'loss_cls': score.new_zeros([1])[0],
-            'loss_box_reg': score.new_zeros([1])[0]}
+            'loss_cls': scores.new_zeros([1])[0],
+            'loss_box_reg': scores.new_zeros([1])[0]}
+
+
+    def _image_label_pair_losses(self, scores, prop_scores, num_inst_per_image,
+        pair_img, pair_label, proposals):
+        """
+        The image label loss of every (image, label) pair (K,) and the row of
+        `scores` (N x (C + 1), all images) it selects (K,):
+            max_size: the largest proposal but the last (the image box),
+                binary cross entropy (or cross entropy with
+                softmax_weak_loss) of its scores with the one-hot label
+            max_score: binary cross entropy of the scores of the proposal with
+                the highest label score with the one-hot label
+            first / image: the same on the first / last proposal
+            wsod / wsddn: binary cross entropy (mean over classes) of the
+                image scores, the sum over the proposals of the scores
+                weighted by the softmax of prop_scores, with the one-hot
+                label; selects the proposal with the highest weighted score
+            min_loss: _min_loss_loss, per pair
+
+        A binary cross entropy against the one-hot label is the sum against
+        all zeros, computed once per selected row, with the term of the
+        label swapped for the one against 1 (the same values up to the order
+        of the float sums).
+        """
+        counts = torch.as_tensor(num_inst_per_image, device=scores.device)
+        offsets = counts.cumsum(0) - counts
+        pair_offset = offsets[pair_img]
+        if self.image_label_loss in ['wsod', 'wsddn']:
+            assert prop_scores is not None
+            final_scores = cat([score.sigmoid() * F.softmax(prop_score, dim=0)
+                for score, prop_score in zip(scores.split(num_inst_per_image, dim=0),
+                    prop_scores.split(num_inst_per_image, dim=0))], dim=0)
+            img_scores = torch.stack([torch.clamp(
+                torch.sum(final_score, dim=0), min=1e-10, max=1-1e-10)
+                for final_score in final_scores.split(num_inst_per_image, dim=0)])
+            ind = self._segment_argmax(
+                final_scores.detach(), pair_offset, counts[pair_img], pair_label)
+            losses = self._one_hot_bce_sums(
+                img_scores, pair_img, pair_label, F.binary_cross_entropy) / img_scores.shape[1]
+            return losses, pair_offset + ind
+        if self.image_label_loss == 'min_loss':
+            losses, rows = [], []
+            for img, label, offset, n in zip(pair_img.tolist(), pair_label.tolist(),
+                    pair_offset.tolist(), counts[pair_img].tolist()):
+                loss_i, ind = self._min_loss_loss(scores[offset:offset + n], label)
+                losses.append(loss_i)
+                rows.append(offset + ind)
+            return torch.stack(losses), torch.as_tensor(rows, device=scores.device)
+
+        if self.image_label_loss == 'max_size':
+            # the largest proposal but the last one (the image box)
+            sizes = pad_sequence(cat([p.proposal_boxes.area() for p in proposals]).split(
+                num_inst_per_image), batch_first=True, padding_value=float('-inf'))
+            sizes = sizes.masked_fill(torch.arange(sizes.shape[1], device=sizes.device)[None] >= \
+                (counts - 1)[:, None], float('-inf'))
+            ind = sizes.argmax(dim=1)[pair_img]
+        elif self.image_label_loss == 'max_score':
+            ind = self._segment_argmax(
+                scores.detach(), pair_offset, counts[pair_img], pair_label)
+        elif self.image_label_loss == 'first':
+            ind = torch.zeros_like(pair_offset)
+        elif self.image_label_loss == 'image':
+            assert self.add_image_box
+            ind = counts[pair_img] - 1
+        else:
+            assert 0
+        rows = pair_offset + ind
+        unique_rows, pair_row = torch.unique(rows, return_inverse=True)
+        if self.softmax_weak_loss and self.image_label_loss == 'max_size':
+            losses = -F.log_softmax(scores[unique_rows], dim=1)[pair_row, pair_label]
+        else:
+            losses = self._one_hot_bce_sums(
+                scores[unique_rows], pair_row, pair_label, F.binary_cross_entropy_with_logits)
+        return losses, rows
+
+
+    @staticmethod
+    def _segment_argmax(values, pair_offset, pair_count, pair_label):
+        """
+        values[offset:offset + count, label].argmax() of every pair.
+        """
+        arange = torch.arange(int(pair_count.max()), device=values.device)
+        rows = (pair_offset[:, None] + arange[None]).clamp(max=values.shape[0] - 1)
+        column = values[rows, pair_label[:, None]]
+        column = column.masked_fill(arange[None] >= pair_count[:, None], float('-inf'))
+        return column.argmax(dim=1)
+
+
+    @staticmethod
+    def _one_hot_bce_sums(x, pair_row, pair_label, bce):
+        """
+        bce(x[row], one-hot label, reduction='sum') of every pair.
+        """
+        zeros = x.new_zeros(()).expand_as(x)
+        sums = bce(x, zeros, reduction='none').sum(dim=1)
+        x_l = x[pair_row, pair_label]
+        return sums[pair_row] - bce(x_l, torch.zeros_like(x_l), reduction='none') + \
+            bce(x_l, torch.ones_like(x_l), reduction='none')
 
 
     def forward(self, x, classifier_info=(None,None,None)):
@@ -494,31 +591,6 @@ class DeticFastRCNNOutputLayers(FastRCNNOutputLayers):
         return score, caption_loss_img
 
 
-    def _wsddn_loss(self, score, prop_score, label):
-        assert prop_score is not None
-        loss = 0
-        final_score = score.sigmoid() * \
-            F.softmax(prop_score, dim=0) # B x (C + 1)
-        img_score = torch.clamp(
-            torch.sum(final_score, dim=0), 
-            min=1e-10, max=1-1e-10) # (C + 1)
-        target = img_score.new_zeros(img_score.shape) # (C + 1)
-        target[label] = 1.
-        loss += F.binary_cross_entropy(img_score, target)
-        ind = final_score[:, label].argmax()
-        return loss, ind
-
-
-    def _max_score_loss(self, score, label):
-        loss = 0
-        target = score.new_zeros(score.shape[1])
-        target[label] = 1.
-        ind = score[:, label].argmax().item()
-        loss += F.binary_cross_entropy_with_logits(
-            score[ind], target, reduction='sum')
-        return loss, ind
-
-
     def _min_loss_loss(self, score, label):
         loss = 0
         target = score.new_zeros(score.shape)
@@ -532,43 +604,6 @@ class DeticFastRCNNOutputLayers(FastRCNNOutputLayers):
         return loss, ind
 
 
-    def _first_loss(self, score, label):
-        loss = 0
-        target = score.new_zeros(score.shape[1])
-        target[label] = 1.
-        ind = 0
-        loss += F.binary_cross_entropy_with_logits(
-            score[ind], target, reduction='sum')
-        return loss, ind
-
-
-    def _image_loss(self, score, label):
-        assert self.add_image_box
-        target = score.new_zeros(score.shape[1])
-        target[label] = 1.
-        ind = score.shape[0] - 1
-        loss = F.binary_cross_entropy_with_logits(
-            score[ind], target, reduction='sum')
-        return loss, ind
-
-
-    def _max_size_loss(self, score, label, p):
-        loss = 0
-        target = score.new_zeros(score.shape[1])
-        target[label] = 1.
-        sizes = p.proposal_boxes.area()
-        ind = sizes[:-1].argmax().item() if len(sizes) > 1 else 0
-        if self.softmax_weak_loss:
-            loss += F.cross_entropy(
-                score[ind:ind+1], 
-                score.new_tensor(label, dtype=torch.long).view(1), 
-                reduction='sum')
-        else:
-            loss += F.binary_cross_entropy_with_logits(
-                score[ind], target, reduction='sum')
-        return loss, ind
-
-
 
 def put_label_distribution(storage, hist_name, hist_counts, num_classes):
     """
@@ -13,6 +13,7 @@ from detectron2.config import configurable
 from detectron2.layers import ShapeSpec
 from detectron2.layers import batched_nms
 from detectron2.structures import Boxes, Instances, pairwise_iou
+from detectron2.structures.boxes import matched_pairwise_iou
 from detectron2.utils.events import get_event_storage
 
 from detectron2.modeling.box_regression import Box2BoxTransform
@@ -39,6 +40,10 @@ class DeticCascadeROIHeads(CascadeROIHeads):
         add_feature_to_prop: bool = False,
         mask_weight: float = 1.0,
         one_class_per_proposal: bool = False,
+        early_exit: bool = False,
+        early_exit_bg_thresh: float = 0.01,
+        early_exit_fg_thresh: float = 0.9,
+        early_exit_box_iou: float = 0.95,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -50,6 +55,10 @@ class DeticCascadeROIHeads(CascadeROIHeads):
         self.add_feature_to_prop = add_feature_to_prop
         self.mask_weight = mask_weight
         self.one_class_per_proposal = one_class_per_proposal
+        self.early_exit = early_exit
+        self.early_exit_bg_thresh = early_exit_bg_thresh
+        self.early_exit_fg_thresh = early_exit_fg_thresh
+        self.early_exit_box_iou = early_exit_box_iou
 
     @classmethod
     def from_config(cls, cfg, input_shape):
@@ -63,6 +72,10 @@ class DeticCascadeROIHeads(CascadeROIHeads):
             'add_feature_to_prop': cfg.MODEL.ROI_BOX_HEAD.ADD_FEATURE_TO_PROP,
             'mask_weight': cfg.MODEL.ROI_HEADS.MASK_WEIGHT,
             'one_class_per_proposal': cfg.MODEL.ROI_HEADS.ONE_CLASS_PER_PROPOSAL,
+            'early_exit': cfg.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT,
+            'early_exit_bg_thresh': cfg.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_BG_THRESH,
+            'early_exit_fg_thresh': cfg.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_FG_THRESH,
+            'early_exit_box_iou': cfg.MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT_BOX_IOU,
         })
         return ret
 
@@ -89,6 +102,7 @@ class DeticCascadeROIHeads(CascadeROIHeads):
         """
         Add mult proposal scores at testing
         Add ann_type
+        Add early exit at testing
         """
         if (not self.training) and self.mult_proposal_score:
             if len(proposals) > 0 and proposals[0].has('scores'):
@@ -101,6 +115,12 @@ class DeticCascadeROIHeads(CascadeROIHeads):
         prev_pred_boxes = None
         image_sizes = [x.image_size for x in proposals]
 
+        if (not self.training) and self.early_exit:
+            scores, boxes = self._run_stages_early_exit(
+                features, proposals, classifier_info=classifier_info)
+            return self._box_inference(scores, boxes, proposal_scores \
+                if self.mult_proposal_score else None, image_sizes)
+
         for k in range(self.num_cascade_stages):
             if k > 0:
                 proposals = self._create_proposals_from_boxes(
@@ -146,23 +166,100 @@ class DeticCascadeROIHeads(CascadeROIHeads):
                 sum(list(scores_per_image)) * (1.0 / self.num_cascade_stages)
                 for scores_per_image in zip(*scores_per_stage)
             ]
-            if self.mult_proposal_score:
-                scores = [(s * ps[:, None]) ** 0.5 \
-                    for s, ps in zip(scores, proposal_scores)]
-            if self.one_class_per_proposal:
-                scores = [s * (s == s[:, :-1].max(dim=1)[0][:, None]).float() for s in scores]
             predictor, predictions, proposals = head_outputs[-1]
             boxes = predictor.predict_boxes(
                 (predictions[0], predictions[1]), proposals)
-            pred_instances, _ = fast_rcnn_inference(
-                boxes,
-                scores,
-                image_sizes,
-                predictor.test_score_thresh,
-                predictor.test_nms_thresh,
-                predictor.test_topk_per_image,
-            )
-            return pred_instances
+            return self._box_inference(scores, boxes, proposal_scores \
+                if self.mult_proposal_score else None, image_sizes)
+
+
+    def _box_inference(self, scores, boxes, proposal_scores, image_sizes):
+        """
+        fast_rcnn_inference of the stage averaged scores and the boxes of
+        every proposal, with the proposal scores (mult_proposal_score) and
+        one_class_per_proposal applied
+        """
+        if proposal_scores is not None:
+            scores = [(s * ps[:, None]) ** 0.5 \
+                for s, ps in zip(scores, proposal_scores)]
+        if self.one_class_per_proposal:
+            scores = [s * (s == s[:, :-1].max(dim=1)[0][:, None]).float() for s in scores]
+        predictor = self.box_predictor[-1]
+        pred_instances, _ = fast_rcnn_inference(
+            boxes,
+            scores,
+            image_sizes,
+            predictor.test_score_thresh,
+            predictor.test_nms_thresh,
+            predictor.test_topk_per_image,
+        )
+        return pred_instances
+
+
+    def _run_stages_early_exit(self, features, proposals, \
+        classifier_info=(None,None,None)):
+        """
+        The cascade stages at testing, where a proposal leaves the cascade
+        after stage k < last once it is confidently background (the highest
+        foreground score averaged over stages 0..k below
+        early_exit_bg_thresh) or confidently classified with a stable box
+        (at least early_exit_fg_thresh, and IoU >= early_exit_box_iou
+        between the box stage k refined and the box it refined it to).
+        An exited proposal keeps the scores averaged over the stages it ran
+        and the box of its last stage; a survivor gets the same as without
+        early exit.
+
+        Returns:
+            scores (list[Tensor] of Ri x (K+1)), boxes (list[Tensor] of
+            Ri x 4) of the proposals of every image, in their input order
+        """
+        num_inst_per_image = [len(p) for p in proposals]
+        image_sizes = [x.image_size for x in proposals]
+        device = proposals[0].objectness_logits.device
+        # the input index of the proposals still in the cascade
+        active = [torch.arange(n, device=device) for n in num_inst_per_image]
+        scores, boxes = [None] * len(proposals), [None] * len(proposals)
+        score_sums = None
+        for k in range(self.num_cascade_stages):
+            if k > 0:
+                proposals = self._create_proposals_from_boxes(
+                    prev_pred_boxes, image_sizes,
+                    logits=[p.objectness_logits for p in proposals])
+            predictions = self._run_stage(features, proposals, k,
+                classifier_info=classifier_info)
+            predictor = self.box_predictor[k]
+            probs = predictor.predict_probs(predictions, proposals)
+            pred_boxes = predictor.predict_boxes(
+                (predictions[0], predictions[1]), proposals)
+            score_sums = probs if k == 0 else \
+                [s + p for s, p in zip(score_sums, probs)]
+            last = k == self.num_cascade_stages - 1
+            survivors = []
+            for i, (score_sum, pred_box, p) in enumerate(
+                zip(score_sums, pred_boxes, proposals)):
+                if scores[i] is None:
+                    scores[i] = score_sum.new_zeros(
+                        (num_inst_per_image[i], score_sum.shape[1]))
+                    boxes[i] = pred_box.new_zeros((num_inst_per_image[i], 4))
+                avg = score_sum * (1.0 / (k + 1))
+                if last:
+                    done = torch.ones(len(p), dtype=torch.bool, device=device)
+                else:
+                    fg = avg[:, :-1].max(dim=1)[0]
+                    stable = matched_pairwise_iou(
+                        p.proposal_boxes, Boxes(pred_box)) >= self.early_exit_box_iou
+                    done = (fg < self.early_exit_bg_thresh) | \
+                        ((fg >= self.early_exit_fg_thresh) & stable)
+                scores[i][active[i][done]] = avg[done]
+                boxes[i][active[i][done]] = pred_box[done]
+                keep = ~done
+                active[i] = active[i][keep]
+                survivors.append((score_sum[keep], pred_box[keep], p[keep]))
+            if last or sum(len(a) for a in active) == 0:
+                break
+            score_sums, prev_pred_boxes, proposals = \
+                [list(x) for x in zip(*survivors)]
+        return scores, boxes
 
 
     def forward(self, images, features, proposals, targets=None,
@@ -1,4 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
+import functools
+import time
+from collections import OrderedDict
 import torch
 import json
 import numpy as np
@@ -8,13 +11,18 @@ def load_class_freq(
     path='datasets/metadata/lvis_v1_train_cat_info.json', freq_weight=1.0, data_classes=80):
     if not path:
         return torch.ones(data_classes)
-    cat_info = json.load(open(path, 'r'))
-    cat_info = torch.tensor(
-        [c['image_count'] for c in sorted(cat_info, key=lambda x: x['id'])])
+    cat_info = torch.tensor(_load_image_counts(path))
     freq_weight = cat_info.float() ** freq_weight
     return freq_weight
 
 
+@functools.lru_cache(maxsize=None)
+def _load_image_counts(path):
+    # image counts of the categories, sorted by id; read once per process
+    cat_info = json.load(open(path, 'r'))
+    return tuple(c['image_count'] for c in sorted(cat_info, key=lambda x: x['id']))
+
+
 def get_fed_loss_inds(gt_classes, num_sample_cats, C, weight=None):
     appeared = torch.unique(gt_classes) # C'
     prob = appeared.new_ones(C + 1).float()
@@ -30,6 +38,55 @@ def get_fed_loss_inds(gt_classes, num_sample_cats, C, weight=None):
     return appeared
 
 
+class GeometryCache(object):
+    """
+    LRU cache of at most `max_size` tensors that only depend on the input
+    geometry (shapes, strides, dtype, device), e.g. anchors and positional
+    encodings of the fixed-size padded inputs. max_size 0 disables it.
+
+    `saved_time` estimates the host time saved so far: the hits times the
+    mean time of the misses (on CUDA the kernel launches, the kernels are
+    asynchronous).
+    """
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.miss_time = 0.
+        self.last_saved_time = 0.
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, compute):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            self.last_saved_time = self.miss_time / max(self.misses, 1)
+            return self._cache[key]
+        start_time = time.perf_counter()
+        value = compute()
+        self.miss_time += time.perf_counter() - start_time
+        self.misses += 1
+        self.last_saved_time = 0.
+        if self.max_size > 0:
+            self._cache[key] = value
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return value
+
+    @property
+    def saved_time(self):
+        return self.hits * self.miss_time / max(self.misses, 1)
+
+    def put_scalars(self, storage, name):
+        storage.put_scalar(name + "/saved_ms", self.last_saved_time * 1000.)
+        storage.put_scalar(name + "/hit_rate", self.hits / max(self.hits + self.misses, 1))
+
+    def clear(self):
+        self._cache.clear()
+
 
 def reset_cls_test(model, cls_path, num_classes):
     model.roi_heads.num_classes = num_classes
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+The test time RoI pooling of samAnchorPromptRoiHeads on synthetic features
+of one image: the FPN box pooler and the res5 VLM pooler (test_pooler of
+ClipRCNNOutputLayers) on the proposals and the FPN mask pooler on the
+detections, called one by one against FusedROIPooler, e.g.
+
+    python tools/benchmark_fused_pooler.py --num_proposals 1000 300 --num_detections 100
+
+Exits with an error if the fused outputs differ from the separate ones.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.modeling.poolers import ROIPooler
+from detectron2.structures import Boxes
+from detic.modeling.custom_poolers import FusedROIPooler
+
+
+def random_boxes(num_boxes, image_size, generator):
+    ctr = torch.rand(num_boxes, 2, generator=generator) * image_size
+    wh = torch.exp(torch.rand(num_boxes, 2, generator=generator) * 5.5) * 2
+    return torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1).clamp(min=0, max=image_size)
+
+
+def separate(poolers, fpn_feats, res5_feats, proposal_boxes, det_boxes):
+    return {
+        'box': poolers['box'](fpn_feats, proposal_boxes),
+        'vlm': poolers['vlm']([res5_feats], proposal_boxes),
+        'mask': poolers['mask'](fpn_feats, det_boxes),
+    }
+
+
+def fused(pooler, fpn_feats, res5_feats, proposal_boxes, det_boxes):
+    ret = pooler({'box': fpn_feats, 'vlm': [res5_feats]}, proposal_boxes)
+    ret.update(pooler({'mask': fpn_feats}, det_boxes))
+    return ret
+
+
+def timed(fn, args, iters, device):
+    for _ in range(2):
+        fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(iters):
+        out = fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start_time) / iters * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_proposals', type=int, nargs='+', default=[1000, 300])
+    parser.add_argument('--num_detections', type=int, default=100)
+    parser.add_argument('--image_size', type=int, default=1024)
+    parser.add_argument('--fpn_channels', type=int, default=256)
+    parser.add_argument('--res5_channels', type=int, default=2048)
+    parser.add_argument('--box_resolution', type=int, default=7)
+    parser.add_argument('--mask_resolution', type=int, default=14)
+    parser.add_argument('--pooler_type', default='ROIAlignV2')
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    fpn_scales = [1. / 4, 1. / 8, 1. / 16, 1. / 32]
+    poolers = {
+        'box': ROIPooler(args.box_resolution, fpn_scales, 0, args.pooler_type),
+        'vlm': ROIPooler(args.box_resolution, [1. / 32], 0, args.pooler_type),
+        'mask': ROIPooler(args.mask_resolution, fpn_scales, 0, args.pooler_type),
+    }
+    fused_pooler = FusedROIPooler(poolers)
+    generator = torch.Generator().manual_seed(0)
+    fpn_feats = [torch.randn(1, args.fpn_channels, int(args.image_size * s), int(args.image_size * s),
+        generator=generator).to(args.device) for s in fpn_scales]
+    res5_feats = torch.randn(1, args.res5_channels, args.image_size // 32, args.image_size // 32,
+        generator=generator).to(args.device)
+    det_boxes = [Boxes(random_boxes(args.num_detections, args.image_size, generator).to(args.device))]
+
+    print('{:>10} {:>12} {:>10} {:>10}'.format('proposals', 'separate ms', 'fused ms', 'speedup'))
+    with torch.no_grad():
+        for num_proposals in args.num_proposals:
+            proposal_boxes = [Boxes(random_boxes(num_proposals, args.image_size, generator).to(args.device))]
+            inputs = (fpn_feats, res5_feats, proposal_boxes, det_boxes)
+            ref, t_separate = timed(separate, (poolers,) + inputs, args.iters, args.device)
+            out, t_fused = timed(fused, (fused_pooler,) + inputs, args.iters, args.device)
+            for name in ref:
+                assert torch.equal(ref[name], out[name]), "{} features differ".format(name)
+            print('{:>10} {:>12.2f} {:>10.2f} {:>9.2f}x'.format(
+                num_proposals, t_separate, t_fused, t_separate / t_fused))
+    print('fused pooler: same features as the separate poolers')
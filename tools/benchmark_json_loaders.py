@@ -0,0 +1,74 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Compare peak memory and wall time of the OID/COCO json loaders, e.g.
+
+    python tools/benchmark_json_loaders.py \
+        --json datasets/oid/annotations/oid_challenge_2019_train_bbox.json
+
+Each loader runs in a fresh process so that the reported peak RSS is its own.
+"""
+import argparse
+import hashlib
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LOADERS = ['load_coco_json_mem_efficient', 'load_coco_json_streaming']
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _checksum(dicts):
+    sha = hashlib.sha1()
+    for record in dicts:
+        sha.update(repr((record['image_id'], record['file_name'],
+            record.get('neg_category_ids'))).encode())
+        for obj in record['annotations']:
+            sha.update(repr((obj['category_id'], [float(x) for x in obj['bbox']],
+                obj.get('iscrowd'), obj.get('segmentation'))).encode())
+    return sha.hexdigest()
+
+
+def _run(loader, json_file, image_root, queue):
+    from detic.data.datasets import register_oid
+    base_rss = _max_rss_mb()
+    start_time = time.time()
+    dicts = getattr(register_oid, loader)(json_file, image_root, 'benchmark')
+    load_time = time.time() - start_time
+    num_anns = sum(len(x['annotations']) for x in dicts)
+    queue.put((loader, len(dicts), num_anns, load_time,
+        base_rss, _max_rss_mb(), _checksum(dicts)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', required=True)
+    parser.add_argument('--image_root', default='')
+    parser.add_argument('--loaders', nargs='+', default=LOADERS, choices=LOADERS)
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for loader in args.loaders:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run, args=(loader, args.json, args.image_root, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            sys.exit('{} failed with exit code {}'.format(loader, proc.exitcode))
+        results.append(queue.get())
+
+    print('{:<32} {:>9} {:>11} {:>8} {:>12}'.format(
+        'loader', 'images', 'annotations', 'time(s)', 'peak(MB)'))
+    for loader, num_images, num_anns, load_time, base_rss, peak_rss, _ in results:
+        print('{:<32} {:>9} {:>11} {:>8.1f} {:>12.0f}'.format(
+            loader, num_images, num_anns, load_time, peak_rss - base_rss))
+    if len(set(x[-1] for x in results)) > 1:
+        print('WARNING: loaders returned different records')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+samAnchorPromptRoiHeads.label_and_sample_proposals (batched) against
+detectron2's StandardROIHeads.label_and_sample_proposals (per image) on
+synthetic proposals and ground truth, e.g.
+
+    python tools/benchmark_label_and_sample.py --batch_size 2 8 --num_proposals 1000 2000
+
+First checks that the two label every proposal the same (the same gt_classes
+and matched gt_boxes, with a sampling budget large enough to keep all of
+them), with and without low quality matches; then times both with
+--batch_size_per_image and --positive_fraction. Exits with an error if the
+labels differ.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.modeling.matcher import Matcher
+from detectron2.modeling.roi_heads import StandardROIHeads
+from detectron2.structures import Boxes, Instances
+from detectron2.utils.events import EventStorage
+from detic.modeling.roi_heads.clip_roi_heads import samAnchorPromptRoiHeads
+
+
+def random_boxes(num_boxes, image_size, generator):
+    ctr = torch.rand(num_boxes, 2, generator=generator) * image_size
+    wh = torch.exp(torch.rand(num_boxes, 2, generator=generator) * 5.5) * 2
+    return torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1).clamp(min=0, max=image_size)
+
+
+def synthetic_batch(batch_size, num_proposals, max_gt, num_classes, image_size, generator):
+    proposals, targets = [], []
+    for i in range(batch_size):
+        num_gt = int(torch.randint(max_gt + 1, (1,), generator=generator))
+        target = Instances((image_size, image_size))
+        target.gt_boxes = Boxes(random_boxes(num_gt, image_size, generator))
+        target.gt_classes = torch.randint(num_classes, (num_gt,), generator=generator)
+        # add_ground_truth_to_proposals needs every proposal field in the targets
+        target.index = torch.arange(num_proposals, num_proposals + num_gt)
+        # proposals near the ground truth, and a few exact duplicates (ties)
+        boxes = random_boxes(num_proposals, image_size, generator)
+        if num_gt:
+            near = target.gt_boxes.tensor[torch.randint(num_gt, (num_proposals // 2,), generator=generator)]
+            boxes[:num_proposals // 2] = near + torch.randn(near.shape, generator=generator) * 8
+            boxes[-10:] = boxes[:10]
+        proposal = Instances((image_size, image_size))
+        proposal.proposal_boxes = Boxes(boxes)
+        proposal.objectness_logits = torch.randn(num_proposals, generator=generator)
+        proposal.index = torch.arange(num_proposals)
+        proposals.append(proposal)
+        targets.append(target)
+    return proposals, targets
+
+
+def build_heads(args, batch_size_per_image, positive_fraction, allow_low_quality_matches):
+    return samAnchorPromptRoiHeads(
+        box_in_features=['p2'], box_pooler=None, box_head=torch.nn.Identity(),
+        box_predictor=torch.nn.Identity(), num_classes=args.num_classes,
+        batch_size_per_image=batch_size_per_image, positive_fraction=positive_fraction,
+        proposal_matcher=Matcher(args.iou_thresholds, args.iou_labels,
+            allow_low_quality_matches=allow_low_quality_matches),
+        proposal_append_gt=True, fused_pooler=False, batched_sampling=True)
+
+
+def labels_by_index(sampled):
+    ret = []
+    for x in sampled:
+        order = torch.argsort(x.index)
+        gt_boxes = x.gt_boxes.tensor[order] if x.has('gt_boxes') else None
+        ret.append((x.index[order], x.gt_classes[order], gt_boxes))
+    return ret
+
+
+def timed(fn, args, iters):
+    # the median, robust to other load on a CPU
+    fn(*args)
+    times = []
+    for _ in range(iters):
+        start_time = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start_time)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[2, 8])
+    parser.add_argument('--num_proposals', type=int, nargs='+', default=[1000, 2000])
+    parser.add_argument('--max_gt', type=int, default=50)
+    parser.add_argument('--num_classes', type=int, default=1203)
+    parser.add_argument('--image_size', type=int, default=1024)
+    parser.add_argument('--iou_thresholds', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--iou_labels', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--batch_size_per_image', type=int, default=512)
+    parser.add_argument('--positive_fraction', type=float, default=0.25)
+    parser.add_argument('--iters', type=int, default=10)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    loop = StandardROIHeads.label_and_sample_proposals
+    with EventStorage():
+        for allow_low_quality_matches in (False, True):
+            heads = build_heads(args, 1 << 30, 0.5, allow_low_quality_matches)
+            for batch_size in args.batch_size:
+                for num_proposals in args.num_proposals:
+                    proposals, targets = synthetic_batch(batch_size, num_proposals,
+                        args.max_gt, args.num_classes, args.image_size, generator)
+                    ref = labels_by_index(loop(heads, proposals, targets))
+                    out = labels_by_index(heads.label_and_sample_proposals(proposals, targets))
+                    for (ri, rc, rb), (oi, oc, ob) in zip(ref, out):
+                        assert torch.equal(ri, oi), 'sampled other proposals'
+                        assert torch.equal(rc, oc), 'gt_classes differ'
+                        assert (rb is None) == (ob is None) and (rb is None or torch.equal(rb, ob)), \
+                            'matched gt_boxes differ'
+        print('same labels and matched boxes as StandardROIHeads (low quality matches on and off)')
+
+        heads = build_heads(args, args.batch_size_per_image, args.positive_fraction, True)
+        print('{:>6} {:>10} {:>10} {:>12} {:>9}'.format(
+            'images', 'proposals', 'loop ms', 'batched ms', 'speedup'))
+        for batch_size in args.batch_size:
+            for num_proposals in args.num_proposals:
+                proposals, targets = synthetic_batch(batch_size, num_proposals,
+                    args.max_gt, args.num_classes, args.image_size, generator)
+                t_loop = timed(loop, (heads, proposals, targets), args.iters)
+                t_batched = timed(heads.label_and_sample_proposals, (proposals, targets), args.iters)
+                print('{:>6} {:>10} {:>10.2f} {:>12.2f} {:>8.2f}x'.format(
+                    batch_size, num_proposals, t_loop, t_batched, t_loop / t_batched))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+The mask head predictor of CustomMaskRCNNConvUpsampleHead: the full
+num_classes 1x1 conv followed by the per-RoI channel gather (what
+mask_rcnn_loss / mask_rcnn_inference read) against gathered_layer, e.g.
+
+    python tools/benchmark_mask_predictor.py --num_classes 1203 --num_rois 100 512
+
+Reports the largest difference (relative to the largest value) of the logits
+and of the gradients of the features and predictor weights, the time of
+forward and forward + backward, and the size of the predictor output (and the
+peak CUDA allocation with --device cuda).
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.layers import ShapeSpec
+from detic.modeling.roi_heads.custom_mask_head import CustomMaskRCNNConvUpsampleHead
+
+
+def full_predictor(head, x, classes):
+    logits = head.predictor(x)
+    return logits[torch.arange(len(classes), device=x.device), classes][:, None]
+
+
+def gathered_predictor(head, x, classes):
+    return head.gathered_layer(x, classes)
+
+
+def _sync(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(fn, head, x, classes, grad_out, args):
+    def step(backward):
+        head.zero_grad(set_to_none=True)
+        x.grad = None
+        out = fn(head, x, classes)
+        if backward:
+            out.backward(grad_out)
+        return out
+    for _ in range(args.warmup):
+        step(True)
+    times = {}
+    for backward in (False, True):
+        _sync(args.device)
+        start_time = time.perf_counter()
+        for _ in range(args.iters):
+            with torch.set_grad_enabled(backward):
+                step(backward)
+        _sync(args.device)
+        times[backward] = (time.perf_counter() - start_time) / args.iters * 1000
+    if args.device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    out = step(True)
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if args.device == 'cuda' else 0.
+    return out.detach(), x.grad.clone(), head.predictor.weight.grad.clone(), times, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_classes', type=int, default=1203)
+    parser.add_argument('--num_rois', type=int, nargs='+', default=[100, 512])
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--resolution', type=int, default=28)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    head = CustomMaskRCNNConvUpsampleHead(
+        ShapeSpec(channels=args.channels, height=args.resolution // 2, width=args.resolution // 2),
+        num_classes=args.num_classes, conv_dims=[args.channels], gathered_predictor=True,
+    ).to(args.device)
+    torch.nn.init.normal_(head.predictor.weight, std=0.01)
+    torch.nn.init.normal_(head.predictor.bias, std=0.01)
+    print('{} classes, {} x {}^2 mask features, on {}'.format(
+        args.num_classes, args.channels, args.resolution, args.device))
+    print('{:>6} {:<10} {:>10} {:>14} {:>14} {:>10} {:>10}'.format(
+        'RoIs', '', 'fwd ms', 'fwd+bwd ms', 'output MB', 'peak MB', 'rel diff'))
+    for num_rois in args.num_rois:
+        x = torch.randn(num_rois, args.channels, args.resolution, args.resolution,
+            device=args.device, requires_grad=True)
+        classes = torch.randint(args.num_classes, (num_rois,), device=args.device)
+        grad_out = torch.randn(num_rois, 1, args.resolution, args.resolution, device=args.device)
+        results = {}
+        for name, fn, num_channels in [
+                ('full', full_predictor, args.num_classes),
+                ('gathered', gathered_predictor, 1)]:
+            results[name] = run(fn, head, x, classes, grad_out, args)
+            _, _, _, times, peak = results[name]
+            diff = max(((a - b).abs().max() / b.abs().max()).item()
+                for a, b in zip(results[name][:3], results['full'][:3]))
+            print('{:>6} {:<10} {:>10.2f} {:>14.2f} {:>14.1f} {:>10.1f} {:>10.2e}'.format(
+                num_rois, name, times[False], times[True],
+                num_rois * num_channels * args.resolution ** 2 * x.element_size() / 2 ** 20,
+                peak, diff))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Fixed-count multi-dataset grouping (MDAspectRatioGroupedDataset /
+DIFFMDAspectRatioGroupedDataset) against PixelBudgetGroupedDataset on a
+synthetic mix of large (LVIS-like, 896) and small (ImageNet-like, 384) images
+with random aspect ratios, e.g.
+
+    python tools/benchmark_pixel_budget_batching.py --pixel_budget 6422528
+
+Each batch is padded like ImageList (to `--size_divisibility`, or to the
+`--square_size` square of the model's padding_constraints) and run through
+a small strided conv stack as a stand-in for the backbone, so images/sec
+follows the padded pixels. Peak memory is the largest padded batch (and the
+peak CUDA allocation with --device cuda).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detic.data.custom_dataset_dataloader import (
+    MDAspectRatioGroupedDataset, DIFFMDAspectRatioGroupedDataset,
+    PixelBudgetGroupedDataset)
+
+
+class SyntheticMixedDataset(object):
+    """
+    Mapped dicts of `sizes[i]` long-side images from source i, drawn with
+    probability `ratio[i]`; width / height log-uniform in [1/2.5, 2.5].
+    """
+    def __init__(self, sizes, ratio, num_samples, seed=0):
+        self.sizes = sizes
+        self.ratio = np.asarray(ratio, dtype=np.float64) / sum(ratio)
+        self.num_samples = num_samples
+        self.seed = seed
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed)
+        for _ in range(self.num_samples):
+            source = int(rng.choice(len(self.sizes), p=self.ratio))
+            aspect_ratio = np.exp(rng.uniform(-np.log(2.5), np.log(2.5)))
+            long_side = self.sizes[source]
+            if aspect_ratio >= 1:
+                w, h = long_side, int(round(long_side / aspect_ratio))
+            else:
+                w, h = int(round(long_side * aspect_ratio)), long_side
+            yield {
+                'image': torch.empty(3, h, w, dtype=torch.uint8),
+                'width': w, 'height': h, 'dataset_source': source,
+            }
+
+
+def pad_batch(batch, size_divisibility, device, square_size=0):
+    if square_size > 0:
+        return torch.zeros(len(batch), 3, square_size, square_size, device=device)
+    h = max(d['image'].shape[1] for d in batch)
+    w = max(d['image'].shape[2] for d in batch)
+    h = (h + size_divisibility - 1) // size_divisibility * size_divisibility
+    w = (w + size_divisibility - 1) // size_divisibility * size_divisibility
+    return torch.zeros(len(batch), 3, h, w, device=device)
+
+
+def run(name, grouped, args, weights):
+    if args.device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        torch.cuda.synchronize()
+    num_images, num_pixels, padded_pixels, peak_padded = 0, 0, 0, 0
+    batch_sizes = [[] for _ in args.sizes]
+    start_time = time.time()
+    for batch in grouped:
+        images = pad_batch(batch, args.size_divisibility, args.device, args.square_size)
+        x = images
+        for weight in weights:
+            x = F.relu(F.conv2d(x, weight, stride=2, padding=1))
+        x.sum().item()
+        num_images += len(batch)
+        num_pixels += sum(d['height'] * d['width'] for d in batch)
+        padded_pixels += images[:, 0].numel()
+        peak_padded = max(peak_padded, images.numel() * images.element_size())
+        batch_sizes[batch[0]['dataset_source']].append(len(batch))
+    elapsed = time.time() - start_time
+    peak = torch.cuda.max_memory_allocated() if args.device == 'cuda' else peak_padded
+    print('{:<28} {:>10.1f} {:>18} {:>10.1%} {:>12.1f}'.format(
+        name, num_images / elapsed,
+        '/'.join('{:.1f}'.format(np.mean(x)) if x else '-' for x in batch_sizes),
+        1 - num_pixels / padded_pixels, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[896, 384])
+    parser.add_argument('--ratio', type=float, nargs='+', default=[1, 1])
+    parser.add_argument('--num_samples', type=int, default=4000)
+    parser.add_argument('--batch_size', type=int, default=8,
+        help='MDAspectRatioGroupedDataset batch size')
+    parser.add_argument('--dataset_bs', type=int, nargs='+', default=[8, 32],
+        help='DIFFMDAspectRatioGroupedDataset batch sizes')
+    parser.add_argument('--pixel_budget', type=int, default=8 * 896 * 896)
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--size_divisibility', type=int, default=32)
+    parser.add_argument('--square_size', type=int, default=0,
+        help='pad every image to this square (1024 for the CLIP trunk)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    assert len(args.sizes) == len(args.ratio) == len(args.dataset_bs)
+
+    torch.manual_seed(0)
+    weights = [torch.randn(16, 3, 3, 3, device=args.device) * 0.1] + \
+        [torch.randn(16, 16, 3, 3, device=args.device) * 0.1 for _ in range(3)]
+    num_datasets = len(args.sizes)
+    dataset = SyntheticMixedDataset(args.sizes, args.ratio, args.num_samples)
+    print('{} images, sources {} with ratio {}, on {}'.format(
+        args.num_samples, args.sizes, args.ratio, args.device))
+    print('{:<28} {:>10} {:>18} {:>10} {:>12}'.format(
+        '', 'images/s', 'images/batch', 'padding', 'peak MB'))
+    run('batch_size={}'.format(args.batch_size), MDAspectRatioGroupedDataset(
+        dataset, args.batch_size, num_datasets), args, weights)
+    run('dataset_bs={}'.format(args.dataset_bs), DIFFMDAspectRatioGroupedDataset(
+        dataset, args.dataset_bs, num_datasets), args, weights)
+    run('pixel_budget={:.1f}M'.format(args.pixel_budget / 1e6), PixelBudgetGroupedDataset(
+        dataset, args.pixel_budget, num_datasets, max_batch_size=args.max_batch_size,
+        size_divisibility=args.size_divisibility, square_size=args.square_size),
+        args, weights)
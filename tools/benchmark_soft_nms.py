@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Checks batched_soft_nms_parallel against the loop Soft-NMS (soft_nms run on
+the boxes of every class) and times both, batched_soft_nms (the loop over
+all classes with box offsets) and batched_matrix_soft_nms on synthetic
+detections: clusters of jittered boxes, `--num_classes` classes scored per
+box as after the score threshold of the box predictor, e.g.
+
+    python tools/benchmark_soft_nms.py --num_boxes 1000 --num_classes 20 100
+
+Exits with an error if the parallel Soft-NMS keeps other boxes or scores
+than the loop. The matrix decay is an approximation: reported is the
+fraction of the top --topk boxes of the loop it also has in its top --topk
+and the mean score difference on the boxes both keep.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detic.modeling.layers.soft_nms import (
+    soft_nms, batched_soft_nms, batched_soft_nms_parallel, batched_matrix_soft_nms)
+
+
+def synthetic_detections(num_boxes, num_classes, num_clusters, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.rand(num_clusters, 2, generator=generator) * 1000
+    sizes = torch.rand(num_clusters, 2, generator=generator) * 200 + 20
+    cluster = torch.randint(num_clusters, (num_boxes,), generator=generator)
+    jitter = torch.randn(num_boxes, 4, generator=generator) * 0.1
+    ctr = centers[cluster] + jitter[:, :2] * sizes[cluster]
+    wh = sizes[cluster] * jitter[:, 2:].exp()
+    boxes = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1)
+    scores = torch.rand(num_boxes, generator=generator)
+    classes = torch.randint(num_classes, (num_boxes,), generator=generator)
+    return boxes, scores, classes
+
+
+def per_class_soft_nms(boxes, scores, classes, *args):
+    idxs, new_scores = [], []
+    for c in torch.unique(classes):
+        inds = torch.nonzero(classes == c).squeeze(1)
+        keep, s = soft_nms(boxes[inds], scores[inds], *args)
+        idxs.append(inds[keep.to(inds.device)])
+        new_scores.append(s.to(scores))
+    idxs, new_scores = torch.cat(idxs), torch.cat(new_scores)
+    order = torch.argsort(new_scores, descending=True, stable=True)
+    return idxs[order], new_scores[order]
+
+
+def timed(fn, args, iters, device):
+    fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(iters):
+        out = fn(*args)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start_time) / iters * 1000
+
+
+def check(ref, out):
+    ref_scores = dict(zip(ref[0].tolist(), ref[1].tolist()))
+    out_scores = dict(zip(out[0].tolist(), out[1].tolist()))
+    assert ref_scores.keys() == out_scores.keys(), \
+        "kept {} boxes, the loop {} ({} differ)".format(
+            len(out_scores), len(ref_scores), len(ref_scores.keys() ^ out_scores.keys()))
+    diff = max((abs(ref_scores[k] - out_scores[k]) for k in ref_scores), default=0.)
+    assert diff < 1e-5, "scores differ by {}".format(diff)
+    return diff
+
+
+def agreement(ref, out, topk):
+    ref_top, out_top = set(ref[0][:topk].tolist()), set(out[0][:topk].tolist())
+    ref_scores = dict(zip(ref[0].tolist(), ref[1].tolist()))
+    common = [(ref_scores[k], s) for k, s in zip(out[0].tolist(), out[1].tolist())
+        if k in ref_scores]
+    return len(ref_top & out_top) / max(len(ref_top), 1), \
+        sum(abs(a - b) for a, b in common) / max(len(common), 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_boxes', type=int, nargs='+', default=[1000, 4000])
+    parser.add_argument('--num_classes', type=int, nargs='+', default=[20, 100])
+    parser.add_argument('--num_clusters', type=int, default=50)
+    parser.add_argument('--methods', nargs='+', default=['linear', 'gaussian', 'hard'])
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--prune', type=float, default=0.001)
+    parser.add_argument('--topk', type=int, default=300)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:<9} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'boxes', 'classes', 'method', 'loop ms', 'offsets ms', 'parallel', 'matrix',
+        'matrix top-k', 'matrix |ds|'))
+    for num_boxes in args.num_boxes:
+        for num_classes in args.num_classes:
+            boxes, scores, classes = synthetic_detections(
+                num_boxes, num_classes, args.num_clusters)
+            boxes, scores, classes = [x.to(args.device) for x in (boxes, scores, classes)]
+            for method in args.methods:
+                nms_args = (method, args.sigma, args.threshold, args.prune)
+                inputs = (boxes, scores, classes) + nms_args
+                ref, t_loop = timed(per_class_soft_nms, inputs, args.iters, args.device)
+                _, t_offsets = timed(batched_soft_nms, inputs, args.iters, args.device)
+                out, t_parallel = timed(batched_soft_nms_parallel, inputs, args.iters, args.device)
+                check(ref, out)
+                if method == 'hard':
+                    t_matrix, top, ds = float('nan'), float('nan'), float('nan')
+                else:
+                    out, t_matrix = timed(batched_matrix_soft_nms, inputs, args.iters, args.device)
+                    top, ds = agreement(ref, out, args.topk)
+                print('{:>6} {:>8} {:<9} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1%} {:>10.4f}'.format(
+                    num_boxes, num_classes, method, t_loop, t_offsets, t_parallel, t_matrix, top, ds))
+    print('parallel Soft-NMS: same boxes and scores as the loop')
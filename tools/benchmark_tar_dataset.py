@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Samples/sec of DiskTarDataset on a synthetic ImageNet-21k style tar corpus
+(many small shards, a few gzipped JPEGs and GNU long names), against the
+per-shard `_TarDataset` lookup it replaced, e.g.
+
+    python tools/benchmark_tar_dataset.py --num_shards 2000 --max_open_files 16 64
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detic.data.tar_dataset import DiskTarDataset, _TarDataset
+
+
+def build_corpus(work_dir, num_shards, samples_per_shard, image_size, seed=0):
+    rng = np.random.RandomState(seed)
+    index_dir = os.path.join(work_dir, 'tarindex_npy')
+    os.makedirs(index_dir, exist_ok=True)
+    images = []
+    for _ in range(8):
+        buf = io.BytesIO()
+        Image.fromarray(rng.randint(0, 255, (image_size, image_size, 3), dtype=np.uint8)).save(
+            buf, format='JPEG')
+        images.append(buf.getvalue())
+    tar_files, payloads = [], []
+    for k in range(num_shards):
+        syn = 'n{:08d}'.format(k)
+        tar_file = os.path.join(work_dir, syn + '.tar')
+        with tarfile.open(tar_file, 'w', format=tarfile.GNU_FORMAT) as tar:
+            for i in range(samples_per_shard):
+                data = images[rng.randint(len(images))]
+                name = '{}_{}.JPEG'.format(syn, i)
+                if i % 17 == 0:
+                    name = 'x' * 120 + name  # needs a GNU LongLink header
+                payloads.append(data)
+                if i % 13 == 0:
+                    data = gzip.compress(data)
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        with tarfile.open(tar_file, 'r') as tar:
+            members = tar.getmembers()
+            end_offset = tar.offset
+        names = np.array([x.name for x in members])
+        offsets = np.array([x.offset // 512 for x in members] + [end_offset // 512], dtype=np.int64)
+        np.save(os.path.join(index_dir, syn + '_names.npy'), names)
+        np.save(os.path.join(index_dir, syn + '_offsets.npy'), offsets)
+        tar_files.append(tar_file)
+    tarfile_path = os.path.join(work_dir, 'tar_files.npy')
+    np.save(tarfile_path, np.array(tar_files))
+    return tarfile_path, index_dir, payloads
+
+
+class LegacyTarDataset(object):
+    """
+    The lookup DiskTarDataset used before the global index: one `_TarDataset`
+    (and one memmap) per shard, searchsorted + linear edge check per sample.
+    """
+    def __init__(self, tarfile_path, tar_index_dir):
+        self.chunk_datasets = [_TarDataset(x, tar_index_dir) for x in np.load(tarfile_path)]
+        self.dataset_cumsums = np.cumsum([len(x) for x in self.chunk_datasets])
+
+    def get_bytes(self, index):
+        d_index = np.searchsorted(self.dataset_cumsums, index)
+        if index in self.dataset_cumsums:
+            d_index += 1
+        local_index = index if d_index == 0 else index - self.dataset_cumsums[d_index - 1]
+        return self.chunk_datasets[d_index][local_index].getvalue()
+
+
+def num_open_files():
+    return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else -1
+
+
+def run(name, dataset, indices, decode):
+    base_fds = num_open_files()
+    start_time = time.time()
+    max_fds = 0
+    for n, i in enumerate(indices):
+        if decode:
+            dataset[i]
+        else:
+            dataset.get_bytes(i)
+        if n % 256 == 0:
+            max_fds = max(max_fds, num_open_files() - base_fds)
+    elapsed = time.time() - start_time
+    print('{:<40} {:>10.0f} {:>10}'.format(name, len(indices) / elapsed, max_fds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', default='')
+    parser.add_argument('--num_shards', type=int, default=500)
+    parser.add_argument('--samples_per_shard', type=int, default=50)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--num_reads', type=int, default=20000)
+    parser.add_argument('--max_open_files', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--decode', action='store_true', help='include JPEG decoding')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    print('Building corpus in', work_dir)
+    tarfile_path, index_dir, payloads = build_corpus(
+        work_dir, args.num_shards, args.samples_per_shard, args.image_size)
+    num_samples = len(payloads)
+
+    dataset = DiskTarDataset(tarfile_path, index_dir)
+    legacy = LegacyTarDataset(tarfile_path, index_dir)
+    check = np.random.RandomState(1).randint(num_samples, size=1000)
+    for i in check:
+        assert dataset.get_bytes(i) == payloads[i] == legacy.get_bytes(i), i
+    print(dataset, 'matches the tar contents')
+
+    rng = np.random.RandomState(0)
+    orders = {
+        'random': rng.randint(num_samples, size=args.num_reads),
+        'sequential': np.arange(args.num_reads) % num_samples,
+    }
+    print('{:<40} {:>10} {:>10}'.format('', 'samples/s', 'max fds'))
+    for order, indices in orders.items():
+        if not args.decode:
+            run('legacy {}'.format(order), LegacyTarDataset(tarfile_path, index_dir), indices, False)
+        for max_open_files in args.max_open_files:
+            for access_pattern in ['', order]:
+                dataset = DiskTarDataset(
+                    tarfile_path, index_dir, max_open_files=max_open_files,
+                    access_pattern=access_pattern)
+                run('{} max_open={} madvise={}'.format(
+                    order, max_open_files, access_pattern or '-'), dataset, indices, args.decode)
@@ -0,0 +1,45 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Pre-build the binary snapshots that `DatasetCatalog.get` reads when
+DETIC_SNAPSHOT_DIR is set, e.g.
+
+    python tools/build_dataset_snapshots.py --snapshot_dir datasets/snapshots \
+        --datasets lvis_v1_zeroshot_train coco_zeroshot_train
+
+and then train with `DETIC_SNAPSHOT_DIR=datasets/snapshots`.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--snapshot_dir", default=os.environ.get(
+        "DETIC_SNAPSHOT_DIR", "datasets/snapshots"))
+    parser.add_argument("--datasets", nargs='+', required=True)
+    args = parser.parse_args()
+
+    from detectron2.data import DatasetCatalog
+    from detectron2.utils.logger import setup_logger
+    from detic.data.datasets import snapshot
+    import detic.data.datasets.coco_zeroshot  # noqa
+    import detic.data.datasets.lvis_v1  # noqa
+    import detic.data.datasets.lvis_v1_zeroshot  # noqa
+    import detic.data.datasets.objects365  # noqa
+    import detic.data.datasets.oid  # noqa
+
+    setup_logger(name="detic")
+    snapshot.SNAPSHOT_DIR = args.snapshot_dir
+    for name in args.datasets:
+        start_time = time.time()
+        dicts = DatasetCatalog.get(name)
+        print('{}: {} images, first load {:.1f}s'.format(
+            name, len(dicts), time.time() - start_time))
+        del dicts
+        start_time = time.time()
+        dicts = DatasetCatalog.get(name)
+        print('{}: {} images, snapshot load {:.1f}s'.format(
+            name, len(dicts), time.time() - start_time))
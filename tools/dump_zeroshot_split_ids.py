@@ -0,0 +1,50 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Regenerate (or, with --check, verify) datasets/metadata/zeroshot_split_ids.json,
+the contiguous base/novel/unused category ids of open-vocabulary COCO and LVIS
+read by `get_contigous_ids` and `get_contigous_ids_lvis`.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lvis_ann", default='datasets/lvis/zero-shot/lvis_v1_train_seen.json',
+        help='LVIS v1 json (or *_cat_info.json) with the category frequencies')
+    parser.add_argument("--out_path", default='datasets/metadata/zeroshot_split_ids.json')
+    parser.add_argument("--check", action='store_true',
+        help='compare --out_path against the source files instead of writing it')
+    args = parser.parse_args()
+
+    from detectron2.data.datasets.builtin_meta import _get_builtin_metadata
+    from detic.data.datasets.zeroshot_splits import \
+        compute_coco_split_ids, compute_lvis_split_ids
+    from detic.data.datasets.coco_zeroshot import categories_seen, categories_unseen
+
+    print('Loading', args.lvis_ann)
+    data = json.load(open(args.lvis_ann, 'r'))
+    lvis_cats = data['categories'] if isinstance(data, dict) else data
+    out = {
+        'coco': compute_coco_split_ids(
+            categories_seen, categories_unseen,
+            _get_builtin_metadata('coco')['thing_dataset_id_to_contiguous_id']),
+        'lvis': compute_lvis_split_ids(lvis_cats),
+    }
+    for dataset, splits in out.items():
+        print(dataset, {k: len(v) for k, v in splits.items()})
+
+    if args.check:
+        saved = json.load(open(args.out_path, 'r'))
+        mismatch = [
+            '{}/{}'.format(dataset, k) for dataset in out for k in out[dataset]
+            if saved.get(dataset, {}).get(k) != out[dataset][k]]
+        if mismatch:
+            sys.exit('{} is out of date: {}'.format(args.out_path, ', '.join(mismatch)))
+        print(args.out_path, 'is consistent with the source annotations')
+    else:
+        print('Saving to', args.out_path)
+        json.dump(out, open(args.out_path, 'w'))
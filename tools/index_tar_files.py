@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Index the ImageNet-21k tar shards for DiskTarDataset by reading their tar
+headers directly (no `tar -tvR` logs), with a process pool across shards:
+
+    python tools/index_tar_files.py --tar_dir datasets/imagenet/ImageNet-21K \
+        --out_dir datasets/imagenet/metadata-22k/tarindex
+
+writes into --out_dir
+    tar_files.npy   the shards with more than --min_count samples (sorted)
+    tar_index.npy   int64 [num_samples, 2], first and end 512-byte block of
+                    every sample (GNU LongLink members start at the LongLink)
+    tar_labels.npy  int64 [num_samples], the shard (synset) of every sample
+    tar_names.npy   member names, with --save_names
+Use it with DATALOADER.TARFILE_PATH=<out_dir>/tar_files.npy and
+DATALOADER.TAR_INDEX_DIR=<out_dir>. gzip compressed members are counted here
+and decompressed by DiskTarDataset when read.
+"""
+import argparse
+import glob
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detic.data.tar_dataset import _tar_member_size
+
+_BLOCK = 512
+_FILE_TYPES = (b'0', b'\0', b'7')
+
+
+def _round_up(size):
+    return (size + _BLOCK - 1) // _BLOCK * _BLOCK
+
+
+def _pax_path(records):
+    # pax records are "<length> <key>=<value>\n"
+    pos = 0
+    while pos < len(records):
+        length = int(records[pos:records.index(b' ', pos)])
+        key, _, value = records[pos:pos + length].partition(b' ')[2].partition(b'=')
+        if key == b'path':
+            return value[:-1]
+        pos += length
+    return None
+
+
+def index_tar(args):
+    """
+    Returns (names, [start, end] blocks, number of gzipped members) of the
+    regular members of one tar file whose name ends with `suffix`.
+    """
+    tar_file, suffix = args
+    names, blocks, num_gzip = [], [], 0
+    with open(tar_file, 'rb') as f:
+        pos = 0
+        while True:
+            f.seek(pos)
+            header = f.read(_BLOCK)
+            if len(header) < _BLOCK or header.count(0) == _BLOCK:
+                break
+            start = pos
+            name = None
+            while header[156:157] in (b'L', b'x', b'g'):
+                # GNU long name / pax headers precede the real header
+                size = _tar_member_size(header)
+                if header[156:157] == b'L':
+                    name = f.read(size).rstrip(b'\0')
+                else:
+                    # the member is read from its own header
+                    start = pos + _BLOCK + _round_up(size)
+                    if header[156:157] == b'x':
+                        name = _pax_path(f.read(size)) or name
+                pos += _BLOCK + _round_up(size)
+                f.seek(pos)
+                header = f.read(_BLOCK)
+            if name is None:
+                name = header[:100].rstrip(b'\0')
+                if header[257:262] == b'ustar' and header[345] != 0:
+                    name = header[345:500].rstrip(b'\0') + b'/' + name
+            size = _tar_member_size(header)
+            end = pos + _BLOCK + _round_up(size)
+            name = name.decode('utf-8', 'replace')
+            if header[156:157] in _FILE_TYPES and name.endswith(suffix):
+                num_gzip += f.read(2) == b'\x1f\x8b'
+                names.append(name)
+                blocks.append((start // _BLOCK, end // _BLOCK))
+            pos = end
+    return names, np.array(blocks, dtype=np.int64).reshape(-1, 2), num_gzip
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tar_dir', default='datasets/imagenet/ImageNet-21K')
+    parser.add_argument('--tar_files', default='',
+        help='npy list of tar files to index instead of all *.tar in --tar_dir')
+    parser.add_argument('--out_dir', default='datasets/imagenet/metadata-22k/tarindex')
+    parser.add_argument('--suffix', default='JPEG')
+    parser.add_argument('--min_count', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=mp.cpu_count())
+    parser.add_argument('--save_names', action='store_true')
+    args = parser.parse_args()
+
+    if args.tar_files:
+        tar_files = [str(x) for x in np.load(args.tar_files)]
+    else:
+        tar_files = sorted(glob.glob(os.path.join(args.tar_dir, '*.tar')))
+    print('Indexing {} tar files with {} workers'.format(len(tar_files), args.num_workers))
+
+    start_time = time.time()
+    with mp.Pool(args.num_workers) as pool:
+        results = pool.map(
+            index_tar, [(x, args.suffix) for x in tar_files], chunksize=16)
+    valid = [len(x[0]) > args.min_count for x in results]
+    tar_files = [x for x, v in zip(tar_files, valid) if v]
+    results = [x for x, v in zip(results, valid) if v]
+    print('Indexed in {:.1f}s, skipped {} tar files with <= {} samples'.format(
+        time.time() - start_time, len(valid) - len(tar_files), args.min_count))
+
+    dataset_lens = [len(x[0]) for x in results]
+    tar_index = np.concatenate(
+        [x[1] for x in results] + [np.zeros((0, 2), dtype=np.int64)])
+    labels = np.repeat(np.arange(len(tar_files), dtype=np.int64), dataset_lens)
+    print('Have {} tar files and {} samples, {} gzip compressed'.format(
+        len(tar_files), len(labels), sum(x[2] for x in results)))
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    np.save(os.path.join(args.out_dir, 'tar_files.npy'), np.array(tar_files))
+    np.save(os.path.join(args.out_dir, 'tar_index.npy'), tar_index)
+    np.save(os.path.join(args.out_dir, 'tar_labels.npy'), labels)
+    if args.save_names:
+        np.save(os.path.join(args.out_dir, 'tar_names.npy'),
+            np.array([name for x in results for name in x[0]]))
+    print('Saved to', args.out_dir)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Pack registered training datasets into large tar shards (records + image
+files) for sequential streaming, e.g.
+
+    python tools/pack_dataset_shards.py --datasets lvis_v1_train_norare \
+        --out_dir datasets/shards --shard_mb 512
+
+writes datasets/shards/<dataset>/shard-*.tar and shards.json. Train with
+DATALOADER.SHARD_DIRS "['datasets/shards/lvis_v1_train_norare']" (one
+directory per DATASETS.TRAIN entry, in the same order).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", nargs='+', required=True)
+    parser.add_argument("--out_dir", default='datasets/shards')
+    parser.add_argument("--shard_mb", type=int, default=256)
+    parser.add_argument("--keep_empty", action='store_true',
+        help='keep images with only crowd annotations (FILTER_EMPTY_ANNOTATIONS=False)')
+    args = parser.parse_args()
+
+    from detectron2.data import DatasetCatalog
+    from detectron2.data.build import filter_images_with_only_crowd_annotations
+    from detectron2.utils.logger import setup_logger
+    from detic.data.sharded_dataset import write_shards
+    import detic.data.datasets.coco_zeroshot  # noqa
+    import detic.data.datasets.lvis_v1  # noqa
+    import detic.data.datasets.lvis_v1_zeroshot  # noqa
+    import detic.data.datasets.objects365  # noqa
+    import detic.data.datasets.oid  # noqa
+
+    setup_logger(name="detic")
+    for name in args.datasets:
+        start_time = time.time()
+        dicts = DatasetCatalog.get(name)
+        if not args.keep_empty and 'annotations' in dicts[0]:
+            dicts = filter_images_with_only_crowd_annotations(dicts)
+        out_dir = os.path.join(args.out_dir, name)
+        meta = write_shards(dicts, out_dir, shard_bytes=args.shard_mb << 20)
+        print('{}: {} records in {} shards at {} ({:.1f}s)'.format(
+            name, meta['num_records'], len(meta['shards']), out_dir,
+            time.time() - start_time))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Run the configured train mapper and loader without the model, e.g.
+
+    python tools/profile_dataloader.py --config-file configs/Fvlm_lvis.yaml \
+        --num-workers 4 8 16 --prefetch-factors 2 4 --output loader.yaml
+
+1. the mapper stages, in the main process: decode (read + copies + tensor
+   conversion), augment, annotation transform, mask rasterization, and the
+   sampling / grouping / collate left of a batch, in ms per sample;
+2. every NUM_WORKERS x PREFETCH_FACTOR x PERSISTENT_WORKERS setting:
+   samples/sec, time to the first batch, and to the first batch of a second
+   pass over the loader (what PERSISTENT_WORKERS saves), peak PSS of the workers and the volume
+   the workers send to the main process;
+3. writes the fastest setting (the cheapest one within --tolerance of it) as
+   a config snippet to --output.
+
+If the loader delivers batches faster than the model consumes them, the
+model is the bottleneck; `data_time` in metrics.json shows it for a run.
+"""
+import argparse
+import copy
+import glob
+import io
+import os
+import pickle
+import sys
+import time
+from collections import defaultdict
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.config import get_cfg
+from detectron2.data.dataset_mapper import DatasetMapper
+from detic.config import add_rsprompter_config
+from detic.data.custom_build_augmentation import build_custom_augmentation
+from detic.data.custom_dataset_dataloader import (
+    build_custom_train_loader, _custom_train_loader_from_config)
+from detic.data.custom_dataset_mapper import SamDatasetMapper
+
+STAGES = ['decode', 'augment', 'annotations', 'rasterize', 'collate']
+
+
+class _Timed(object):
+    """
+    Calls `fn`, adding its wall time to `times[name]`.
+    """
+    def __init__(self, fn, times, name):
+        self.fn = fn
+        self.times = times
+        self.name = name
+
+    def __getattr__(self, name):
+        return getattr(self.fn, name)
+
+    def __call__(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.times[self.name] += time.perf_counter() - start_time
+
+
+def stage_timed_mapper(mapper, times):
+    """
+    A copy of `mapper` timing its stages into `times`.
+    """
+    mapper = copy.copy(mapper)
+    mapper.augmentations = _Timed(mapper.augmentations, times, 'augment')
+    mapper._transform_annotations = _Timed(
+        mapper._transform_annotations, times, '_transform_annotations')
+    if hasattr(mapper, 'annotations_to_instances'):
+        # SamDatasetMapper rasterizes the masks here
+        mapper.annotations_to_instances = _Timed(
+            mapper.annotations_to_instances, times, 'rasterize')
+    return _Timed(mapper, times, 'mapper')
+
+
+def profile_stages(loader_kwargs, num_batches):
+    times = defaultdict(float)
+    loader_kwargs = dict(loader_kwargs,
+        mapper=stage_timed_mapper(loader_kwargs['mapper'], times),
+        sampler=copy.deepcopy(loader_kwargs['sampler']), num_workers=0)
+    loader = build_custom_train_loader(**loader_kwargs)
+    num_samples = 0
+    start_time = time.perf_counter()
+    for batch, _ in zip(loader, range(num_batches)):
+        num_samples += len(batch)
+    elapsed = time.perf_counter() - start_time
+    ms = {
+        'decode': times['mapper'] - times['augment'] - times['_transform_annotations'],
+        'augment': times['augment'],
+        'annotations': times['_transform_annotations'] - times['rasterize'],
+        'rasterize': times['rasterize'],
+        'collate': elapsed - times['mapper'],
+    }
+    return {k: v * 1000. / num_samples for k, v in ms.items()}
+
+
+def _child_pids(pid):
+    pids = []
+    for path in glob.glob('/proc/{}/task/*/children'.format(pid)):
+        try:
+            pids.extend(int(x) for x in open(path).read().split())
+        except (OSError, ValueError):
+            pass
+    return pids
+
+
+def _pss_mb(pid):
+    # proportional set size, shared pages are split between the processes
+    try:
+        for line in open('/proc/{}/smaps_rollup'.format(pid)):
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return 0.
+
+
+def workers_pss_mb():
+    return sum(_pss_mb(pid) for pid in _child_pids(os.getpid()))
+
+
+class _IPCPickler(pickle.Pickler):
+    """
+    Pickles a batch like a DataLoader worker sends it, without the tensor
+    storage: the workers move it to shared memory and only send a handle.
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, torch.Tensor):
+            # a stand-in of the size of the metadata sent for it
+            return tuple, ((tuple(obj.shape), str(obj.dtype)),)
+        return NotImplemented
+
+
+def ipc_bytes_of(batch):
+    f = io.BytesIO()
+    _IPCPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(batch)
+    return f.tell()
+
+
+def profile_loader(loader_kwargs, num_batches, warmup, measure_every=10):
+    loader = build_custom_train_loader(**dict(
+        loader_kwargs, sampler=copy.deepcopy(loader_kwargs['sampler'])))
+    start_time = time.perf_counter()
+    it = iter(loader)
+    next(it)
+    first_batch = time.perf_counter() - start_time
+    for _ in range(warmup):
+        next(it)
+    num_samples, ipc_bytes, ipc_samples, max_pss = 0, 0, 0, 0.
+    start_time = time.perf_counter()
+    for i in range(num_batches):
+        batch = next(it)
+        num_samples += len(batch)
+        if i % measure_every == 0:
+            # what the workers pickle (tensors go through shared memory)
+            ipc_bytes += ipc_bytes_of(batch)
+            ipc_samples += len(batch)
+            max_pss = max(max_pss, workers_pss_mb())
+    elapsed = time.perf_counter() - start_time
+    del it
+    # a second pass, e.g. the next evaluation over a test loader
+    start_time = time.perf_counter()
+    next(iter(loader))
+    restart = time.perf_counter() - start_time
+    return {
+        'samples/s': num_samples / elapsed,
+        'first batch s': first_batch,
+        'restart s': restart,
+        'workers PSS MB': max_pss,
+        'IPC MB/s': ipc_bytes / max(ipc_samples, 1) * num_samples / elapsed / 2 ** 20,
+    }
+
+
+def recommend(results, tolerance):
+    best = max(r['samples/s'] for r in results)
+    fast = [r for r in results if r['samples/s'] >= (1 - tolerance) * best]
+    choice = min(fast, key=lambda r: (
+        r['num_workers'], r['prefetch_factor'], r['workers PSS MB']))
+    # persistent workers only change the restart of the loader
+    same = [r for r in results if r['num_workers'] == choice['num_workers']
+        and r['prefetch_factor'] == choice['prefetch_factor']]
+    choice = min(same, key=lambda r: r['restart s'])
+    return choice
+
+
+def build_mapper(cfg):
+    if cfg.INPUT.CUSTOM_AUG == 'default':
+        # SamDatasetMapper also reads the image_bytes of the shard records
+        return SamDatasetMapper(cfg, True) if cfg.DATALOADER.SHARD_DIRS \
+            else DatasetMapper(cfg, True)
+    return SamDatasetMapper(
+        cfg, True, augmentations=build_custom_augmentation(cfg, True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', required=True)
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--prefetch-factors', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--persistent-workers', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--num-batches', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--stage-batches', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=0.05,
+        help='take the fewest workers within this fraction of the best samples/s')
+    parser.add_argument('--output', default='',
+        help='config snippet with the recommended DATALOADER settings')
+    parser.add_argument('--square-size', type=int, default=1024,
+        help='square_size of the padding_constraints of the model (PIXEL_BUDGET)')
+    parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    add_rsprompter_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    # load the dataset dicts and sampler statistics once
+    loader_kwargs = _custom_train_loader_from_config(cfg, mapper=build_mapper(cfg),
+        padding_constraints={'square_size': args.square_size})
+    print('{} images, {} per batch'.format(
+        len(loader_kwargs['dataset']), loader_kwargs['total_batch_size']))
+
+    stages = profile_stages(loader_kwargs, args.stage_batches)
+    print('mapper stages (ms / sample, 1 process):')
+    for k in STAGES:
+        print('  {:<12} {:>8.2f}'.format(k, stages[k]))
+    print('  {:<12} {:>8.2f} -> at most {:.1f} samples/s per worker'.format(
+        'total', sum(stages.values()), 1000. / max(sum(stages.values()), 1e-6)))
+
+    results = []
+    columns = ['samples/s', 'first batch s', 'restart s', 'workers PSS MB', 'IPC MB/s']
+    print(('{:>8} {:>9} {:>11}' + ' {:>15}' * len(columns)).format(
+        'workers', 'prefetch', 'persistent', *columns))
+    for num_workers in args.num_workers:
+        for prefetch_factor in args.prefetch_factors:
+            for persistent in args.persistent_workers:
+                r = profile_loader(dict(loader_kwargs,
+                    num_workers=num_workers, prefetch_factor=prefetch_factor,
+                    persistent_workers=bool(persistent)),
+                    args.num_batches, args.warmup)
+                r.update({'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                    'persistent_workers': bool(persistent)})
+                results.append(r)
+                print(('{:>8} {:>9} {:>11}' + ' {:>15.2f}' * len(columns)).format(
+                    num_workers, prefetch_factor, str(bool(persistent)),
+                    *[r[k] for k in columns]))
+
+    choice = recommend(results, args.tolerance)
+    snippet = (
+        'DATALOADER:\n'
+        '  NUM_WORKERS: {num_workers}\n'
+        '  PREFETCH_FACTOR: {prefetch_factor}\n'
+        '  PERSISTENT_WORKERS: {persistent}\n').format(
+            persistent=str(choice['persistent_workers']).lower(), **choice)
+    print('recommended ({:.1f} samples/s, {:.2f} batches/s):'.format(
+        choice['samples/s'], choice['samples/s'] / loader_kwargs['total_batch_size']))
+    print(snippet)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('# tools/profile_dataloader.py --config-file {}\n'.format(args.config_file))
+            f.write(snippet)
+        print('Saved to', args.output)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+AP against the mean number of test proposals per image for fixed and
+adaptive (CustomRPN.adaptive_topk_test) proposal budgets, e.g.
+
+    python tools/sweep_adaptive_proposals.py --config-file configs/Fvlm_lvis_eval.yaml \
+        --modes topk=1000 topk=300 thresh=0.5 thresh=0.3 mass=0.9 mass=0.8,min=20 \
+        MODEL.WEIGHTS output/model_final.pth
+
+A mode is `default` (the config) or comma separated overrides:
+    topk=N      MODEL.RPN.POST_NMS_TOPK_TEST (the fixed budget, and the
+                upper bound of the adaptive ones)
+    thresh=T    MODEL.RPN.ADAPTIVE_TOPK_TEST 'threshold' with ADAPTIVE_TOPK_THRESH T
+    mass=M      MODEL.RPN.ADAPTIVE_TOPK_TEST 'mass' with ADAPTIVE_TOPK_MASS M
+    min=K       MODEL.RPN.ADAPTIVE_TOPK_MIN
+
+For every mode, the mean / p10 / p50 / p90 number of proposals per image,
+the per-image latency of the whole model (CUDA synchronized) and the bbox /
+segm AP and APr (LVIS) of the first test dataset; the points, ordered by
+the mean number of proposals, are also written to <output-dir>/curve.json.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.evaluation import inference_on_dataset
+from detectron2.modeling import build_model
+from detic.config import add_rsprompter_config
+from detic.data.custom_build_augmentation import build_custom_augmentation
+from detic.data.custom_dataset_mapper import SamDatasetMapper
+from sweep_inference_nms import build_evaluator
+
+
+def parse_mode(mode):
+    if mode == 'default':
+        return {}
+    ret = {}
+    for item in mode.split(','):
+        key, value = item.split('=')
+        if key == 'topk':
+            ret['post_nms_topk'] = int(value)
+        elif key == 'thresh':
+            ret.update(adaptive_topk_test='threshold', adaptive_topk_thresh=float(value))
+        elif key == 'mass':
+            ret.update(adaptive_topk_test='mass', adaptive_topk_mass=float(value))
+        elif key == 'min':
+            ret['adaptive_topk_min'] = int(value)
+        else:
+            raise ValueError("Unknown mode key '{}'".format(key))
+    return ret
+
+
+class _CountProposals(object):
+    """
+    Wraps CustomRPN.predict_proposals, recording the number of proposals of
+    every image.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.num_proposals = []
+
+    def __call__(self, *args, **kwargs):
+        proposals = self.fn(*args, **kwargs)
+        self.num_proposals.extend(len(p) for p in proposals)
+        return proposals
+
+
+class _TimedForward(object):
+    """
+    Wraps the forward of the model, recording its latency per image.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.latencies = []
+
+    def __call__(self, batched_inputs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        outputs = self.fn(batched_inputs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.latencies.extend(
+            [(time.perf_counter() - start_time) / len(batched_inputs)] * len(batched_inputs))
+        return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', required=True)
+    parser.add_argument('--modes', nargs='+',
+        default=['topk=1000', 'topk=500', 'topk=300', 'thresh=0.5', 'thresh=0.3',
+            'mass=0.95', 'mass=0.9', 'mass=0.8'])
+    parser.add_argument('--output-dir', default='output/sweep_adaptive_proposals')
+    parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    add_rsprompter_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    rpn = model.proposal_generator
+    defaults = {
+        'post_nms_topk': rpn.post_nms_topk[False],
+        'adaptive_topk_test': rpn.adaptive_topk_test,
+        'adaptive_topk_thresh': rpn.adaptive_topk_thresh,
+        'adaptive_topk_mass': rpn.adaptive_topk_mass,
+        'adaptive_topk_min': rpn.adaptive_topk_min,
+    }
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    mapper = SamDatasetMapper(
+        cfg, False, augmentations=build_custom_augmentation(cfg, is_train=False))
+    data_loader = build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+
+    summary = []
+    for mode in args.modes:
+        for attr, value in dict(defaults, **parse_mode(mode)).items():
+            if attr == 'post_nms_topk':
+                rpn.post_nms_topk = {True: rpn.post_nms_topk[True], False: value}
+            else:
+                setattr(rpn, attr, value)
+        counter = _CountProposals(type(rpn).predict_proposals.__get__(rpn))
+        rpn.predict_proposals = counter
+        timed = _TimedForward(type(model).forward.__get__(model))
+        model.forward = timed
+        evaluator = build_evaluator(
+            cfg, dataset_name, os.path.join(args.output_dir, mode.replace(',', '_')))
+        try:
+            with torch.cuda.amp.autocast(enabled=cfg.SOLVER.AMP.ENABLED):
+                results = inference_on_dataset(model, data_loader, evaluator)
+        finally:
+            del rpn.predict_proposals
+            del model.forward
+        num_proposals = np.asarray(counter.num_proposals)
+        latencies_ms = np.asarray(timed.latencies) * 1000
+        row = OrderedDict([('mode', mode), ('mean props', num_proposals.mean())])
+        for p in (10, 50, 90):
+            row['p{} props'.format(p)] = np.percentile(num_proposals, p)
+        row['p50 ms'] = np.percentile(latencies_ms, 50)
+        row['mean ms'] = latencies_ms.mean()
+        for task in ('bbox', 'segm'):
+            for metric in ('AP', 'APr'):
+                if metric in results.get(task, {}):
+                    row['{} {}'.format(task, metric)] = results[task][metric]
+        print('mode {}: {:.1f} proposals / image, {:.1f} ms / image'.format(
+            mode, row['mean props'], row['mean ms']))
+        summary.append(row)
+
+    summary.sort(key=lambda row: row['mean props'])
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'curve.json'), 'w') as f:
+        json.dump([{k: v if k == 'mode' else float(v) for k, v in row.items()}
+            for row in summary], f, indent=2)
+    columns = list(OrderedDict.fromkeys(k for row in summary for k in row))
+    print(' '.join('{:>24}'.format(c) if c == 'mode' else '{:>10}'.format(c) for c in columns))
+    for row in summary:
+        print(' '.join('{:>24}'.format(row[c]) if c == 'mode' else
+            '{:>10.2f}'.format(row.get(c, float('nan'))) for c in columns))
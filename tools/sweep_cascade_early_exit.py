@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+AP against latency of DeticCascadeROIHeads with and without the test time
+early exit from the cascade (MODEL.ROI_BOX_CASCADE_HEAD.EARLY_EXIT), e.g.
+
+    python tools/sweep_cascade_early_exit.py --config-file <cascade config> \
+        --modes off bg=0.01 bg=0.02 bg=0.01,fg=0.9,iou=0.95 bg=0.02,fg=0.8,iou=0.9 \
+        MODEL.WEIGHTS output/model_final.pth
+
+A mode is `off` (all the stages for every proposal) or comma separated
+overrides of the early exit:
+    bg=T        EARLY_EXIT_BG_THRESH (0 never exits as background)
+    fg=T        EARLY_EXIT_FG_THRESH (above 1 never exits as classified)
+    iou=T       EARLY_EXIT_BOX_IOU
+unset thresholds take the config values, except fg which is 2 (off)
+unless given.
+
+For every mode, the mean number of proposals per image run by every stage,
+the fraction of the stage runs saved, the per-image latency of the whole
+model (CUDA synchronized) and the bbox / segm AP and APr (LVIS) of the first
+test dataset; the points, ordered by latency, are also written to
+<output-dir>/curve.json.
+"""
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_test_loader
+from detectron2.evaluation import inference_on_dataset
+from detectron2.modeling import build_model
+from detic.config import add_rsprompter_config
+from detic.data.custom_build_augmentation import build_custom_augmentation
+from detic.data.custom_dataset_mapper import SamDatasetMapper
+from detic.modeling.roi_heads.detic_roi_heads import DeticCascadeROIHeads
+from sweep_inference_nms import build_evaluator
+from sweep_adaptive_proposals import _TimedForward
+
+
+def parse_mode(mode):
+    if mode == 'off':
+        return {'early_exit': False}
+    ret = {'early_exit': True, 'early_exit_fg_thresh': 2.}
+    for item in mode.split(','):
+        key, value = item.split('=')
+        if key == 'bg':
+            ret['early_exit_bg_thresh'] = float(value)
+        elif key == 'fg':
+            ret['early_exit_fg_thresh'] = float(value)
+        elif key == 'iou':
+            ret['early_exit_box_iou'] = float(value)
+        else:
+            raise ValueError("Unknown mode key '{}'".format(key))
+    return ret
+
+
+class _CountStageProposals(object):
+    """
+    Wraps DeticCascadeROIHeads._run_stage, recording the number of
+    proposals every stage runs on and the number of images.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.num_proposals = defaultdict(int)
+        self.num_images = 0
+
+    def __call__(self, features, proposals, stage, **kwargs):
+        if stage == 0:
+            self.num_images += len(proposals)
+        self.num_proposals[stage] += sum(len(p) for p in proposals)
+        return self.fn(features, proposals, stage, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', required=True)
+    parser.add_argument('--modes', nargs='+',
+        default=['off', 'bg=0.005', 'bg=0.01', 'bg=0.02',
+            'bg=0.01,fg=0.9,iou=0.95', 'bg=0.02,fg=0.8,iou=0.9'])
+    parser.add_argument('--output-dir', default='output/sweep_cascade_early_exit')
+    parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    add_rsprompter_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    roi_heads = model.roi_heads
+    assert isinstance(roi_heads, DeticCascadeROIHeads), \
+        "{} is not a DeticCascadeROIHeads".format(type(roi_heads).__name__)
+    defaults = {
+        'early_exit': roi_heads.early_exit,
+        'early_exit_bg_thresh': roi_heads.early_exit_bg_thresh,
+        'early_exit_fg_thresh': roi_heads.early_exit_fg_thresh,
+        'early_exit_box_iou': roi_heads.early_exit_box_iou,
+    }
+    num_stages = roi_heads.num_cascade_stages
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    mapper = SamDatasetMapper(
+        cfg, False, augmentations=build_custom_augmentation(cfg, is_train=False))
+    data_loader = build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+
+    summary = []
+    for mode in args.modes:
+        for attr, value in dict(defaults, **parse_mode(mode)).items():
+            setattr(roi_heads, attr, value)
+        counter = _CountStageProposals(type(roi_heads)._run_stage.__get__(roi_heads))
+        roi_heads._run_stage = counter
+        timed = _TimedForward(type(model).forward.__get__(model))
+        model.forward = timed
+        evaluator = build_evaluator(
+            cfg, dataset_name, os.path.join(args.output_dir, mode.replace(',', '_')))
+        try:
+            with torch.cuda.amp.autocast(enabled=cfg.SOLVER.AMP.ENABLED):
+                results = inference_on_dataset(model, data_loader, evaluator)
+        finally:
+            del roi_heads._run_stage
+            del model.forward
+        num_images = max(counter.num_images, 1)
+        row = OrderedDict([('mode', mode)])
+        for stage in range(num_stages):
+            row['s{} props'.format(stage)] = counter.num_proposals[stage] / num_images
+        row['saved'] = 1. - sum(counter.num_proposals.values()) / \
+            max(num_stages * counter.num_proposals[0], 1)
+        latencies_ms = np.asarray(timed.latencies) * 1000
+        row['p50 ms'] = np.percentile(latencies_ms, 50)
+        row['mean ms'] = latencies_ms.mean()
+        for task in ('bbox', 'segm'):
+            for metric in ('AP', 'APr'):
+                if metric in results.get(task, {}):
+                    row['{} {}'.format(task, metric)] = results[task][metric]
+        print('mode {}: {:.1%} of the stage runs saved, {:.1f} ms / image'.format(
+            mode, row['saved'], row['mean ms']))
+        summary.append(row)
+
+    summary.sort(key=lambda row: row['mean ms'])
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'curve.json'), 'w') as f:
+        json.dump([{k: v if k == 'mode' else float(v) for k, v in row.items()}
+            for row in summary], f, indent=2)
+    columns = list(OrderedDict.fromkeys(k for row in summary for k in row))
+    print(' '.join('{:>24}'.format(c) if c == 'mode' else '{:>10}'.format(c) for c in columns))
+    for row in summary:
+        print(' '.join('{:>24}'.format(row[c]) if c == 'mode' else
+            '{:>10.2f}'.format(row.get(c, float('nan'))) for c in columns))
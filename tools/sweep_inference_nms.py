@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+"""
+Evaluate a trained model with several settings of the detection NMS
+(ClipRCNNOutputLayers.ov_fast_rcnn_inference_single_image), e.g.
+
+    python tools/sweep_inference_nms.py --config-file configs/Fvlm_lvis_eval.yaml \
+        --modes default cap=10000 cap=10000,topk=5 cap=10000,agnostic=1 \
+        MODEL.WEIGHTS output/model_final.pth
+
+A mode is `default` (the config) or comma separated overrides:
+    cap=N       MODEL.ROI_HEADS.MAX_CANDIDATES_TEST
+    topk=K      MODEL.ROI_HEADS.TOPK_CLASSES_PER_BOX
+    agnostic=1  MODEL.ROI_HEADS.CLASS_AGNOSTIC_NMS
+    nms=T       MODEL.ROI_HEADS.NMS_TYPE (hard, soft or matrix)
+
+For every mode, the per-image latency of the score filtering + NMS (a
+histogram and percentiles, CUDA synchronized) and the AP / APr (LVIS) or AP
+(COCO) of the first test dataset.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import MetadataCatalog, build_detection_test_loader
+from detectron2.evaluation import inference_on_dataset
+from detectron2.modeling import build_model
+from detic.config import add_rsprompter_config
+from detic.data.custom_build_augmentation import build_custom_augmentation
+from detic.data.custom_dataset_mapper import SamDatasetMapper
+from detic.evaluation.custom_coco_eval import CustomCOCOEvaluator, RLECOCOEvaluator
+from detic.evaluation.custom_lvis_eval import CustomLVISEvaluator
+
+MODE_KEYS = OrderedDict([
+    ('cap', ('max_candidates_test', int)),
+    ('topk', ('topk_classes_per_box', int)),
+    ('agnostic', ('class_agnostic_nms', lambda x: bool(int(x)))),
+    ('nms', ('nms_type', str)),
+])
+
+
+def parse_mode(mode):
+    if mode == 'default':
+        return {}
+    ret = {}
+    for item in mode.split(','):
+        key, value = item.split('=')
+        attr, convert = MODE_KEYS[key]
+        ret[attr] = convert(value)
+    return ret
+
+
+class _TimedInference(object):
+    """
+    Wraps ov_fast_rcnn_inference_single_image, recording its latency and the
+    number of detections of every image.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.latencies = []
+        self.num_detections = []
+
+    def __call__(self, *args, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        result, inds = self.fn(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.latencies.append(time.perf_counter() - start_time)
+        self.num_detections.append(len(result))
+        return result, inds
+
+
+def build_evaluator(cfg, dataset_name, output_folder):
+    evaluator_type = MetadataCatalog.get(dataset_name).evaluator_type
+    if evaluator_type == 'lvis':
+        return CustomLVISEvaluator(dataset_name, cfg, False, output_folder)
+    assert evaluator_type == 'coco', evaluator_type
+    if dataset_name == 'coco_generalized_zeroshot_val':
+        return CustomCOCOEvaluator(dataset_name, cfg, False, output_folder)
+    return RLECOCOEvaluator(dataset_name, cfg, False, output_folder)
+
+
+def print_histogram(latencies_ms, num_bins):
+    edges = np.geomspace(max(latencies_ms.min(), 1e-3), latencies_ms.max() * 1.0001, num_bins + 1)
+    counts, _ = np.histogram(latencies_ms, bins=edges)
+    width = 50. / max(counts.max(), 1)
+    for lo, hi, count in zip(edges[:-1], edges[1:], counts):
+        print('  {:>9.2f} - {:>9.2f} ms {:>6} {}'.format(lo, hi, count, '#' * int(count * width)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', required=True)
+    parser.add_argument('--modes', nargs='+',
+        default=['default', 'cap=10000', 'cap=10000,topk=5', 'cap=10000,agnostic=1'])
+    parser.add_argument('--bins', type=int, default=10)
+    parser.add_argument('--output-dir', default='output/sweep_inference_nms')
+    parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg = get_cfg()
+    add_rsprompter_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    predictor = model.roi_heads.box_predictor
+    defaults = {attr: getattr(predictor, attr) for attr, _ in MODE_KEYS.values()}
+
+    dataset_name = cfg.DATASETS.TEST[0]
+    mapper = SamDatasetMapper(
+        cfg, False, augmentations=build_custom_augmentation(cfg, is_train=False))
+    data_loader = build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+
+    summary = []
+    for mode in args.modes:
+        for attr, value in dict(defaults, **parse_mode(mode)).items():
+            setattr(predictor, attr, value)
+        timed = _TimedInference(type(predictor).ov_fast_rcnn_inference_single_image.__get__(predictor))
+        predictor.ov_fast_rcnn_inference_single_image = timed
+        evaluator = build_evaluator(
+            cfg, dataset_name, os.path.join(args.output_dir, mode.replace(',', '_')))
+        try:
+            with torch.cuda.amp.autocast(enabled=cfg.SOLVER.AMP.ENABLED):
+                results = inference_on_dataset(model, data_loader, evaluator)
+        finally:
+            del predictor.ov_fast_rcnn_inference_single_image
+        latencies_ms = np.asarray(timed.latencies) * 1000
+        print('mode {}: {} images, {:.1f} detections / image'.format(
+            mode, len(latencies_ms), np.mean(timed.num_detections)))
+        print_histogram(latencies_ms, args.bins)
+        row = OrderedDict([('mode', mode)])
+        for p in (50, 90, 99):
+            row['p{} ms'.format(p)] = np.percentile(latencies_ms, p)
+        row['max ms'] = latencies_ms.max()
+        for task in ('bbox', 'segm'):
+            for metric in ('AP', 'APr'):
+                if metric in results.get(task, {}):
+                    row['{} {}'.format(task, metric)] = results[task][metric]
+        summary.append(row)
+
+    columns = list(OrderedDict.fromkeys(k for row in summary for k in row))
+    print(' '.join('{:>24}'.format(c) if c == 'mode' else '{:>10}'.format(c) for c in columns))
+    for row in summary:
+        print(' '.join('{:>24}'.format(row[c]) if c == 'mode' else
+            '{:>10.2f}'.format(row.get(c, float('nan'))) for c in columns))
@@ -31,11 +31,14 @@ from detectron2.utils.events import (
 )
 from torch.cuda.amp import GradScaler
 from detic.data.custom_dataset_mapper import SamDatasetMapper
+from detic.data.custom_dataset_dataloader import build_custom_train_loader, TrainLoaderCheckpointable
+from detic.data.device_prefetcher import DevicePrefetcher
+from detic.modeling.utils import GeometryCache
 from detic.data.custom_build_augmentation import build_custom_augmentation
 from detic.config import add_rsprompter_config
 from detectron2.utils.logger import setup_logger
 from detic.custom_solver import build_sam_optimizer
-from detic.evaluation.custom_coco_eval import CustomCOCOEvaluator
+from detic.evaluation.custom_coco_eval import CustomCOCOEvaluator, RLECOCOEvaluator
 from detic.evaluation.custom_lvis_eval import CustomLVISEvaluator,LVISEvaluatorFixedAP
 import wandb
 import torch.nn as nn
@@ -54,6 +57,9 @@ def do_test(cfg, model):
         mapper = SamDatasetMapper(
                 cfg, False, augmentations=build_custom_augmentation(cfg, is_train=False))
         data_loader = build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+        if cfg.DATALOADER.DEVICE_PREFETCH > 0:
+            data_loader = DevicePrefetcher(
+                data_loader, cfg.MODEL.DEVICE, cfg.DATALOADER.DEVICE_PREFETCH)
         #####
         output_folder = os.path.join(
             cfg.OUTPUT_DIR, "inference_{}".format(dataset_name))
@@ -70,7 +76,7 @@ def do_test(cfg, model):
                 # Additionally plot mAP for 'seen classes' and 'unseen classes'
                 evaluator = CustomCOCOEvaluator(dataset_name, cfg, True, output_folder)
             else:
-                evaluator = COCOEvaluator(dataset_name, cfg, True, output_folder)
+                evaluator = RLECOCOEvaluator(dataset_name, cfg, True, output_folder)
         else:
             assert 0, evaluator_type
         if cfg.SOLVER.AMP.ENABLED:
@@ -89,8 +95,26 @@ def do_train(cfg, model, resume=False):
     # also set requires_grad for module
     optimizer = build_sam_optimizer(cfg, model, logger)
     scheduler = build_lr_scheduler(cfg, optimizer)
+    #####
+    mapper = None if cfg.INPUT.CUSTOM_AUG == 'default' \
+            else SamDatasetMapper(
+                cfg, True, augmentations=build_custom_augmentation(cfg, True))
+    #####
+    unwrapped = model.module if isinstance(model, DistributedDataParallel) else model
+    data_loader = build_custom_train_loader(cfg, mapper=mapper,
+        padding_constraints=unwrapped.clip.visual.padding_constraints)
+    if cfg.DATALOADER.DEVICE_PREFETCH > 0:
+        # without workers the dicts are mapped (with the global RNGs) by
+        # whichever thread reads the loader, which must be the training one
+        data_loader = DevicePrefetcher(
+            data_loader, cfg.MODEL.DEVICE, cfg.DATALOADER.DEVICE_PREFETCH,
+            read_in_thread=cfg.DATALOADER.NUM_WORKERS > 0)
+    # the sampler/grouping state and RNGs are saved with the model so that
+    # --resume continues the same data stream
+    loader_state = TrainLoaderCheckpointable(data_loader)
     checkpointer = DetectionCheckpointer(
         model, cfg.OUTPUT_DIR, optimizer=optimizer, scheduler=scheduler, 
+        data_loader=loader_state,
     )
     start_iter = (
         checkpointer.resume_or_load(cfg.MODEL.WEIGHTS, resume=resume).get("iteration", -1) + 1
@@ -113,19 +137,15 @@ def do_train(cfg, model, resume=False):
     )
     # compared to "train_net.py", we do not support accurate timing and
     # precise BN here, because they are not trivial to implement in a small training loop
-    #####
-    mapper = None if cfg.INPUT.CUSTOM_AUG == 'default' \
-            else SamDatasetMapper(
-                cfg, True, augmentations=build_custom_augmentation(cfg, True))
-    #####
-    
-    data_loader = build_detection_train_loader(cfg, mapper=mapper)
     if cfg.SOLVER.AMP.ENABLED:
         scaler = GradScaler()
     logger.info("Starting training from iteration {}".format(start_iter))
     with EventStorage(start_iter) as storage:
         for data, iteration in zip(data_loader, range(start_iter, max_iter)):
             storage.iter = iteration
+            if isinstance(data_loader, DevicePrefetcher):
+                # time this step waited for the loader
+                storage.put_scalar("data_time", data_loader.wait_time)
             if cfg.SOLVER.AMP.ENABLED:
                 with torch.cuda.amp.autocast():
                     loss_dict = model(data)
@@ -171,7 +191,19 @@ def do_train(cfg, model, resume=False):
                     loss_dict_reduced['iteration'] = iteration
                     loss_dict_reduced['total_loss'] = losses_reduced
                     wandb.log(loss_dict_reduced)
+            if (iteration + 1) % cfg.SOLVER.CHECKPOINT_PERIOD == 0 \
+                or iteration >= max_iter - 1:
+                # PeriodicCheckpointer saves at this iteration
+                loader_state.gather()
             periodic_checkpointer.step(iteration)
+    if isinstance(data_loader, DevicePrefetcher) and data_loader.num_batches:
+        logger.info("Waited {:.1f}s for the data loader in {} iterations".format(
+            data_loader.total_wait_time, data_loader.num_batches))
+    for name, module in model.named_modules():
+        for attr, cache in vars(module).items():
+            if isinstance(cache, GeometryCache) and cache.hits:
+                logger.info("{} {}: {} hits / {} misses, saved ~{:.1f}s".format(
+                    name, attr, cache.hits, cache.misses, cache.saved_time))
 
 def setup(args):
     """